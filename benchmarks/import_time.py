@@ -0,0 +1,74 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Import time of `run_dada2 --help` (or of any module), measured with
+`python -X importtime`: the total, and the slowest imports.
+
+    python benchmarks/import_time.py [--target 300] [--module MODULE]
+
+Exits with status 1 if the import time of `--help` exceeds the target (ms).
+"""
+
+import sys
+import time
+import subprocess
+import click
+
+HELP = ('from evaluate_dada2.scripts._standalone_dada2 import '
+        'standalone_dada2; standalone_dada2(["--help"])')
+
+
+def get_import_times(code):
+    """Cumulative import time (ms) of each import of the code, and whether
+    it is a top-level import"""
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    start = time.time()
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    wall = 1000 * (time.time() - start)
+    if proc.returncode:
+        raise RuntimeError(proc.stderr)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        top_level = not name.startswith('   ')
+        imports.append((int(cumulative) / 1000., name.strip(), top_level))
+    return imports, wall
+
+
+def show(what, imports, wall, top):
+    total = sum(ms for ms, _, top_level in imports if top_level)
+    print('%s: %s ms of imports (%s ms wall time)' % (
+        what, round(total), round(wall)))
+    for ms, name, _ in sorted(imports, reverse=True)[:top]:
+        print('  %10s ms  %s' % (round(ms, 1), name))
+    return total
+
+
+@click.command()
+@click.option("-t", "--target", default=300, show_default=True,
+              help="Target import time of `run_dada2 --help` (ms)")
+@click.option("-m", "--module", default=None,
+              help="Also report the import time of this module "
+                   "(e.g. evaluate_dada2.run_dada2)")
+@click.option("-n", "--top", default=10, show_default=True,
+              help="Number of slowest imports to show")
+def import_time(target, module, top):
+    total = show('run_dada2 --help', *get_import_times(HELP), top)
+    if module:
+        show(module, *get_import_times('import %s' % module), top)
+    if total > target:
+        print('Above the target of %s ms' % target)
+        sys.exit(1)
+    print('Below the target of %s ms' % target)
+
+
+if __name__ == "__main__":
+    import_time()
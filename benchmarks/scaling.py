@@ -0,0 +1,224 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Scaling of the stages of run_dada2 on synthetic datasets (see
+`synthetic.py`) of small, medium and large sizes: each size is run from
+scratch with `--trace`, and the wall time, CPU time (including that of the
+subprocesses), peak memory and I/O of each stage are saved as JSON.
+
+    python benchmarks/scaling.py run -o OUT_DIR [--size small] [...]
+    python benchmarks/scaling.py compare OLD.json NEW.json
+
+The results of two versions (e.g. two commits) are compared stage by stage.
+"""
+
+import os
+import json
+import time
+import shutil
+import platform
+import subprocess
+import click
+
+from synthetic import make_dataset
+
+# dataset (see `make_dataset`) and denoising grid of each size
+SIZES = {
+    'small': {'n_samples': 6, 'n_reads': 2000, 'n_refs': 20, 'n_others': 20,
+              'trim_lengths': (150, 200)},
+    'medium': {'n_samples': 24, 'n_reads': 10000, 'n_refs': 50,
+               'n_others': 100, 'trim_lengths': (150, 175, 200, 225)},
+    'large': {'n_samples': 96, 'n_reads': 50000, 'n_refs': 200,
+              'n_others': 400, 'trim_lengths': (150, 175, 200, 225, 250)}}
+# spans (category, name) of each stage (see `evaluate_dada2.trace`), where
+# None matches any name of the category
+STAGES = {
+    'fastq_discovery': [('stage', 'get_fastqs')],
+    'denoising': [('stage', 'import'), ('task', 'denoise')],
+    'dada2_results': [('stage', 'get_results'), ('stage', 'get_stats_pd')],
+    'stability': [('stage', 'get_stability')],
+    'clustering': [('stage', 'open_ref')],
+    'regressions': [('stage', 'get_regressions')],
+    'blast': [('stage', 'search')],
+    'hit_parsing': [('stage', 'get_hits_pd')],
+    'evaluation': [('stage', 'evaluation')],
+    'plotting': [('plot', None), ('stage', 'pdf_report'),
+                 ('stage', 'html_report')]}
+
+
+def get_busy(intervals):
+    """Time covered by (possibly overlapping, e.g. parallel) intervals"""
+    busy, end = 0, None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            busy += stop - start
+            end = stop
+        elif stop > end:
+            busy += stop - end
+            end = stop
+    return busy
+
+
+def get_top(events):
+    """Spans that are not nested in another of the spans, in the same thread
+    (e.g. the plots rendered in-process by the PDF report): of spans with
+    the same interval, the outer one is written last"""
+    spans = [((e['pid'], e['tid']), e['ts'], e['ts'] + e['dur'], -edx)
+             for edx, e in enumerate(events)]
+
+    def nests(o, s):
+        return o[0] == s[0] and o[1] <= s[1] and s[2] <= o[2] and (
+            o[1], -o[2], o[3]) < (s[1], -s[2], s[3])
+    return [e for e, s in zip(events, spans)
+            if not any(nests(o, s) for o in spans)]
+
+
+def get_stages(events):
+    """Wall time (covered by the stage's spans), summed CPU time and I/O
+    (of its spans not nested in another, and without the process totals of
+    the spans overlapping other threads, see `evaluate_dada2.trace`), and
+    max peak memory of the spans of each stage"""
+    stages = {}
+    for stage, spans in STAGES.items():
+        stage_events = [e for e in events if e.get('ph') == 'X' and any(
+            e['cat'] == cat and name in (None, e['name'])
+            for cat, name in spans)]
+        if not stage_events:
+            continue
+        args = [e['args'] for e in get_top(stage_events)]
+        stages[stage] = {
+            'calls': len(stage_events),
+            'wall_s': round(get_busy([(e['ts'], e['ts'] + e['dur'])
+                                      for e in stage_events]) / 1e6, 3),
+            'cpu_s': round(sum(x['cpu_s'] + x.get('children_cpu_s', 0)
+                               for x in args), 3),
+            'peak_rss_mb': round(max(x['peak_rss_mb'] for x in args), 1),
+            'read_mb': round(sum(x.get('read_mb', 0) for x in args), 1),
+            'written_mb': round(sum(x.get('written_mb', 0) for x in args),
+                                1)}
+    return stages
+
+
+def get_commit():
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(['git', '-C', repo, 'rev-parse', '--short', 'HEAD'],
+                          capture_output=True, text=True)
+    return proc.stdout.strip() or None
+
+
+def run_size(size_dir, size, n_cores, search, evaluator):
+    """Generate the dataset of a size and run the pipeline on it from
+    scratch, traced"""
+    from evaluate_dada2.run_dada2 import run_dada2
+    params = dict(SIZES[size])
+    trim_lengths = params.pop('trim_lengths')
+    if os.path.isdir(size_dir):
+        shutil.rmtree(size_dir)
+    start = time.time()
+    metadata, mock_dir, tax_file = make_dataset(size_dir, **params)
+    generation = time.time() - start
+    start = time.time()
+    run_dada2(
+        base_dir=size_dir, metadata=metadata, mock_ref_dir=mock_dir,
+        ref_tax_file=tax_file, meta_cols=['group'],
+        ranks=['d', 'p', 'c', 'o', 'f', 'g', 's'], trim_range=(150, 250, 25),
+        trim_lengths=trim_lengths, f_trim_lengths=(), r_trim_lengths=(),
+        n_cores=n_cores, sample_regressions=True, trunc_q=20, max_er=2.0,
+        max_er_rev=2.0, n_reads_learn=1000000, search=search,
+        evaluator=evaluator, max_meta_depth=0, stability='neighbors',
+        n_boot=0, report='both', trace=True)
+    total = time.time() - start
+    with open('%s/trace.json' % size_dir) as f:
+        events = json.load(f)['traceEvents']
+    return {'dataset': SIZES[size], 'combinations': len(trim_lengths) ** 2,
+            'generation_s': round(generation, 3), 'wall_s': round(total, 3),
+            'stages': get_stages(events)}
+
+
+@click.group()
+def scaling():
+    pass
+
+
+@scaling.command()
+@click.option("-o", "--o-dir", required=True,
+              help="Folder for the datasets and runs of each size")
+@click.option("-s", "--size", multiple=True, type=click.Choice(list(SIZES)),
+              default=list(SIZES), show_default=True,
+              help="Sizes to benchmark")
+@click.option("-n", "--n-cores", default=4, show_default=True,
+              help="Number of cores for multiprocessing")
+@click.option("-b", "--search", type=click.Choice(['blastn', 'kmer']),
+              default='blastn', show_default=True, help="Search backend")
+@click.option("-v", "--evaluator", type=click.Choice(['native', 'qiime2']),
+              default='native', show_default=True, help="Evaluator")
+@click.option("-j", "--o-json", default=None,
+              help="Results file [default: OUT_DIR/scaling_<commit>.json]")
+@click.option("--keep/--no-keep", default=False, show_default=True,
+              help="Keep the datasets and outputs of each size")
+def run(o_dir, size, n_cores, search, evaluator, o_json, keep):
+    from evaluate_dada2 import __version__
+    results = {'version': __version__, 'commit': get_commit(),
+               'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'settings': {'n_cores': n_cores, 'search': search,
+                            'evaluator': evaluator},
+               'sizes': {}}
+    for s in size:
+        print('[%s] %s' % (s, SIZES[s]))
+        size_dir = '%s/%s' % (o_dir, s)
+        results['sizes'][s] = run_size(size_dir, s, n_cores, search,
+                                       evaluator)
+        if not keep:
+            shutil.rmtree(size_dir)
+    if not o_json:
+        o_json = '%s/scaling_%s.json' % (o_dir, results['commit'] or 'local')
+    with open(o_json, 'w') as o:
+        json.dump(results, o, indent=2)
+    show(results)
+    print('Written:', o_json)
+
+
+def show(results):
+    for s, res in results['sizes'].items():
+        print('%s (%s s in total):' % (s, res['wall_s']))
+        for stage, metrics in res['stages'].items():
+            print('  %-16s %10s s wall %10s s CPU %10s MB' % (
+                stage, metrics['wall_s'], metrics['cpu_s'],
+                metrics['peak_rss_mb']))
+
+
+@scaling.command()
+@click.argument("old_json")
+@click.argument("new_json")
+@click.option("-m", "--metric", default='wall_s', show_default=True,
+              type=click.Choice(['wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb',
+                                 'written_mb']),
+              help="Metric to compare")
+def compare(old_json, new_json, metric):
+    with open(old_json) as f:
+        old = json.load(f)
+    with open(new_json) as f:
+        new = json.load(f)
+    print('%s: %s (%s) vs. %s (%s)' % (metric, old['commit'], old['date'],
+                                       new['commit'], new['date']))
+    if old['settings'] != new['settings']:
+        print('Warning: different settings (%s vs. %s)' % (
+            old['settings'], new['settings']))
+    for s in [x for x in old['sizes'] if x in new['sizes']]:
+        print(s)
+        olds, news = old['sizes'][s]['stages'], new['sizes'][s]['stages']
+        for stage in [x for x in STAGES if x in olds and x in news]:
+            before, after = olds[stage][metric], news[stage][metric]
+            ratio = after / before if before else float('nan')
+            print('  %-16s %10s %10s  x%.2f' % (stage, before, after, ratio))
+
+
+if __name__ == "__main__":
+    scaling()
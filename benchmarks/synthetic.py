@@ -0,0 +1,255 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Synthetic dataset for run_dada2: a mock community of related reference
+sequences (with their taxonomy and clustering levels), and the paired FASTQs
+of mock samples and of other samples (mixing some mock references with
+unrelated sequences), sequenced with a position-dependent error profile.
+
+    python benchmarks/synthetic.py -o OUT_DIR [--n-samples 12] [...]
+
+Writes, in OUT_DIR:
+    01_trimmed/<sample>_R1.fastq.gz, 01_trimmed/<sample>_R2.fastq.gz
+    metadata.tsv (`sample_name`, `control_type` and `group`)
+    mock/clustering/<perc_identity>/sequences.fasta
+    mock/clustering/<perc_identity>/relative_abundances.tsv
+    mock/taxonomy.tsv
+
+i.e., the inputs of:
+    run_dada2 -i OUT_DIR -m OUT_DIR/metadata.tsv -mi OUT_DIR/mock \\
+        -mt taxonomy.tsv -c group
+"""
+
+import os
+import gzip
+import click
+import numpy as np
+import pandas as pd
+
+NUCLS = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT = np.array([3, 2, 1, 0])
+RANKS = ['d', 'p', 'c', 'o', 'f', 'g', 's']
+# divergence between genera, between the species of a genus and between the
+# strains of a species (substitutions per position)
+DIVERGENCES = (0.08, 0.01, 0.002)
+
+
+def mutate(seq, rate, rng):
+    """Copy of a sequence (codes) with substitutions at `rate` of its
+    positions (at least one)"""
+    seq = seq.copy()
+    pos = rng.choice(len(seq), max(1, round(rate * len(seq))), replace=False)
+    seq[pos] = (seq[pos] + rng.integers(1, 4, len(pos))) % 4
+    return seq
+
+
+def get_tree_seqs(n_seqs, length, rng, n_species=3, n_strains=2):
+    """Sequences (codes) descending from one random ancestor through
+    genera, species and strains, and the (genus, species) of each"""
+    root = rng.integers(0, 4, length)
+    seqs, clades = [], []
+    while len(seqs) < n_seqs:
+        genus = mutate(root, DIVERGENCES[0], rng)
+        g = len(set(x for x, _ in clades))
+        for s in range(n_species):
+            species = mutate(genus, DIVERGENCES[1], rng)
+            for _ in range(n_strains):
+                seqs.append(mutate(species, DIVERGENCES[2], rng))
+                clades.append((g, s))
+    return np.array(seqs[:n_seqs]), clades[:n_seqs]
+
+
+def get_lineage(g, s):
+    """Taxonomy of a reference, nested in ranks up to its genus/species"""
+    names = ['Bacteria', 'Phylum%s' % (g // 8), 'Class%s' % (g // 4),
+             'Order%s' % (g // 2), 'Family%s' % g, 'Genus%s' % g,
+             'Genus%s_species%s' % (g, s)]
+    return '; '.join('%s__%s' % x for x in zip(RANKS, names))
+
+
+def get_abundances(n, rng, sigma=1.):
+    """Log-normal relative abundances"""
+    abundances = rng.lognormal(0, sigma, n)
+    return abundances / abundances.sum()
+
+
+def cluster(seqs, abundances, perc_identity):
+    """Greedy clustering (most abundant first) of equal-length sequences on
+    their identity: the representative of each sequence"""
+    reps = []
+    assignments = np.zeros(len(seqs), dtype=int)
+    for idx in np.argsort(-abundances, kind='stable'):
+        if reps:
+            identities = (seqs[reps] == seqs[idx]).mean(1)
+            best = identities.argmax()
+            if identities[best] >= perc_identity:
+                assignments[idx] = reps[best]
+                continue
+        reps.append(idx)
+        assignments[idx] = idx
+    return assignments
+
+
+def write_fasta(fasta_fp, ids, seqs):
+    with open(fasta_fp, 'w') as o:
+        for name, seq in zip(ids, seqs):
+            o.write('>%s\n%s\n' % (name, NUCLS[seq].tobytes().decode()))
+
+
+def write_mock(mock_dir, seqs, clades, abundances, perc_identities):
+    """Reference sequences and expected relative abundances of the mock,
+    at each clustering level, and the taxonomy of the references"""
+    ids = ['ref%s' % idx for idx in range(len(seqs))]
+    for p in perc_identities:
+        p_dir = '%s/clustering/%s' % (mock_dir, p)
+        os.makedirs(p_dir, exist_ok=True)
+        reps = cluster(seqs, abundances, float(p))
+        rep_pd = pd.Series(abundances).groupby(reps).sum()
+        write_fasta('%s/sequences.fasta' % p_dir,
+                    [ids[x] for x in rep_pd.index], seqs[rep_pd.index])
+        pd.DataFrame({'featureid': [ids[x] for x in rep_pd.index],
+                      'mock': rep_pd.values}).to_csv(
+            '%s/relative_abundances.tsv' % p_dir, index=False, sep='\t')
+    tax_pd = pd.DataFrame({'Feature ID': ids, 'Taxon': [
+        get_lineage(g, s) for g, s in clades]})
+    tax_pd.to_csv('%s/taxonomy.tsv' % mock_dir, index=False, sep='\t')
+
+
+def get_qualities(n_reads, length, error_start, error_end, rng):
+    """Phred scores degrading along the reads (from the error probability
+    at the first to that at the last position), with noise per read and
+    per base"""
+    errors = np.linspace(error_start, error_end, length)
+    mean = -10 * np.log10(errors)
+    noise = rng.normal(0, 2, (n_reads, 1)) + rng.normal(0, 3, (n_reads,
+                                                            length))
+    return np.clip(np.rint(mean + noise), 2, 40).astype(np.uint8)
+
+
+def sequence(templates, read_length, error_start, error_end, rng):
+    """Reads (codes) and Phred scores of the first bases of the templates,
+    with substitutions at the error probability of each base's score"""
+    reads = templates[:, :read_length].copy()
+    quals = get_qualities(reads.shape[0], reads.shape[1], error_start,
+                          error_end, rng)
+    errors = rng.random(reads.shape) < 10 ** (quals / -10)
+    reads[errors] = (reads[errors] + rng.integers(1, 4, errors.sum())) % 4
+    return reads, quals
+
+
+def write_fastq(fastq_fp, names, reads, quals, mate):
+    seqs = NUCLS[reads].view('S%s' % reads.shape[1]).ravel()
+    scores = (quals + 33).view('S%s' % quals.shape[1]).ravel()
+    with gzip.open(fastq_fp, 'wb', compresslevel=1) as o:
+        o.write(b''.join(b'@%s %d:N:0:1\n%s\n+\n%s\n' % (name, mate, seq, q)
+                         for name, seq, q in zip(names, seqs, scores)))
+
+
+def write_sample(fastqs_dir, sample, seqs, composition, n_reads, read_length,
+                 error_profile, rng):
+    """Paired FASTQs of the reads of a sample, drawn from its composition
+    (the reverse reads start from the other end, with more errors)"""
+    error_start, error_end, reverse_factor = error_profile
+    counts = rng.multinomial(n_reads, composition)
+    templates = np.repeat(seqs, counts, axis=0)
+    templates = templates[rng.permutation(n_reads)]
+    names = [b'%s.%d' % (sample.encode(), idx) for idx in range(n_reads)]
+    for mate, mate_templates, factor in [
+            (1, templates, 1), (2, COMPLEMENT[templates[:, ::-1]],
+                                reverse_factor)]:
+        reads, quals = sequence(mate_templates, read_length,
+                                error_start * factor, error_end * factor, rng)
+        write_fastq('%s/%s_R%s.fastq.gz' % (fastqs_dir, sample, mate),
+                    names, reads, quals, mate)
+
+
+def get_sample_composition(n_refs, n_others, mock_fraction, rng):
+    """Composition of a (non-mock) sample: a random subset of the mock
+    references, and of the unrelated sequences"""
+    present = np.concatenate([rng.random(n_refs) < mock_fraction,
+                              rng.random(n_others) < .5])
+    composition = get_abundances(n_refs + n_others, rng) * present
+    return composition / composition.sum()
+
+
+def make_dataset(out_dir, n_samples=12, n_mocks=1, n_reads=2000, n_refs=20,
+                 n_others=40, amplicon_length=253, read_length=250,
+                 error_profile=(0.001, 0.01, 2.), mock_fraction=0.3,
+                 perc_identities=('0.97', '0.99', '1.0'), seed=12345):
+    """Write a synthetic dataset (see the module docstring) and return the
+    paths of its metadata, mock folder and taxonomy file name"""
+    rng = np.random.default_rng(seed)
+    read_length = min(read_length, amplicon_length)
+    refs, clades = get_tree_seqs(n_refs, amplicon_length, rng)
+    others, _ = get_tree_seqs(n_others, amplicon_length, rng)
+    abundances = get_abundances(n_refs, rng)
+    mock_dir = '%s/mock' % out_dir
+    write_mock(mock_dir, refs, clades, abundances, perc_identities)
+
+    fastqs_dir = '%s/01_trimmed' % out_dir
+    os.makedirs(fastqs_dir, exist_ok=True)
+    seqs = np.concatenate([refs, others])
+    meta = []
+    for sdx in range(n_mocks + n_samples):
+        if sdx < n_mocks:
+            sample = 'mock_%03d' % (sdx + 1)
+            composition = np.concatenate([abundances, np.zeros(n_others)])
+            meta.append([sample, 'control positive', 'mock'])
+        else:
+            sample = 'sample_%03d' % (sdx - n_mocks + 1)
+            composition = get_sample_composition(n_refs, n_others,
+                                                 mock_fraction, rng)
+            meta.append([sample, 'sample', 'AB'[sdx % 2]])
+        write_sample(fastqs_dir, sample, seqs, composition, n_reads,
+                     read_length, error_profile, rng)
+    metadata = '%s/metadata.tsv' % out_dir
+    pd.DataFrame(meta, columns=['sample_name', 'control_type', 'group']
+                 ).to_csv(metadata, index=False, sep='\t')
+    return metadata, mock_dir, 'taxonomy.tsv'
+
+
+@click.command()
+@click.option("-o", "--o-dir", required=True,
+              help="Output folder (the `-i` of run_dada2)")
+@click.option("-s", "--n-samples", default=12, show_default=True,
+              help="Number of samples (besides the mock samples)")
+@click.option("-k", "--n-mocks", default=1, show_default=True,
+              help="Number of mock samples")
+@click.option("-n", "--n-reads", default=2000, show_default=True,
+              help="Number of read pairs per sample")
+@click.option("-f", "--n-refs", default=20, show_default=True,
+              help="Number of reference sequences in the mock community")
+@click.option("-u", "--n-others", default=40, show_default=True,
+              help="Number of sequences unrelated to the mock community, "
+                   "found in the other samples")
+@click.option("-a", "--amplicon-length", default=253, show_default=True,
+              help="Length of the amplicons (nt)")
+@click.option("-l", "--read-length", default=250, show_default=True,
+              help="Length of the reads (nt)")
+@click.option("-e", "--error-profile", nargs=3, type=float,
+              default=(0.001, 0.01, 2.), show_default=True,
+              help="Error probability at the first and last base of the "
+                   "forward reads, and factor for the reverse reads")
+@click.option("-p", "--perc-identities", multiple=True,
+              default=('0.97', '0.99', '1.0'), show_default=True,
+              help="Clustering levels of the mock references")
+@click.option("--seed", default=12345, show_default=True,
+              help="Seed of the random generator")
+def synthetic(o_dir, n_samples, n_mocks, n_reads, n_refs, n_others,
+              amplicon_length, read_length, error_profile, perc_identities,
+              seed):
+    metadata, mock_dir, tax_file = make_dataset(
+        o_dir, n_samples, n_mocks, n_reads, n_refs, n_others, amplicon_length,
+        read_length, error_profile, perc_identities=perc_identities,
+        seed=seed)
+    print('Written: %s (metadata), %s (mock, taxonomy in %s)' % (
+        metadata, mock_dir, tax_file))
+
+
+if __name__ == "__main__":
+    synthetic()
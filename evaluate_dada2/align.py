@@ -0,0 +1,195 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+from evaluate_dada2.io import read_fasta, get_pool
+
+OUT_COLS = ['qseqid', 'sseqid', 'pident', 'bitscore', 'qcovs']
+# megablast (reward=1, penalty=-2) Karlin-Altschul parameters
+LAMBDA, K = 1.28, 0.46
+# scores are doubled to stay integer: linear gaps of 2.5 as in megablast
+MATCH, MISMATCH, GAP = 2, -4, -5
+NEG = -10 ** 6
+CODES = np.full(256, 4, dtype=np.int8)
+for c, n in zip(b'ACGT', range(4)):
+    CODES[c] = n
+
+
+def get_bitscore(raw_score):
+    """Bit score of an HSP from its raw score, formatted as BLAST does"""
+    bitscore = (LAMBDA * raw_score - np.log(K)) / np.log(2)
+    if bitscore > 99.9:
+        return float(int(bitscore))
+    return round(bitscore, 1)
+
+
+def rev_comp(seq):
+    return seq[::-1].translate(str.maketrans('ACGTN', 'TGCAN'))
+
+
+def encode(seq):
+    return CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+def get_kmers(codes, k):
+    """Integer code of every k-mer (-1 for k-mers with ambiguous bases)"""
+    if len(codes) < k:
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    kmers = (windows.astype(np.int64) << (2 * np.arange(k - 1, -1, -1))).sum(1)
+    kmers[(windows > 3).any(1)] = -1
+    return kmers
+
+
+def get_kmer_index(ref_fasta, k=12):
+    """Sorted k-mers of the reference sequences with their positions"""
+    refs = read_fasta(ref_fasta)
+    ids = list(refs)
+    codes = [encode(refs[x]) for x in ids]
+    lens = np.array([len(x) for x in codes])
+    ref_mat = np.full((len(ids), lens.max()), 4, dtype=np.int8)
+    kmers, ref_idx, ref_pos = [], [], []
+    for rdx, ref_codes in enumerate(codes):
+        ref_mat[rdx, :len(ref_codes)] = ref_codes
+        ref_kmers = get_kmers(ref_codes, k)
+        kmers.append(ref_kmers)
+        ref_idx.append(np.full(len(ref_kmers), rdx))
+        ref_pos.append(np.arange(len(ref_kmers)))
+    kmers, ref_idx, ref_pos = map(np.concatenate, [kmers, ref_idx, ref_pos])
+    order = np.argsort(kmers, kind='stable')
+    index = {'ids': ids, 'lens': lens, 'mat': ref_mat, 'k': k,
+             'kmers': kmers[order], 'idx': ref_idx[order],
+             'pos': ref_pos[order]}
+    return index
+
+
+def get_seeds(query, index):
+    """Best seeded diagonal (ref position - query position) per reference"""
+    q_kmers = get_kmers(query, index['k'])
+    q_pos = np.arange(len(q_kmers))[q_kmers >= 0]
+    q_kmers = q_kmers[q_kmers >= 0]
+    starts = np.searchsorted(index['kmers'], q_kmers, side='left')
+    ends = np.searchsorted(index['kmers'], q_kmers, side='right')
+    n_hits = ends - starts
+    if not n_hits.sum():
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    hits = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+    refs = index['idx'][hits]
+    diags = index['pos'][hits] - np.repeat(q_pos, n_hits)
+    seeds = pd.Series(1, index=pd.MultiIndex.from_arrays([refs, diags]))
+    votes = seeds.groupby(level=[0, 1]).sum().sort_values(ascending=False)
+    votes = votes[~votes.index.get_level_values(0).duplicated()]
+    return (votes.index.get_level_values(0).values,
+            votes.index.get_level_values(1).values)
+
+
+def banded_align(query, index, refs, diags, w=16):
+    """Banded local alignment (linear gaps) of one query against the
+    seeded diagonal of each candidate reference, all at once.
+
+    Each band row is filled in a vectorized way: horizontal gaps are
+    resolved with a running maximum over (score - GAP * band position),
+    and the identities, alignment length and query start of every cell
+    are carried along instead of doing a traceback."""
+    n, band = len(refs), np.arange(-w, w + 1)
+    n_b = len(band)
+    cols = np.arange(n)[:, None]
+    H = np.full((n, n_b), NEG)
+    ident = np.zeros((n, n_b), dtype=int)
+    length = np.zeros((n, n_b), dtype=int)
+    start = np.zeros((n, n_b), dtype=int)
+    best = np.zeros(n, dtype=int)
+    best_attrs = np.zeros((n, 4), dtype=int)
+    lens = index['lens'][refs][:, None]
+    for i, q in enumerate(query):
+        j = i + diags[:, None] + band
+        valid = (j >= 0) & (j < lens)
+        ref_chars = index['mat'][refs[:, None], np.clip(j, 0, lens - 1)]
+        is_match = (ref_chars == q) & (q < 4)
+        s = np.where(is_match, MATCH, MISMATCH)
+        # diagonal move: same band position in the previous row
+        prev = np.maximum(H, 0)
+        empty = H <= 0
+        diag = prev + s
+        d_ident = np.where(empty, 0, ident) + is_match
+        d_length = np.where(empty, 0, length) + 1
+        d_start = np.where(empty, i, start)
+        # vertical move (query base vs gap): next band position
+        up = np.full((n, n_b), NEG)
+        up[:, :-1] = H[:, 1:] + GAP
+        D = np.maximum(diag, up)
+        take_up = up > diag
+        D_ident = np.where(take_up, np.pad(ident[:, 1:], ((0, 0), (0, 1))),
+                           d_ident)
+        D_length = np.where(take_up, np.pad(length[:, 1:], ((0, 0), (0, 1))),
+                            d_length) + take_up
+        D_start = np.where(take_up, np.pad(start[:, 1:], ((0, 0), (0, 1))),
+                           d_start)
+        D = np.where(valid, D, NEG)
+        # horizontal moves (reference base vs gap) within the row
+        shifted = D - GAP * np.arange(n_b)
+        run_max = np.maximum.accumulate(shifted, axis=1)
+        src = np.maximum.accumulate(
+            np.where(shifted == run_max, np.arange(n_b), 0), axis=1)
+        H = np.where(valid, run_max + GAP * np.arange(n_b), NEG)
+        gaps = np.arange(n_b) - src
+        ident = D_ident[cols, src]
+        length = D_length[cols, src] + gaps
+        start = D_start[cols, src]
+        row_best = H.argmax(1)
+        row_score = H[np.arange(n), row_best]
+        better = row_score > best
+        best = np.where(better, row_score, best)
+        best_attrs[better] = np.stack([
+            ident[better, row_best[better]], length[better, row_best[better]],
+            start[better, row_best[better]], np.full(better.sum(), i)], 1)
+    return best, best_attrs
+
+
+def align_query(query, index, w=16, min_score=56):
+    """Best local alignment of a query against every seeded reference"""
+    hits = {}
+    q_len = len(query)
+    for strand in [query, rev_comp(query)]:
+        codes = encode(strand)
+        refs, diags = get_seeds(codes, index)
+        if not len(refs):
+            continue
+        scores, attrs = banded_align(codes, index, refs, diags, w)
+        for ref, score, (ident, length, q_start, q_end) in zip(
+                refs, scores, attrs):
+            if score < min_score or score <= hits.get(ref, (0,))[0]:
+                continue
+            hits[ref] = (score, 100 * ident / length,
+                         round(100 * (q_end - q_start + 1) / q_len))
+    rows = [[index['ids'][ref], round(pident, 3), get_bitscore(score / 2),
+             float(qcovs)] for ref, (score, pident, qcovs) in hits.items()]
+    return rows
+
+
+def align_queries(mock_seqs, index):
+    rows = []
+    for qseqid, query in mock_seqs.items():
+        rows.extend([[qseqid] + row for row in align_query(query, index)])
+    return rows
+
+
+def kmer_search(mock_seqs, index, n_cores=1):
+    """Search the queries against a reference k-mer index, in-process"""
+    bounds = np.linspace(0, len(mock_seqs), n_cores + 1).astype(int)
+    chunks = [mock_seqs.iloc[s:e] for s, e in zip(bounds, bounds[1:]) if e > s]
+    if len(chunks) > 1:
+        with get_pool(len(chunks)) as pool:
+            rows_split = pool.starmap(
+                align_queries, [(chunk, index) for chunk in chunks])
+    else:
+        rows_split = [align_queries(chunk, index) for chunk in chunks]
+    search_out = pd.DataFrame(
+        [row for rows in rows_split for row in rows], columns=OUT_COLS)
+    return search_out
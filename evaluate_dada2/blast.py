@@ -7,10 +7,21 @@
 # ----------------------------------------------------------------------------
 
 import os
+import glob
+import shutil
+import tempfile
 import pandas as pd
-from qiime2 import Metadata
+from functools import lru_cache
+from os.path import isdir, isfile
 from evaluate_dada2.q2 import spawn_subprocess
-from evaluate_dada2.io import get_fwd_rev
+from evaluate_dada2.trace import span, traced
+from evaluate_dada2.report import get_code_version
+from evaluate_dada2.io import (
+    get_fwd_rev, read_fasta, get_checksum, get_cache_dir, mk_dirs,
+    get_fingerprint, get_keys, read_store, write_store)
+from evaluate_dada2.mock import get_clusters_map
+from evaluate_dada2.align import (
+    OUT_COLS, get_bitscore, rev_comp, get_kmer_index, kmer_search)
 
 
 def get_bests_pd(params_pd, max_pident, max_qcovs, or_=0):
@@ -63,59 +74,251 @@ def get_ref(params_pd):
     return ref, cause
 
 
-def makeblastdb(blast_db):
-    cmd = ['makeblastdb', '-dbtype', 'nucl', '-in', blast_db]
-    spawn_subprocess(cmd)
+@lru_cache()
+def get_blast_version():
+    return spawn_subprocess(['blastn', '-version'])[0].split()[-1]
 
 
-def write_seq_to_blast(seq_out, mock_tab, seq, mocks):
+def makeblastdb(ref_fasta):
+    """Get the BLAST database of a reference FASTA, from the cache where
+    it is keyed by FASTA checksum and BLAST+ version (built if needed)"""
+    key = '%s_%s' % (get_checksum(ref_fasta), get_blast_version())
+    cache_dir = '%s/blastdb' % get_cache_dir()
+    db_dir = '%s/%s' % (cache_dir, key)
+    if not isdir(db_dir):
+        mk_dirs([cache_dir])
+        # build aside and rename, so that other jobs never see partial DBs
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.%s_' % key)
+        cmd = ['makeblastdb', '-dbtype', 'nucl', '-in', ref_fasta,
+               '-out', '%s/db' % tmp_dir]
+        spawn_subprocess(cmd)
+        if not glob.glob('%s/db.n*' % tmp_dir):
+            shutil.rmtree(tmp_dir)
+            raise IOError('makeblastdb failed for "%s"' % ref_fasta)
+        try:
+            os.rename(tmp_dir, db_dir)
+        except OSError:
+            # already built by a concurrent job
+            shutil.rmtree(tmp_dir)
+    return '%s/db' % db_dir
+
+
+def get_mock_seqs(mock_tab, seq, mocks):
+    from qiime2 import Metadata
     mock_tab = mock_tab[mocks]
     mock_seqs_ids = mock_tab[mock_tab[mocks].sum(1) > 0].index
     mock_seqs = seq.view(Metadata).to_dataframe().loc[mock_seqs_ids]
+    return mock_seqs['Sequence'].astype(str).str.upper()
+
+
+def write_seq_to_blast(seq_out, mock_seqs):
     with open(seq_out, "w") as o:
-        for r, row in mock_seqs.iterrows():
-            o.write('>%s\n%s\n' % (r, row["Sequence"]))
-    return mock_seqs_ids
+        for r, s in mock_seqs.items():
+            o.write('>%s\n%s\n' % (r, s))
 
 
 def blastn(seq_out, blast_db):
-    out_cols = ['qseqid', 'sseqid', 'pident', 'bitscore', 'qcovs']
     cmd = ['blastn', '-query', seq_out, '-db', blast_db,
-           '-outfmt', '6 delim=@ %s' % ' '.join(out_cols)]
+           '-outfmt', '6 delim=@ %s' % ' '.join(OUT_COLS)]
     blast_out = pd.DataFrame(
-        [x.split('@') for x in spawn_subprocess(cmd)],
-        columns=out_cols)
+        [x.split('@') for x in spawn_subprocess(cmd) if x],
+        columns=OUT_COLS)
+    blast_out[OUT_COLS[2:]] = blast_out[OUT_COLS[2:]].astype(float)
     return blast_out
 
 
-def run_blasts(dada2, eval_dir, mocks, blast_dbs, blast_in, blast_out):
-    """Perform the BLAST searches"""
-    blast_ins_pds = []
-    blast_outs_pds = []
+def get_exact_index(ref_fasta, k=16):
+    """Index every k-mer position of the reference sequences"""
+    refs = read_fasta(ref_fasta)
+    index = {}
+    for ref, ref_seq in refs.items():
+        for pos in range(len(ref_seq) - k + 1):
+            index.setdefault(ref_seq[pos:pos + k], []).append((ref, pos))
+    return refs, index, k
+
+
+def get_exact_refs(query, exact_index):
+    """Get the references containing the query (either strand)"""
+    refs, index, k = exact_index
+    hits = set()
+    for q in [query, rev_comp(query)]:
+        for ref, pos in index.get(q[:k], []):
+            if refs[ref][pos:pos + len(q)] == q:
+                hits.add(ref)
+    return hits
+
+
+def get_exact_hits(mock_seqs, exact_index):
+    """Resolve the queries that are exact substrings of a reference,
+    returning BLAST-like perfect hits and the sequences left to BLAST"""
+    rows, to_blast = [], []
+    for qseqid, query in mock_seqs.items():
+        hits = []
+        if len(query) >= exact_index[2]:
+            hits = sorted(get_exact_refs(query, exact_index))
+        if not hits:
+            to_blast.append(qseqid)
+            continue
+        bitscore = get_bitscore(len(query))
+        for sseqid in hits:
+            rows.append([qseqid, sseqid, 100., bitscore, 100.])
+    exact_pd = pd.DataFrame(rows, columns=OUT_COLS)
+    return exact_pd, mock_seqs.loc[to_blast]
+
+
+def search_seqs(seq_out, to_blast, ref_fasta, kmer_index, search, n_cores):
+    """Search the sequences with blastn, or with the in-process aligner"""
+    if search == 'kmer':
+        return kmer_search(to_blast, kmer_index, n_cores)
+    write_seq_to_blast(seq_out, to_blast)
+    search_out = blastn(seq_out, makeblastdb(ref_fasta))
+    os.remove(seq_out)
+    return search_out
+
+
+def validate_search(seq_fp, ref_fasta, n_cores=1):
+    """Compare the reference assigned to each query by blastn and by the
+    in-process k-mer aligner (`--p-search kmer`)"""
+    to_blast = pd.Series(read_fasta(seq_fp))
+    searches = {
+        'blastn': blastn(seq_fp, makeblastdb(ref_fasta)),
+        'kmer': kmer_search(to_blast, get_kmer_index(ref_fasta), n_cores)}
+    refs = {}
+    for search, search_out in searches.items():
+        refs[search] = pd.DataFrame(
+            [get_ref(q_pd) for _, q_pd in search_out.groupby('qseqid')],
+            index=sorted(search_out['qseqid'].unique()),
+            columns=['ref', 'cause'])
+    validation = refs['blastn'].join(
+        refs['kmer'], how='outer', lsuffix='_blastn', rsuffix='_kmer')
+    validation['agree'] = validation['ref_blastn'] == validation['ref_kmer']
+    print('Same reference for %s/%s queries' % (
+        validation['agree'].sum(), validation.shape[0]))
+    return validation
+
+
+def derive_hits(search_out, p_map):
+    """Hits against the representatives of a coarser clustering level,
+    from the hits against the finest level: each subject is replaced by
+    its representative, keeping the best hit per query and subject"""
+    p_out = search_out.copy()
+    p_out['sseqid'] = p_out['sseqid'].map(p_map).fillna(p_out['sseqid'])
+    p_out = p_out.sort_values(
+        ['bitscore', 'pident', 'qcovs'], ascending=False
+    ).drop_duplicates(['qseqid', 'sseqid']).sort_index()
+    return p_out
+
+
+def get_blasts_todo(dada2, mocks, blast_dbs, blast_in, search):
+    """Combinations whose mock ASVs were not searched yet, or were searched
+    for other ASVs, against other references, with another backend or with
+    another version of the search code (blast and align modules)"""
+    code = [get_code_version(x) for x in (get_blasts_todo, kmer_search)]
+    refs = get_fingerprint(search, code, *[get_checksum(blast_dbs[p])
+                                           for p in sorted(blast_dbs)])
+    done = {}
+    if isfile(blast_in):
+        blast_ins_pd = read_store(blast_in)
+        if 'fingerprint' in blast_ins_pd.columns:
+            done = dict(zip(get_keys(blast_ins_pd, ['forward', 'reverse']),
+                            blast_ins_pd['fingerprint']))
+    todo = []
     for fr, (tab, seq, _) in dada2.items():
         fwd, rev = get_fwd_rev(fr)
         mock_tab = tab.view(pd.DataFrame).T
         if set(mocks).difference(set(mock_tab.columns)):
             continue
+        mock_seqs = get_mock_seqs(mock_tab, seq, mocks)
+        fingerprint = get_fingerprint(refs, sorted(mock_seqs.items()))
+        if done.get('%s|%s' % (fwd, rev)) != fingerprint:
+            todo.append((fr, fwd, rev, mock_seqs, fingerprint))
+    return todo
+
+
+def merge_blasts(blast_fp, new_pd, combos):
+    """Replace the rows of the searched combinations (keys "f|r") in a
+    stored table, including those of combinations without new rows"""
+    if isfile(blast_fp):
+        old_pd = read_store(blast_fp)
+        old_pd = old_pd[~get_keys(old_pd, ['forward', 'reverse']).isin(
+            set(combos))]
+        new_pd = pd.concat([old_pd, new_pd], ignore_index=True)
+    write_store(new_pd, blast_fp)
+
+
+def merge_streams(stream_dirs, blast_in, blast_out):
+    """Merge the search results of the combinations streamed from the
+    denoising (each stored in its own folder) into the stores, at once"""
+    ins, outs = [], []
+    for stream_dir in stream_dirs:
+        stream_in = '%s/blast_in.tsv' % stream_dir
+        stream_out = '%s/blast_out.tsv' % stream_dir
+        if isfile(stream_in) and isfile(stream_out):
+            ins.append(read_store(stream_in))
+            outs.append(read_store(stream_out))
+    if not ins:
+        return
+    ins_pd = pd.concat(ins, ignore_index=True)
+    combos = get_keys(ins_pd, ['forward', 'reverse'])
+    merge_blasts(blast_out, pd.concat(outs, ignore_index=True), combos)
+    merge_blasts(blast_in, ins_pd, combos)
+    for stream_dir in stream_dirs:
+        for fp in glob.glob('%s/blast_*.tsv' % stream_dir):
+            os.remove(fp)
+
+
+@traced('search')
+def run_blasts(dada2, eval_dir, mocks, ref_seqs, blast_dbs, blast_in,
+               blast_out, search='blastn', n_cores=1):
+    """Perform the BLAST searches (only against the finest clustering
+    level of the references, from which the other levels are derived),
+    for the combinations not searched in a previous run"""
+    todo = get_blasts_todo(dada2, mocks, blast_dbs, blast_in, search)
+    if not todo:
+        return
+    print("Mapping the mock references across clustering levels")
+    finest, clusters_map = get_clusters_map(ref_seqs)
+    print("Running %s for %s combinations" % (search, len(todo)))
+    blast_ins_pds = []
+    blast_outs_pds = []
+    ref_fasta = blast_dbs[finest]
+    exact_index = get_exact_index(ref_fasta)
+    kmer_index = get_kmer_index(ref_fasta) if search == 'kmer' else None
+    for fr, fwd, rev, mock_seqs, fingerprint in todo:
         seq_out = '%s/%s_toblast.fa' % (eval_dir, '-'.join(map(str, fr)))
-        mock_seqs_ids = write_seq_to_blast(seq_out, mock_tab, seq, mocks)
-        blast_ins_pds.append([fwd, rev, len(mock_seqs_ids)])
-        for p, blast_db in blast_dbs.items():
-            blast_out_pd = blastn(seq_out, blast_db)
+        blast_ins_pds.append([fwd, rev, len(mock_seqs), fingerprint])
+        # perfect hits do not need to go through BLAST
+        exact_pd, to_blast = get_exact_hits(mock_seqs, exact_index)
+        search_outs = [exact_pd]
+        if to_blast.size:
+            with span(search, 'task', combo='%s-%s' % (fwd, rev),
+                      queries=to_blast.size):
+                search_outs.append(search_seqs(seq_out, to_blast, ref_fasta,
+                                               kmer_index, search, n_cores))
+        search_out = pd.concat(search_outs, ignore_index=True)
+        for p in blast_dbs:
+            with span('derive_hits', 'task', combo='%s-%s' % (fwd, rev), p=p):
+                blast_out_pd = derive_hits(search_out, clusters_map[p])
             blast_out_pd['forward'] = fwd
             blast_out_pd['reverse'] = rev
             blast_out_pd['perc_identity'] = p
             blast_outs_pds.append(blast_out_pd)
-        os.remove(seq_out)
 
-    blast_outs_pd = pd.concat(blast_outs_pds)
-    blast_outs_pd.to_csv(blast_out, index=False, sep='\t')
+    combos = ['%s|%s' % (fwd, rev) for _, fwd, rev, __, ___ in todo]
+    merge_blasts(blast_out, pd.concat(blast_outs_pds), combos)
+    merge_blasts(blast_in, pd.DataFrame(blast_ins_pds, columns=[
+        'forward', 'reverse', 'nqueries', 'fingerprint']), combos)
+
 
-    blast_ins_pd = pd.DataFrame(
-        blast_ins_pds, columns=['forward', 'reverse', 'nqueries'])
-    blast_ins_pd.to_csv(blast_in, index=False, sep='\t')
+def read_blasts(blast_fp, dada2):
+    """Stored search results of the current combinations"""
+    blast_pd = read_store(blast_fp)
+    combos = set(['%s|%s' % get_fwd_rev(fr) for fr in dada2])
+    blast_pd = blast_pd[get_keys(blast_pd, ['forward', 'reverse']).isin(combos)]
+    return blast_pd
 
 
+@traced()
 def get_hits_pd(blast_out):
     """Parse blast results"""
     hits = []
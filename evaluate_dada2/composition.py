@@ -0,0 +1,139 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+import numpy as np
+import pandas as pd
+from evaluate_dada2.taxonomy import collapse
+from evaluate_dada2.regression import linregress_sums
+
+# metrics of the results that get bootstrap confidence intervals
+CI_METRICS = ['TAR', 'TDR', 'Bray-Curtis', 'Jaccard', 'r-squared']
+
+
+def linregress_rows(x, y, mask):
+    """Least-squares regression of y on x for every row, on the masked
+    columns only (same outputs as scipy.stats.linregress)"""
+    x, y = np.where(mask, x, 0), np.where(mask, y, 0)
+    return linregress_sums(mask.sum(1), x.sum(1), y.sum(1), (x ** 2).sum(1),
+                           (y ** 2).sum(1), (x * y).sum(1))
+
+
+def get_rates(obs, exp):
+    """Observed counts, TAR, TDR, Bray-Curtis and Jaccard for every row"""
+    obs_pos, exp_pos = obs > 0, exp > 0
+    n_obs, n_exp = obs_pos.sum(1), exp_pos.sum(1)
+    tp = (obs_pos & exp_pos).sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tar, tdr = tp / n_obs, tp / n_exp
+        bray_curtis = np.abs(obs - exp).sum(1) / (obs + exp).sum(1)
+        union = n_obs + n_exp - tp
+        jaccard = np.where(union > 0, 1. - tp / union, 0.)
+    return n_obs, n_obs / n_exp, tar, tdr, bray_curtis, jaccard
+
+
+def strip_empty(taxon):
+    """Taxonomy ranks of a lineage, without the empty ranks (e.g. 'g__')"""
+    ranks = [x.strip() for x in taxon.split(';')]
+    return [x for x in ranks if x and not re.match(r'^\w__$', x)]
+
+
+def get_underclassifiable(taxa, exp_taxa):
+    """Whether each taxon is a (less deep) lineage of an expected taxon"""
+    exp_ranks = [strip_empty(x) for x in exp_taxa]
+    underclassifiable = []
+    for taxon in taxa:
+        ranks = strip_empty(taxon)
+        underclassifiable.append(any(
+            len(ranks) < len(x) and x[:len(ranks)] == ranks
+            for x in exp_ranks))
+    return np.array(underclassifiable, dtype=bool)
+
+
+def get_features(values, keep, taxa, sample):
+    """Long table of the kept features of every row"""
+    cells, features = np.nonzero(keep)
+    features_pd = pd.DataFrame({
+        'cell': cells, 'Taxon': taxa[features],
+        sample: values[cells, features]})
+    return features_pd
+
+
+def evaluate_compositions(exp, obs, depth=1, sample='mock', tax_index=None):
+    """Evaluate many observed compositions against one expected composition
+    at once, as `qiime quality-control evaluate-composition` does for one.
+
+    Parameters
+    ----------
+    exp : pd.Series
+        Expected relative abundance of each feature (taxonomy)
+    obs : pd.DataFrame
+        Observed relative abundances: one row per evaluated composition
+        ("cell"), NaN for features not in the table of that composition
+    depth : int
+        Depth of the taxonomy at which to evaluate
+    tax_index : dict
+        Taxonomy index of the features (see `taxonomy.get_tax_index`)
+
+    Returns
+    -------
+    evaluation : dict
+        "results", "false_neg", "misclass" and "underclass" tables, with the
+        row of `obs` in a "cell" column
+    """
+    obs = obs.loc[:, obs.notna().any()]
+    features = exp.index.union(obs.columns)
+    obs = obs.reindex(columns=features)
+    # features of a table are regressed on even if absent from the other
+    mask = obs.notna() | pd.Series(features.isin(exp.index), index=features)
+    obs = obs.fillna(0.)
+    exp = pd.DataFrame([exp.reindex(features).fillna(0.)] * obs.shape[0],
+                       index=obs.index)
+    results = []
+    for level in range(1, depth + 1):
+        obs_l = collapse(obs, level, tax_index)
+        exp_l = collapse(exp, level, tax_index)
+        mask_l = collapse(mask.astype(int), level, tax_index).values > 0
+        obs_v, exp_v = obs_l.values, exp_l.values
+        rates = get_rates(obs_v, exp_v)
+        slope, intercept, r, p, std_err = linregress_rows(exp_v, obs_v, mask_l)
+        results.append(pd.DataFrame({
+            'cell': range(obs.shape[0]), 'sample': sample, 'level': level,
+            'Observed Taxa': rates[0], 'Observed / Expected Taxa': rates[1],
+            'TAR': rates[2], 'TDR': rates[3], 'Slope': slope,
+            'Intercept': intercept, 'r-value': r, 'P value': p,
+            'Std Err': std_err, 'r-squared': r ** 2,
+            'Bray-Curtis': rates[4], 'Jaccard': rates[5]}))
+    # false positives/negatives, at the evaluation depth
+    taxa = obs_l.columns.values
+    obs_pos, exp_pos = obs_v > 0, exp_v > 0
+    false_pos = obs_pos & ~exp_pos
+    under = get_underclassifiable(taxa, taxa[exp_pos[0]])
+    evaluation = {
+        'false_neg': get_features(exp_v, exp_pos & ~obs_pos, taxa, sample),
+        'misclass': get_features(obs_v, false_pos & ~under, taxa, sample),
+        'underclass': get_features(obs_v, false_pos & under, taxa, sample),
+        'results': pd.concat(results, ignore_index=True)}
+    return evaluation
+
+
+def get_resamples(obs, n_reads, n_boot, rng):
+    """Relative abundances of multinomial resamples of the reads of an
+    observed composition (one row per resample)"""
+    probs = obs.values / obs.values.sum()
+    counts = rng.multinomial(n_reads, probs, size=n_boot)
+    return pd.DataFrame(counts / n_reads, columns=obs.index)
+
+
+def get_cis(results, ci=95):
+    """Bounds of the confidence intervals of the metrics of the evaluated
+    resamples, per level"""
+    bounds = {'low': (100 - ci) / 200., 'high': (100 + ci) / 200.}
+    cis = pd.concat({'%s %s' % (m, b): results.groupby('level')[m].quantile(q)
+                     for m in CI_METRICS for b, q in bounds.items()}, axis=1)
+    return cis
@@ -6,65 +6,395 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import time
+import zlib
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 
-from qiime2 import Artifact
-from evaluate_dada2.io import qzv_unzip
+from os.path import isfile
+from contextlib import nullcontext
+from evaluate_dada2.io import (
+    qzv_unzip, print_progress, get_fingerprint, get_keys, read_store,
+    write_store, get_pool)
 from evaluate_dada2.mock import (
-    get_asv_mock_sample, get_tax_mock_sample, get_mock_melt)
+    get_asv_mock_sample, get_tax_mock_sample, get_mock_counts, get_mock_melts)
 from evaluate_dada2.q2 import run_evaluation
 from evaluate_dada2.io import get_fwd_rev
+from evaluate_dada2.composition import (
+    CI_METRICS, evaluate_compositions, get_resamples, get_cis)
+from evaluate_dada2.taxonomy import collapse_features
+from evaluate_dada2.trace import span, traced
+from evaluate_dada2.report import get_code_version
 
-
-def eval_asv(eval_dir, mock_q2s, t, m, p, f, r):
-    ref_q2 = mock_q2s[str(p)][0]
-    sam = get_asv_mock_sample(t)
-    sam_q2 = Artifact.import_data('FeatureTable[RelativeFrequency]', sam.T)
-    evaluation = run_evaluation(ref_q2, sam_q2, 1)
-    evaluation_fp = '%s/asv/clust-%s_%s_%s-%s' % (eval_dir, p, m, f, r)
-    evaluation.visualization.save(evaluation_fp)
-    res = qzv_unzip(eval_dir, evaluation_fp)
-    return res, sam
+# index of the expected table and evaluation depth (None: all ranks)
+LEVELS = {'asv': (0, 1), 'taxo': (1, None)}
+OUTS = ['false_neg', 'misclass', 'underclass', 'results']
+# key of the stored outputs, and of the cells in the melted mock samples
+KEY = ['f', 'r', 'p', 'sam', 'type']
+CELL_MELT = ['forward', 'reverse', 'perc_identity', 'mock']
+# columns of the evaluation outputs (besides the keys) and their dtype
+FEATURES = {'Taxon': object, 'mock': float}
+METRICS = ['Observed Taxa', 'Observed / Expected Taxa', 'TAR', 'TDR', 'Slope',
+           'Intercept', 'r-value', 'P value', 'Std Err', 'r-squared',
+           'Bray-Curtis', 'Jaccard']
+SCHEMA = {'false_neg': FEATURES, 'misclass': FEATURES,
+          'underclass': FEATURES,
+          'results': dict([('sample', object), ('level', float)] +
+                          [(x, float) for x in METRICS] +
+                          [('%s %s' % (x, b), float) for x in CI_METRICS
+                           for b in ['low', 'high']])}
+# missing values per dtype, and dtypes of the built columns (if different)
+NA = {object: None, float: np.nan}
+DTYPES = {'level': 'Int64'}
 
 
-def eval_tax(eval_dir, mock_q2s, sam, m, p, f, r, refs, ranks):
-    ref_q2 = mock_q2s[str(p)][1]
-    tax = get_tax_mock_sample(sam, refs, ranks)
-    tax_q2 = Artifact.import_data('FeatureTable[RelativeFrequency]', tax)
-    evaluation = run_evaluation(ref_q2, tax_q2, 7)
-    evaluation_fp = '%s/taxo/clust-%s_%s_%s-%s' % (eval_dir, p, m, f, r)
+def eval_q2(tmp_dir, exp_pd, obs_pd, depth, evaluation_fp):
+    from qiime2 import Artifact
+    ref_q2 = Artifact.import_data('FeatureTable[RelativeFrequency]', exp_pd)
+    sam_q2 = Artifact.import_data('FeatureTable[RelativeFrequency]', obs_pd)
+    evaluation = run_evaluation(ref_q2, sam_q2, depth)
     evaluation.visualization.save(evaluation_fp)
-    res = qzv_unzip(eval_dir, evaluation_fp)
+    res = qzv_unzip(tmp_dir, evaluation_fp)
     return res
 
 
-def collect(out, res, f, r, p, sam, level):
-    vs = {'f': f, 'r': r, 'p': p, 'sam': sam, 'type': level}
-    for d, dat in res.items():
-        if not dat.shape[0]:
-            dat = pd.DataFrame({'Taxon': ['None'], 'mock': [np.nan]})
-        for k, v in vs.items():
-            dat[k] = v
-        out[d].append(dat)
+def get_exp(mock_tabs, p, level):
+    """Expected composition (the reference table has one mock sample)"""
+    tdx, _ = LEVELS[level]
+    return mock_tabs[str(p)][tdx].iloc[0]
+
+
+class Outputs(object):
+    """Columnar accumulator of the evaluation outputs: the keys of the
+    evaluated cells are interned as categorical codes, the other columns
+    are gathered as typed arrays (see `SCHEMA`), and the frames are built
+    once, with categorical keys"""
+
+    def __init__(self):
+        self.categories = {k: {} for k in KEY}
+        self.columns = {d: {c: [] for c in KEY + list(SCHEMA[d])}
+                        for d in OUTS}
+
+    def intern(self, key, value):
+        value = str(value)
+        return self.categories[key].setdefault(
+            value, len(self.categories[key]))
+
+    def add(self, res, f, r, p, sam, level):
+        """Add the outputs of the evaluation of one cell at one level"""
+        codes = [self.intern(k, v) for k, v in zip(KEY, [f, r, p, sam, level])]
+        for d, dat in res.items():
+            if not dat.shape[0]:
+                dat = pd.DataFrame({'Taxon': ['None'], 'mock': [np.nan]})
+            self.append(d, dat, {k: np.full(dat.shape[0], c, dtype=np.int32)
+                                 for k, c in zip(KEY, codes)})
+
+    def extend(self, outs):
+        """Add the outputs of many cells (built, or read from the store)"""
+        for d, dat in outs.items():
+            codes = {}
+            for k in KEY:
+                values, uniques = pd.factorize(dat[k])
+                interned = [self.intern(k, v) for v in uniques]
+                codes[k] = np.array(interned, dtype=np.int32)[values]
+            self.append(d, dat, codes)
+
+    def append(self, d, dat, codes):
+        for k in KEY:
+            self.columns[d][k].append(codes[k])
+        for col, dtype in SCHEMA[d].items():
+            if col in dat.columns:
+                values = dat[col].to_numpy(dtype=dtype, na_value=NA[dtype])
+            else:
+                values = np.full(dat.shape[0], NA[dtype], dtype=dtype)
+            self.columns[d][col].append(values)
+
+    def build(self):
+        """Outputs tables, with the keys categories in (numeric) order"""
+        categories, remaps = {}, {}
+        for k, interned in self.categories.items():
+            values = list(interned)
+            order = sorted(range(len(values)),
+                           key=lambda x: get_sort_key(values[x]))
+            categories[k] = [values[x] for x in order]
+            remaps[k] = np.argsort(order).astype(np.int32)
+        outs = {}
+        for d, columns in self.columns.items():
+            out = {}
+            for k in KEY:
+                codes = np.concatenate(columns[k] or [np.zeros(0, np.int32)])
+                out[k] = pd.Categorical.from_codes(remaps[k][codes],
+                                                   categories[k])
+            for col, dtype in SCHEMA[d].items():
+                values = np.concatenate(columns[col] or [np.zeros(0, dtype)])
+                out[col] = pd.array(values, dtype=DTYPES.get(col, dtype))
+            outs[d] = pd.DataFrame(out)[list(SCHEMA[d]) + KEY]
+        return outs
+
+
+def get_sort_key(value):
+    try:
+        return 0, float(value), value
+    except ValueError:
+        return 1, 0., value
+
+
+def get_cells(melts, tax_index):
+    """Compositions of the mock samples to evaluate, for every combination,
+    mock sample and perc_identity: as ASVs and as taxonomy"""
+    cells = []
+    gb = ['combo', 'forward', 'reverse', 'mock', 'perc_identity']
+    for (_, f, r, m, p), t in melts.groupby(gb):
+        sam = get_asv_mock_sample(t)
+        tax = get_tax_mock_sample(sam, tax_index)
+        cells.append((f, r, p, m, sam, tax, t['count'].sum()))
+    return cells
+
+
+def bootstrap(res, cell, level, mock_tabs, tax_index, n_boot):
+    """Attach to the results of a cell the confidence intervals of its
+    metrics, evaluated at once on multinomial resamples of its reads"""
+    f, r, p, m, sam, _, n_reads = cell
+    if not res['results'].shape[0]:
+        return
+    tdx, depth = LEVELS[level]
+    seed = zlib.crc32(('%s|%s|%s|%s' % (f, r, p, m)).encode())
+    resamples = get_resamples(sam['mock'], n_reads, n_boot,
+                              np.random.default_rng(seed))
+    if tdx:
+        resamples = collapse_features(resamples, tax_index, 'd__')
+    evaluation = evaluate_compositions(
+        get_exp(mock_tabs, p, level), resamples,
+        depth or len(tax_index['ranks']), tax_index=tax_index)
+    res['results'] = res['results'].merge(
+        get_cis(evaluation['results']), left_on='level', right_index=True,
+        how='left')
+
+
+def evaluate_native(out, cells, mock_tabs, tax_index, n_boot=0):
+    """Evaluate all the cells of each perc_identity at once"""
+    keys = pd.DataFrame([cell[:4] for cell in cells],
+                        columns=['f', 'r', 'p', 'sam'])
+    for level, (tdx, depth) in LEVELS.items():
+        depth = depth or len(tax_index['ranks'])
+        for p, p_keys in keys.groupby('p', sort=False):
+            with span('evaluate', 'task', level=level, p=p,
+                      cells=p_keys.shape[0]):
+                obs = pd.DataFrame([cells[idx][4 + tdx].squeeze(
+                    axis=1 - tdx) for idx in p_keys.index])
+                obs.index = range(obs.shape[0])
+                evaluation = evaluate_compositions(
+                    get_exp(mock_tabs, p, level), obs, depth,
+                    tax_index=tax_index)
+            res_cells = {d: dict(list(dat.drop(columns='cell').groupby(
+                dat['cell']))) for d, dat in evaluation.items()}
+            for cdx, (idx, (f, r, p, m)) in enumerate(zip(
+                    p_keys.index, p_keys.values)):
+                res = {d: dats.get(cdx, pd.DataFrame())
+                       for d, dats in res_cells.items()}
+                if n_boot:
+                    bootstrap(res, cells[idx], level, mock_tabs, tax_index,
+                              n_boot)
+                out.add(res, f, r, p, m, level)
+
+
+def evaluate_q2(out, cells, mock_tabs, tax_index, eval_dir, n_boot=0):
+    """Evaluate the cells one by one using qiime2's evaluate-composition"""
+    tmp_dir = tempfile.mkdtemp(dir=eval_dir, prefix='tmp_')
+    for cell in cells:
+        f, r, p, m, sam, tax, _ = cell
+        for level, (tdx, depth) in LEVELS.items():
+            depth = depth or len(tax_index['ranks'])
+            obs_pd = [sam.T, tax][tdx]
+            exp_pd = mock_tabs[str(p)][tdx]
+            evaluation_fp = '%s/%s/clust-%s_%s_%s-%s' % (
+                eval_dir, level, p, m, f, r)
+            with span('evaluate', 'task', level=level, p=p, cells=1):
+                res = eval_q2(tmp_dir, exp_pd, obs_pd, depth, evaluation_fp)
+            if n_boot:
+                bootstrap(res, cell, level, mock_tabs, tax_index, n_boot)
+            out.add(res, f, r, p, m, level)
+    shutil.rmtree(tmp_dir)
 
 
-def get_outs(dada2, eval_dir, mocks, hits_pd, mock_q2s, refs, ranks):
-    out = {'false_neg': [], 'misclass': [], 'underclass': [], 'results': []}
-    for fdx, (fr, (tab, _, __)) in enumerate(dada2.items()):
+@traced(cat='task')
+def eval_chunk(chunk):
+    """Evaluate the cells of a chunk of combinations (in a worker)"""
+    melts, mock_tabs, tax_index, evaluator, eval_dir, n_boot = chunk
+    out = Outputs()
+    cells = get_cells(melts, tax_index)
+    if evaluator == 'qiime2':
+        evaluate_q2(out, cells, mock_tabs, tax_index, eval_dir, n_boot)
+    else:
+        evaluate_native(out, cells, mock_tabs, tax_index, n_boot)
+    return out.build()
+
+
+def get_melts(dada2, mocks, hits_pd):
+    """Melt the mock samples of all combinations in one pass"""
+    combos = []
+    for fr, (tab, _, __) in dada2.items():
         f, r = get_fwd_rev(fr)
         mock_pd = tab.view(pd.DataFrame).T
         if set(mocks).difference(set(mock_pd.columns)):
             continue
-        mock_pd = mock_pd[sorted(mocks)]
-        print('[%s/%s] for: %s - rev: %s' % (fdx + 1, len(dada2), f, r))
-        mock_melt = get_mock_melt(mock_pd, hits_pd, list(mocks), f, r)
-        for m in mocks:
-            gb_col = ['perc_ident', 'ref', m]
-            for p, t in mock_melt[gb_col].groupby('perc_ident'):
-                res, sam = eval_asv(eval_dir, mock_q2s, t, m, p, f, r)
-                collect(out, res, f, r, p, m, "asv")
-                res = eval_tax(eval_dir, mock_q2s, sam, m, p, f, r, refs, ranks)
-                collect(out, res, f, r, p, m, "taxo")
-    outs = {k: pd.concat(v) for k, v in out.items()}
+        combos.append((f, r, mock_pd[sorted(mocks)]))
+    if not combos:
+        return pd.DataFrame(columns=['combo'] + CELL_MELT + ['ref', 'count'])
+    melts = get_mock_melts(get_mock_counts(combos), hits_pd)
+    return melts
+
+
+def get_fingerprints(melts, mock_tabs, tax_index, evaluator, n_boot=0):
+    """Fingerprint of the inputs of every cell and level: the mock sample
+    composition, the expected tables, the evaluation settings and the code
+    of the evaluation (eval, composition and taxonomy modules)"""
+    code = [get_code_version(x) for x in (
+        get_fingerprints, evaluate_compositions, collapse_features)]
+    settings = {}
+    for p, (asv_pd, tax_pd) in mock_tabs.items():
+        settings[p] = get_fingerprint(
+            code, evaluator, n_boot, tax_index['ranks'],
+            sorted(tax_index['lineages'].items()),
+            asv_pd.to_csv(), tax_pd.to_csv())
+    fingerprints = []
+    melts = melts.sort_values(CELL_MELT + ['ref'])
+    for (f, r, p, m), t in melts.groupby(CELL_MELT, sort=False):
+        composition = list(zip(t['ref'], t['count']))
+        for level in LEVELS:
+            fingerprints.append([f, r, p, m, level, get_fingerprint(
+                settings[str(p)], level, composition)])
+    fingerprints = pd.DataFrame(fingerprints, columns=KEY + ['fingerprint'])
+    return fingerprints
+
+
+def read_outs(outs_dir):
+    """Evaluation outputs and fingerprints stored by the previous runs"""
+    fps = ['%s/%s.tsv' % (outs_dir, x) for x in OUTS + ['fingerprints']]
+    if not all(isfile(fp) for fp in fps):
+        return {}, pd.DataFrame(columns=KEY + ['fingerprint'])
+    stored = {x: read_store(fp) for x, fp in zip(OUTS, fps)}
+    return stored, read_store(fps[-1])
+
+
+def get_stale(fingerprints, stored_fps):
+    """Keys of the cells and levels never evaluated, or whose inputs changed"""
+    stored = dict(zip(get_keys(stored_fps, KEY), stored_fps['fingerprint']))
+    keys = get_keys(fingerprints, KEY)
+    stale = [k for k, fp in zip(keys, fingerprints['fingerprint'])
+             if stored.get(k) != fp]
+    return set(stale)
+
+
+def merge_outs(outs_dir, out, stored, stored_fps, fingerprints, stale):
+    """Replace the stale keys in the stored outputs, and store them"""
+    os.makedirs(outs_dir, exist_ok=True)
+    out.extend({d: dat[~get_keys(dat, KEY).isin(stale)]
+                for d, dat in stored.items()})
+    merged = out.build()
+    for d, dat in merged.items():
+        write_store(dat, '%s/%s.tsv' % (outs_dir, d))
+    stored_fps = stored_fps[~get_keys(stored_fps, KEY).isin(stale)]
+    new_fps = fingerprints[get_keys(fingerprints, KEY).isin(stale)]
+    write_store(pd.concat([stored_fps, new_fps], ignore_index=True),
+                '%s/fingerprints.tsv' % outs_dir)
+    return merged
+
+
+def get_chunks(melts, mock_tabs, tax_index, evaluator, eval_dir, n_chunks,
+               n_boot=0):
+    """Split the combinations to evaluate in chunks for the workers"""
+    chunks = []
+    combos = melts['combo'].unique()
+    if not len(combos):
+        return chunks
+    for combos_chunk in np.array_split(combos, min(n_chunks, len(combos))):
+        chunk_melts = melts[melts['combo'].isin(combos_chunk)]
+        chunks.append((chunk_melts, mock_tabs, tax_index, evaluator, eval_dir,
+                       n_boot))
+    return chunks
+
+
+def validate_evaluation(exp_pd, obs_pd, depth, eval_dir):
+    """Largest absolute difference per results metric between the native
+    evaluation and qiime2's evaluate-composition, for one composition"""
+    evaluation = evaluate_compositions(exp_pd.iloc[0], obs_pd, depth)
+    res = eval_q2(eval_dir, exp_pd, obs_pd, depth, '%s/validation' % eval_dir)
+    metrics = evaluation['results'].drop(columns=['cell', 'sample'])
+    q2_metrics = res['results'].set_index('level').loc[metrics['level']]
+    diffs = (metrics.set_index('level') - q2_metrics[metrics.columns[1:]])
+    diffs = diffs.abs().max()
+    for d in ['false_neg', 'misclass', 'underclass']:
+        diffs[d] = len(set(evaluation[d]['Taxon']) ^ set(res[d]['Taxon']))
+    return diffs
+
+
+@traced('evaluation')
+def get_outs(dada2, eval_dir, mocks, hits_pd, mock_tabs, tax_index,
+             evaluator='native', n_cores=1, n_boot=0, outs_dir=None):
+    """Evaluate the cells that are not in the evaluation store yet (or
+    whose inputs changed) in chunks dispatched to a pool of workers (or
+    in-process, on one core), merge them into the store (by default, in
+    `outs` of the evaluation folder), and return the outputs of the current
+    cells"""
+    outs_dir = outs_dir or '%s/outs' % eval_dir
+    melts = get_melts(dada2, mocks, hits_pd)
+    fingerprints = get_fingerprints(melts, mock_tabs, tax_index, evaluator,
+                                    n_boot)
+    stored, stored_fps = read_outs(outs_dir)
+    stale = get_stale(fingerprints, stored_fps)
+    todo = get_keys(melts, CELL_MELT).isin(
+        set([x.rsplit('|', 1)[0] for x in stale]))
+    chunks = get_chunks(melts[todo], mock_tabs, tax_index, evaluator,
+                        eval_dir, 4 * n_cores, n_boot)
+    print("%s cells and levels to evaluate (%s up to date)" % (
+        len(stale), fingerprints.shape[0] - len(stale)))
+    out = Outputs()
+    start = time.time()
+    with get_pool(n_cores) if n_cores > 1 else nullcontext() as pool:
+        chunk_outs = pool.imap(eval_chunk, chunks) if pool else map(
+            eval_chunk, chunks)
+        for cdx, chunk_out in enumerate(chunk_outs):
+            out.extend(chunk_out)
+            print_progress(cdx + 1, len(chunks), start, 'evaluation chunks')
+    merged = merge_outs(outs_dir, out, stored, stored_fps, fingerprints, stale)
+    current = set(get_keys(fingerprints, KEY))
+    outs = {}
+    for d, dat in merged.items():
+        dat = dat[get_keys(dat, KEY).isin(current)].reset_index(drop=True)
+        for k in KEY:
+            dat[k] = dat[k].cat.remove_unused_categories()
+        outs[d] = dat
     return outs
+
+
+def merge_streams(stream_dirs, outs_dir):
+    """Merge the evaluation outputs of the combinations streamed from the
+    denoising (each stored in its own folder) into the store, at once"""
+    streamed = [read_outs('%s/outs' % x) for x in stream_dirs]
+    streamed = [(outs, fps) for outs, fps in streamed if outs]
+    if not streamed:
+        return
+    out = Outputs()
+    for outs, _ in streamed:
+        out.extend(outs)
+    fingerprints = pd.concat([fps for _, fps in streamed], ignore_index=True)
+    stored, stored_fps = read_outs(outs_dir)
+    merge_outs(outs_dir, out, stored, stored_fps, fingerprints,
+               set(get_keys(fingerprints, KEY)))
+    for stream_dir in stream_dirs:
+        shutil.rmtree('%s/outs' % stream_dir, ignore_errors=True)
+
+
+def load_outs(eval_dir, dada2):
+    """Stored evaluation outputs of the current combinations (when they are
+    up to date)"""
+    stored, _ = read_outs('%s/outs' % eval_dir)
+    combos = set(['%s|%s' % get_fwd_rev(fr) for fr in dada2])
+    out = Outputs()
+    out.extend({d: dat[get_keys(dat, ['f', 'r']).isin(combos)]
+                for d, dat in stored.items()})
+    return out.build()
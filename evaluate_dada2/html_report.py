@@ -0,0 +1,145 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import json
+import shutil
+import pandas as pd
+from evaluate_dada2.io import mk_dirs
+from evaluate_dada2.trace import traced
+from evaluate_dada2.regression import PAGE
+from evaluate_dada2.plots import get_txts, get_classifs_cells
+
+TEMPLATE = '%s/resources/report.html' % os.path.dirname(
+    os.path.abspath(__file__))
+REGRESSION = PAGE + ['comparison', 'variable', 'n_samples', 'n', 'slope',
+                     'intercept', 'r_squared', 'p_value', 'x_min', 'x_max',
+                     'x_mean', 'ssx', 'resid_std', 't_crit']
+
+
+def get_columns(tab, decimals=6):
+    """Columnar encoding of a table for JSON: the strings (and categories)
+    as codes in the list of their categories, the numbers rounded (and NaN
+    as null)"""
+    columns = {}
+    for col in tab.columns:
+        values = tab[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.remove_unused_categories()
+            categories = list(map(str, values.cat.categories))
+            columns[col] = {'codes': values.cat.codes.tolist(),
+                            'categories': categories}
+        elif pd.api.types.is_bool_dtype(values) or not \
+                pd.api.types.is_numeric_dtype(values):
+            codes, categories = pd.factorize(values.astype(str), sort=True)
+            columns[col] = {'codes': codes.tolist(),
+                            'categories': list(categories)}
+        else:
+            values = values.astype(float).round(decimals)
+            columns[col] = values.astype(object).where(
+                values.notna(), None).tolist()
+    return columns
+
+
+def get_outputs_data(meta, stats_pd):
+    """Mean and standard deviation of the DADA2 stats of each combination,
+    for all the samples, or for the control and the other samples"""
+    names = [x for x in stats_pd.columns if x.startswith('percentage of')]
+    stats = stats_pd.set_index('sample-id')[['forward', 'reverse'] + names]
+    groups = {'samples': list(meta.sample_name)}
+    if 'is_control' in meta and meta['is_control'].nunique() > 1:
+        groups = {'control samples==%s' % c: list(c_pd.sample_name)
+                  for c, c_pd in meta.groupby('is_control')}
+    outputs = []
+    for group, sams in groups.items():
+        sams_stats = stats[stats.index.isin(sams)].melt(
+            id_vars=['forward', 'reverse'], var_name='name')
+        sams_stats['value'] = sams_stats['value'].astype(float)
+        group_pd = sams_stats.groupby(['name', 'forward', 'reverse'])[
+            'value'].agg(['mean', 'std']).reset_index()
+        group_pd['samples'] = '%s (n=%s)' % (group, len(sams))
+        outputs.append(group_pd)
+    return pd.concat(outputs, ignore_index=True)
+
+
+def get_blast_data(blast_in_pd):
+    """Number of ASVs in the trimmed mock sample of each combination"""
+    return blast_in_pd.groupby(['forward', 'reverse'])['nqueries'].mean(
+        ).reset_index()
+
+
+def get_classifs_data(outs):
+    """Cells of the three classification tables, stacked"""
+    classifs = []
+    for typ in ['misclass', 'underclass', 'false_neg']:
+        cells = get_classifs_cells(outs[typ]).reset_index()
+        classifs.append(cells.assign(table=typ))
+    return pd.concat(classifs, ignore_index=True)
+
+
+def get_regressions_data(regressions_pd):
+    """What the browser needs to draw the regression lines and bands"""
+    return regressions_pd[REGRESSION]
+
+
+def get_points_data(plots_pd):
+    """Abundances of the mock features in the samples (non-zero only: the
+    browser fills the zeros)"""
+    return plots_pd[PAGE + ['feature', 'sample_name', 'value']]
+
+
+def get_pages_data(plots_pd):
+    """Percent of the samples sharing no mock feature, for each page"""
+    return plots_pd.groupby(PAGE)['perc_empty_samples'].first().reset_index()
+
+
+def get_labels_data(sams_labels):
+    """Label of each sample for every comparison"""
+    return {' & '.join(combi): combi_labels
+            for combi, combi_labels in sams_labels.items()}
+
+
+def get_results_data(outs):
+    """Evaluation metrics (and their confidence intervals, if any)"""
+    results = outs['results'].drop(columns='sample')
+    return results.dropna(axis=1, how='all')
+
+
+class HtmlReport(object):
+    """Interactive HTML report: the data of the views are written once, as
+    compact (columnar) JSON in `data.js`, next to a static page that draws
+    the view selected in the browser (no server needed). The data are only
+    prepared (by a function and its arguments) if there is a report folder
+    """
+
+    def __init__(self, html_dir):
+        self.html_dir = html_dir
+        self.data = {'txts': get_txts(), 'tables': {}}
+
+    def add(self, name, get_data, *args):
+        if self.html_dir is None:
+            return
+        data = get_data(*args)
+        if isinstance(data, pd.DataFrame):
+            self.data['tables'][name] = get_columns(data)
+        else:
+            self.data[name] = data
+
+    @traced('html_report')
+    def close(self):
+        if self.html_dir is None:
+            return
+        mk_dirs([self.html_dir])
+        data_fp = '%s/data.js' % self.html_dir
+        with open('%s.tmp' % data_fp, 'w') as o:
+            o.write('var REPORT = ')
+            json.dump(self.data, o, separators=(',', ':'))
+            o.write(';\n')
+        os.replace('%s.tmp' % data_fp, data_fp)
+        shutil.copyfile(TEMPLATE, '%s/index.html' % self.html_dir)
+        print('--> Written: %s/index.html' % self.html_dir)
@@ -8,10 +8,14 @@
 
 import os
 import glob
+import time
 import shutil
+import hashlib
 import zipfile
+import multiprocessing
 import pandas as pd
 from os.path import isdir, isfile
+from evaluate_dada2.trace import traced
 
 
 def get_fors_revs(
@@ -37,20 +41,29 @@ def get_fors_revs(
     return forwards, reverses
 
 
+def get_pool(n_workers):
+    """Pool of workers started in fresh interpreters: the stages of the
+    pipeline run in threads, and a process forked while another thread
+    holds a lock (e.g. of an import, or in a qiime2 action) can deadlock"""
+    return multiprocessing.get_context('spawn').Pool(n_workers)
+
+
 def mk_dirs(to_create):
     for d in to_create:
         if not isdir(d):
             os.makedirs(d)
 
 
-def define_dirs(base_dir):
+def define_dirs(base_dir, out_dir=None):
     # fastq directory with the samples we are using
     to_create = []
     trimmed_dir = "%s/01_trimmed" % base_dir
-    denoized_dir = "%s/02_denoized" % base_dir
+    # outputs in the input folder, or in that of a shard
+    out_dir = out_dir or base_dir
+    denoized_dir = "%s/02_denoized" % out_dir
     to_create.append(denoized_dir)
 
-    eval_dir = "%s/03_evaluated" % base_dir
+    eval_dir = "%s/03_evaluated" % out_dir
     for subdir in ['asv', 'taxo']:
         to_create.append('%s/%s' % (eval_dir, subdir))
 
@@ -94,6 +107,7 @@ def get_metadata(metadata, mock_ref_dir):
     return meta, mock_sams
 
 
+@traced()
 def get_fastqs(meta, trimmed_dir):
     fastqs = {}
     for sample_name in meta['sample_name']:
@@ -107,6 +121,7 @@ def get_fastqs(meta, trimmed_dir):
     return fastqs
 
 
+@traced()
 def get_trimmed_seqs(fastqs, denoized_dir, reverses):
     manifest = '%s/MANIFEST' % denoized_dir
     if reverses:
@@ -125,6 +140,70 @@ def get_trimmed_seqs(fastqs, denoized_dir, reverses):
     return manifest
 
 
+def read_fasta(fasta_fp):
+    seqs = {}
+    with open(fasta_fp) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                seqs[name] = []
+            elif line:
+                seqs[name].append(line.upper())
+    seqs = {name: ''.join(seq) for name, seq in seqs.items()}
+    return seqs
+
+
+def get_checksum(fp):
+    md5 = hashlib.md5()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_fingerprint(*items):
+    """Checksum of the string representation of the items"""
+    md5 = hashlib.md5()
+    for item in items:
+        md5.update(str(item).encode())
+    return md5.hexdigest()
+
+
+def get_keys(tab, cols):
+    """Key of each row of a table, on the string of its `cols` values"""
+    keys = tab[cols[0]].astype(str)
+    for col in cols[1:]:
+        keys = keys + '|' + tab[col].astype(str)
+    return keys
+
+
+def read_store(fp):
+    """Read a table persisted across runs (keeping the 'None' reverse, and
+    the floats as written)"""
+    return pd.read_table(fp, keep_default_na=False, na_values=[''],
+                         float_precision='round_trip')
+
+
+def write_store(tab, fp):
+    """Write a table persisted across runs (atomically)"""
+    tab.to_csv('%s.tmp' % fp, index=False, sep='\t')
+    os.replace('%s.tmp' % fp, fp)
+
+
+def get_cache_dir():
+    cache_dir = os.environ.get('EVALUATE_DADA2_CACHE', os.path.join(
+        os.path.expanduser('~'), '.cache', 'evaluate_dada2'))
+    return cache_dir
+
+
+def print_progress(done, total, start, what):
+    elapsed = time.time() - start
+    eta = elapsed * (total - done) / done
+    print('[%s/%s] %s (elapsed: %ss, ETA: %ss)' % (
+        done, total, what, round(elapsed), round(eta)))
+
+
 def get_fwd_rev(fr):
     fwd, rev = fr[0], 'None'
     if len(fr) == 2:
@@ -9,23 +9,45 @@
 import glob
 import itertools
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from os.path import dirname
-from qiime2 import Artifact
-from qiime2.plugins.vsearch.pipelines import cluster_features_open_reference
-from qiime2.plugins.feature_table.methods import relative_frequency
-from evaluate_dada2.blast import makeblastdb
+from evaluate_dada2.io import read_fasta, get_fwd_rev
+from evaluate_dada2.trace import span, traced
+from evaluate_dada2.align import get_kmer_index, align_query
+from evaluate_dada2.taxonomy import collapse_features
 
 
-def get_plot_pd(meta_combis, meta, mock_sam, tab_mock, value_name):
+def get_meta_combis(meta_cols, max_depth=0):
+    """Combinations of metadata variables, up to `max_depth` variables
+    (all combinations if 0)"""
+    depth = min(max_depth or len(meta_cols), len(meta_cols))
+    meta_combis = [it for n in range(depth)
+                   for it in itertools.combinations(meta_cols, n + 1)]
+    return meta_combis
+
+
+def get_sams_labels(meta, meta_combis):
+    """Label of each sample for every combination of metadata variables"""
+    meta = meta.drop_duplicates('sample_name').set_index('sample_name')
+    sams_labels = {}
+    for meta_combi in meta_combis:
+        sams_labels[meta_combi] = meta[list(meta_combi)].astype(str).agg(
+            '_'.join, axis=1).to_dict()
+    return sams_labels
+
+
+def get_plot_pd(page_pd, mock_sam, meta_combis, sams_labels, value_name):
+    """Melt the relative abundances of the mock features in the samples,
+    for one page of regressions (i.e., on demand)"""
+    tab_mock = page_pd.pivot_table(
+        index='feature', columns='sample_name', values='value', fill_value=0)
     plot_pds = []
-    for cdx, meta_combi in enumerate(meta_combis):
-        sams_d = meta.groupby('sample_name').apply(lambda x: '_'.join(
-            map(str, x[list(meta_combi)].values[0]))).to_dict()
+    for meta_combi in meta_combis:
+        sams_d = dict(sams_labels[meta_combi])
         sams_d[mock_sam] = 'mock (% reads)'
         combi_pd = tab_mock.copy()
-        combi_pd = combi_pd.loc[:, combi_pd.sum() > 0]
-        combi_pd = combi_pd / combi_pd.sum()
         combi_pd.columns = [sams_d.get(x, x) for x in combi_pd.columns]
         combi_ml = combi_pd.melt(
             id_vars=['mock (% reads)'],
@@ -38,27 +60,115 @@ def get_plot_pd(meta_combis, meta, mock_sam, tab_mock, value_name):
     return plot_pd
 
 
-def get_clusters(ref_seqs, seq, tab):
+def get_union(dada2):
+    """Pool the unique ASVs of all combinations (hashed IDs are shared):
+    their sequences, and a table where each ASV is its own sample with
+    its total abundance across combinations"""
+    import biom
+    from qiime2 import Artifact
+    from qiime2.plugins.feature_table.methods import merge_seqs
+    seqs = merge_seqs(data=[seq for _, seq, __ in dada2.values()])
+    tabs = {fr: tab.view(pd.DataFrame) for fr, (tab, _, __) in dada2.items()}
+    totals = pd.concat([tab.sum() for tab in tabs.values()], axis=1).sum(1)
+    totals = totals.round().astype(int)
+    union = biom.Table(sp.diags(totals.values).tocsr(),
+                       observation_ids=list(totals.index),
+                       sample_ids=list(totals.index))
+    union_tab = Artifact.import_data('FeatureTable[Frequency]', union)
+    return union_tab, seqs.merged_data, tabs
+
+
+def get_clusters(ref_seqs, union_tab, union_seqs, n_cores):
+    """Closed-reference cluster the pooled ASVs once per perc_identity: the
+    ASV -> reference mapping as a sparse (ASVs x references) matrix, and
+    the sequences of the ASVs that matched no reference"""
+    from qiime2.plugins.vsearch.methods import (
+        cluster_features_closed_reference)
     clusters = {}
     for p, (_, __, ref_seq) in ref_seqs.items():
         print('Clustering vs DB version p="%s"' % p)
-        open_table, open_seqs, _ = cluster_features_open_reference(
-            sequences=seq, table=tab, reference_sequences=ref_seq,
-            perc_identity=float(p), threads=1)
-        print('Turning to relative frequencies')
-        clusters[p] = relative_frequency(open_table)
+        with span('cluster', 'task', p=p):
+            closed_table, _, unmatched = cluster_features_closed_reference(
+                sequences=union_seqs, table=union_tab,
+                reference_sequences=ref_seq, perc_identity=float(p),
+                threads=n_cores)
+        closed_pd = closed_table.view(pd.DataFrame)
+        asvs, refs = np.nonzero(closed_pd.values)
+        mapping = sp.csr_matrix((np.ones(len(asvs)), (asvs, refs)),
+                                shape=closed_pd.shape)
+        clusters[p] = (closed_pd.index, closed_pd.columns, mapping,
+                       unmatched.view(pd.Series))
     return clusters
 
 
-def get_mock_refs(ref_seqs, refs, ranks):
-    """Make BLAST databases from the mock references"""
+def get_denovo(tab, unmatched, p, n_cores):
+    """De novo cluster the ASVs of a combination that matched no reference,
+    on the abundances of that combination (as open-reference clustering
+    does for each combination)"""
+    from qiime2 import Artifact
+    from qiime2.plugins.vsearch.methods import cluster_features_de_novo
+    ids = [x for x in tab.columns if x in unmatched.index]
+    if not ids:
+        return None
+    tab = tab[ids].loc[tab[ids].sum(1) > 0]
+    denovo_table, _ = cluster_features_de_novo(
+        sequences=Artifact.import_data('FeatureData[Sequence]',
+                                       unmatched[ids]),
+        table=Artifact.import_data('FeatureTable[Frequency]', tab),
+        perc_identity=float(p), threads=n_cores)
+    return denovo_table.view(pd.DataFrame)
+
+
+def project_clusters(tab, cluster, denovo=None):
+    """Relative frequencies of the clusters in the samples of a table: the
+    references its ASVs matched, and its de novo clusters"""
+    asvs, refs, mapping, _ = cluster
+    closed = tab.reindex(columns=asvs, fill_value=0)
+    clust = (mapping.T @ closed.values.T).T
+    clust_pd = pd.DataFrame(clust, index=tab.index, columns=refs)
+    if denovo is not None:
+        clust_pd = pd.concat([clust_pd, denovo.reindex(
+            index=tab.index, fill_value=0)], axis=1)
+    clust_pd = clust_pd.loc[:, clust_pd.sum() > 0]
+    clust_pd = clust_pd.div(clust_pd.sum(1), axis=0)
+    return clust_pd.T
+
+
+def get_mock_refs(ref_seqs, tax_index):
+    """Get the mock references FASTA (BLAST databases are only built from
+    these, and cached, when a search needs them) and expected tables"""
     blast_dbs = {}
-    mock_q2s = {}
+    mock_tabs = {}
     for p, (ref_seq_fp, ref_table_fp, ref_seq) in ref_seqs.items():
-        makeblastdb(ref_seq_fp)
         blast_dbs[p] = ref_seq_fp
-        mock_q2s[p] = get_db_q2(ref_table_fp, refs, ranks)
-    return blast_dbs, mock_q2s
+        mock_tabs[p] = get_db_tabs(ref_table_fp, tax_index)
+    return blast_dbs, mock_tabs
+
+
+def get_clusters_map(ref_seqs):
+    """Map each sequence of the finest reference clustering level to its
+    cluster representative at every other level (the representative it
+    aligns best to, even below the alignment score threshold, or itself if
+    it is one)"""
+    finest = max(ref_seqs, key=float)
+    seqs = read_fasta(ref_seqs[finest][0])
+    clusters_map = {}
+    for p, (ref_seq_fp, _, __) in ref_seqs.items():
+        reps = read_fasta(ref_seq_fp)
+        index = get_kmer_index(ref_seq_fp)
+        p_map = {}
+        for ref, seq in seqs.items():
+            if ref in reps:
+                p_map[ref] = ref
+                continue
+            hits = align_query(seq, index) or align_query(seq, index,
+                                                          min_score=0)
+            if not hits:
+                raise ValueError('Reference "%s" aligns to no representative '
+                                 'of the clustering level "%s"' % (ref, p))
+            p_map[ref] = max(hits, key=lambda x: (x[2], x[1]))[0]
+        clusters_map[p] = p_map
+    return finest, clusters_map
 
 
 def get_tab_mock(tab_clust, mock_sam, mock_sams):
@@ -69,15 +179,17 @@ def get_tab_mock(tab_clust, mock_sam, mock_sams):
     return tab_mock
 
 
-def get_lmplots(plots_pds, relab, mocks, meta, meta_cols, f, r, p):
-    val = 'sample (% reads)'
-    tab_clust = relab.relative_frequency_table.view(pd.DataFrame).T
-    meta_combis = [it for n in range(len(meta_cols))
-                   for it in itertools.combinations(meta_cols, n + 1)]
+def get_lmplots(plots_pds, tab_clust, mocks, f, r, p):
+    """Keep the (non-zero) relative abundances of each mock's features in
+    all the samples: the regressions data is only melted per page"""
     for mock in mocks:
         tab_mock = get_tab_mock(tab_clust, mock, mocks)
         empties = 100 * ((tab_mock.sum() == 0).sum() / tab_mock.shape[1])
-        plots_pd = get_plot_pd(meta_combis, meta, mock, tab_mock, val)
+        tab_mock = tab_mock.loc[:, tab_mock.sum() > 0]
+        tab_mock = tab_mock / tab_mock.sum()
+        plots_pd = tab_mock.rename_axis(
+            index='feature', columns='sample_name').stack()
+        plots_pd = plots_pd[plots_pd > 0].rename('value').reset_index()
         plots_pd['mock_sample'] = mock
         plots_pd['forward'] = f
         plots_pd['reverse'] = r
@@ -86,75 +198,79 @@ def get_lmplots(plots_pds, relab, mocks, meta, meta_cols, f, r, p):
         plots_pds.append(plots_pd)
 
 
-def open_ref(dada2, ref_seqs, mocks, meta, meta_cols):
+@traced()
+def open_ref(dada2, ref_seqs, mocks, n_cores=1):
     """
     Perform open-reference clustering of the mock sample ASVs onto the reference mock sequences
     For the three different `perc_identity` at which the reference mock sequences do cluster
+    The ASVs of all combinations are closed-reference clustered once, and
+    those matching no reference are de novo clustered per combination
     """
+    union_tab, union_seqs, tabs = get_union(dada2)
+    clusters = get_clusters(ref_seqs, union_tab, union_seqs, n_cores)
     plots_pds = []
-    for (f, r), (tab, seq, _) in dada2.items():
-        clusters = get_clusters(ref_seqs, seq, tab)
-        for p, relab in clusters.items():
-            get_lmplots(plots_pds, relab, mocks, meta, meta_cols, f, r, p)
+    for fr, tab in tabs.items():
+        f, r = get_fwd_rev(fr)
+        for p, cluster in clusters.items():
+            with span('cluster_denovo', 'task', p=p, combo='%s-%s' % (f, r)):
+                denovo = get_denovo(tab, cluster[3], p, n_cores)
+            tab_clust = project_clusters(tab, cluster, denovo)
+            get_lmplots(plots_pds, tab_clust, mocks, f, r, p)
     plots_pd = pd.concat(plots_pds)
     return plots_pd
 
 
-def get_db_q2(table_fp, refs, ranks):
+def get_db_tabs(table_fp, tax_index):
     tab = pd.read_table(table_fp)
-    asv_q2 = Artifact.import_data(
-        'FeatureTable[RelativeFrequency]',
-        tab.set_index('featureid').T)
-    tab['featureid'] = [refs.get(x, 'd__Eukaryota') for x in tab['featureid']]
-    tab['featureid'] = ['%s; %s' % (x, '; '.join([
-        '%s__' % r for r in ranks[ranks.index(x.split('; ')[-1][0]) + 1:]]
-    )) for x in tab['featureid']]
-    tab = tab.groupby('featureid').sum()
-    tax_q2 = Artifact.import_data('FeatureTable[RelativeFrequency]', tab.T)
-    return asv_q2, tax_q2
-
-
-def get_mock_melt(mock_sams_pd, hits_pd, sams, f, r):
-    fr_pd = hits_pd[
-        (hits_pd['forward'] == f) &
-        (hits_pd['reverse'] == r)]
-    fr_us = fr_pd.drop(
-        columns=['forward', 'reverse', 'cause']
-    ).set_index(
-        ['perc_identity', 'seq']
-    ).unstack().T
-    fr_us.index = fr_us.index.droplevel()
-    fr_mock_pd = pd.concat([fr_us, mock_sams_pd], axis=1)
-    fr_mock_pd[sams] = fr_mock_pd[sams].fillna(0.)
-    fr_mock_pd = fr_mock_pd.apply(lambda x: x.fillna(x.index.to_series()))
-    mock_melt = fr_mock_pd.melt(
-        id_vars=sams, value_name='ref', var_name='perc_ident'
-    ).groupby(
-        ['perc_ident', 'ref']
-    ).sum().reset_index()
-    return mock_melt
+    asv_pd = tab.set_index('featureid').T
+    tax_pd = collapse_features(asv_pd, tax_index, 'd__Eukaryota')
+    return asv_pd, tax_pd
+
+
+def get_mock_counts(combos):
+    """Stack the mock samples counts of all the combinations"""
+    counts = []
+    for cdx, (f, r, mock_pd) in enumerate(combos):
+        count = mock_pd.rename_axis(index='seq', columns='mock').stack()
+        count = count.rename('count').reset_index()
+        count['combo'], count['forward'], count['reverse'] = cdx, f, r
+        counts.append(count)
+    counts = pd.concat(counts, ignore_index=True)
+    return counts
+
+
+def get_mock_melts(counts, hits_pd):
+    """Sum the mock samples counts per reference hit by the ASVs (ASVs
+    without hit stand as their own reference), for every combination and
+    perc_identity at once"""
+    keys = ['forward', 'reverse']
+    levels = hits_pd[keys + ['perc_identity']].drop_duplicates()
+    melts = counts.merge(levels, on=keys).merge(
+        hits_pd[keys + ['perc_identity', 'seq', 'ref']],
+        on=keys + ['perc_identity', 'seq'], how='left')
+    melts['ref'] = melts['ref'].fillna(melts['seq'])
+    melts = melts.groupby(
+        ['combo'] + keys + ['mock', 'perc_identity', 'ref']
+    )['count'].sum().reset_index()
+    return melts
 
 
 def get_asv_mock_sample(t):
-    sam = t.drop(columns='perc_ident')
-    sam = sam.set_index('ref')
+    sam = t.set_index('ref')[['count']]
     sam.index.name = 'featureid'
     sam.columns = ['mock']
     sam = sam / sam.sum()
     return sam
 
 
-def get_tax_mock_sample(sam, refs, ranks):
-    sam.index = [refs.get(x, 'd__') for x in sam.index]
-    sam.index = ['%s; %s' % (x, '; '.join(
-        ['%s__' % r for r in ranks[ranks.index(x.split('; ')[-1][0]) + 1:]]
-    )) for x in sam.index]
-    tax = sam.groupby(level=0).sum().T
+def get_tax_mock_sample(sam, tax_index):
+    tax = collapse_features(sam.T, tax_index, 'd__')
     return tax
 
 
 def get_ref_seqs(mock_ref_dir):
     """Get the reference mock community sequences and taxonomy"""
+    from qiime2 import Artifact
     ref_seqs = {}
     ref_clust_fps = glob.glob('%s/clustering/*/sequences.fasta' % mock_ref_dir)
     for ref_clust_fp in ref_clust_fps:
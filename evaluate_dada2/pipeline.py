@@ -0,0 +1,221 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import threading
+import pandas as pd
+from os.path import isfile
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from evaluate_dada2.io import (
+    get_checksum, get_fingerprint, read_store, write_store)
+from evaluate_dada2.report import get_code_version
+from evaluate_dada2.trace import span
+
+
+def no_values(values):
+    return {}
+
+
+class Stage(object):
+    """Step of the pipeline: `run` computes the values of the stage (dict)
+    from the configuration and the values of the stages it depends on, and
+    writes its output files, from which `load` restores its values when the
+    stage is up to date. The inputs of a stage are its parameters, the code
+    of the package functions it calls, its input files, and the outputs of
+    the stages it depends on. A stage without output files (cheap to run)
+    is only run if selected, or when its values are needed. `cores` is the
+    number of cores the stage uses (e.g. its pool of workers)"""
+
+    def __init__(self, name, run, deps=(), outputs=(), load=no_values,
+                 files=(), params=(), code=(), cores=1):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+        self.load = load
+        self.files = list(files)
+        self.params = params
+        self.code = list(code)
+        self.cores = cores
+
+
+class Pipeline(object):
+    """DAG of stages (added after the stages they depend on). Each stage is
+    fingerprinted on the content of its inputs, and the fingerprints and
+    outputs checksums of the stages that ran are stored: a stage is run if
+    it is selected and its fingerprint changed or its outputs are missing
+    or were modified, and its values are otherwise loaded only if another
+    stage needs them. A stage whose outputs did not change (e.g. rerun with
+    new code giving the same results) does not make its dependents stale.
+    Independent stages run concurrently (in threads: the stages run their
+    heavy work in pools of workers, or in subprocesses), within a budget of
+    `n_cores` cores shared by the stages running at once"""
+
+    def __init__(self, config, store_fp, n_cores=1):
+        self.config = config
+        self.store_fp = store_fp
+        self.n_cores = n_cores
+        self.free = n_cores
+        self.budget = threading.Condition()
+        self.stages = {}
+        self.values = {}
+        self.locks = {}
+        self.stored = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage):
+        unknown = [x for x in stage.deps if x not in self.stages]
+        if unknown:
+            raise ValueError('Stage "%s" depends on unknown stage(s): %s' % (
+                stage.name, ', '.join(unknown)))
+        self.stages[stage.name] = stage
+        self.locks[stage.name] = threading.Lock()
+
+    def get_upstream(self, names):
+        upstream = set()
+        for name in reversed(list(self.stages)):
+            if name in names or name in upstream:
+                upstream.update(self.stages[name].deps)
+        return upstream
+
+    def get_downstream(self, name):
+        downstream = set([name])
+        for stage in self.stages.values():
+            if downstream.intersection(stage.deps):
+                downstream.add(stage.name)
+        return downstream
+
+    def select(self, only=(), start=None):
+        """Stages forced to run, stages to run if stale, and stages whose
+        values may be needed: the `only` stages (the others are loaded from
+        their outputs, even if stale), or the `start` stage and all its
+        dependents, or all the stages (run if stale)"""
+        unknown = [x for x in list(only) + [start] if x and x not in
+                   self.stages]
+        if unknown:
+            raise ValueError('Unknown stage(s): %s (stages: %s)' % (
+                ', '.join(unknown), ', '.join(self.stages)))
+        if only:
+            forced = set(only)
+        elif start:
+            forced = self.get_downstream(start)
+        else:
+            forced = set()
+        targets = forced or set(self.stages)
+        return forced, targets, targets | self.get_upstream(targets)
+
+    def read(self):
+        if not isfile(self.store_fp):
+            return {}
+        stored = read_store(self.store_fp)
+        return {stage: (fingerprint, checksum) for stage, fingerprint, checksum
+                in stored[['stage', 'fingerprint', 'checksum']].values}
+
+    def save(self, name, fingerprint, checksum):
+        with self.lock:
+            self.stored[name] = (fingerprint, checksum)
+            write_store(pd.DataFrame(
+                [[x, y, z] for x, (y, z) in self.stored.items()],
+                columns=['stage', 'fingerprint', 'checksum']), self.store_fp)
+
+    def get_fingerprint(self, stage, deps_checksums):
+        return get_fingerprint(
+            stage.name, stage.params, deps_checksums,
+            [get_code_version(func) for func in stage.code],
+            [(fp, get_checksum(fp)) for fp in stage.files])
+
+    def get_checksum(self, stage):
+        """Checksum of the outputs of a stage (None if any is missing)"""
+        if not all(isfile(fp) for fp in stage.outputs):
+            return None
+        return get_fingerprint(*[get_checksum(fp) for fp in stage.outputs])
+
+    def get_inputs(self, stage, fingerprint=None):
+        inputs = dict(self.config, fingerprint=fingerprint)
+        for dep in stage.deps:
+            inputs.update(self.get_values(dep))
+        return inputs
+
+    def get_values(self, name):
+        """Values of a stage: computed, loaded from its outputs, or (for a
+        stage without outputs) computed on demand"""
+        stage = self.stages[name]
+        with self.locks[name]:
+            if name not in self.values:
+                inputs = self.get_inputs(stage)
+                if stage.outputs:
+                    print('[%s] Loading the outputs' % name)
+                    self.values[name] = stage.load(inputs)
+                else:
+                    self.execute(stage, inputs)
+        return self.values[name]
+
+    @contextmanager
+    def reserve(self, cores):
+        """Take cores from the budget for the duration of a stage, once the
+        stages running at once have freed enough of them"""
+        cores = min(cores, self.n_cores)
+        with self.budget:
+            self.budget.wait_for(lambda: self.free >= cores)
+            self.free -= cores
+        try:
+            yield
+        finally:
+            with self.budget:
+                self.free += cores
+                self.budget.notify_all()
+
+    def execute(self, stage, inputs):
+        with self.reserve(stage.cores), span(stage.name, 'pipeline'):
+            self.values[stage.name] = stage.run(inputs)
+
+    def process(self, stage, deps, forced, targets, needed, only):
+        """Run a stage if it must, once the stages it depends on are done,
+        and return the checksum of its outputs"""
+        deps_checksums = [dep.result() for dep in deps]
+        if stage.name not in needed:
+            return None
+        fingerprint = self.get_fingerprint(stage, deps_checksums)
+        if not stage.outputs:
+            if stage.name in targets:
+                with self.locks[stage.name]:
+                    self.execute(stage, self.get_inputs(stage, fingerprint))
+            return fingerprint
+        checksum = self.get_checksum(stage)
+        up_to_date = checksum is not None and self.stored.get(
+            stage.name) == (fingerprint, checksum)
+        if stage.name in forced or (not up_to_date and stage.name in targets):
+            print('[%s] Running' % stage.name)
+        elif up_to_date or (only and checksum is not None):
+            if not up_to_date:
+                print('[%s] Outdated, but not selected' % stage.name)
+            else:
+                print('[%s] Up to date' % stage.name)
+            return checksum
+        else:
+            print('[%s] Running (needed by the selected stages)' % stage.name)
+        with self.locks[stage.name]:
+            self.execute(stage, self.get_inputs(stage, fingerprint))
+        checksum = self.get_checksum(stage)
+        self.save(stage.name, fingerprint, checksum)
+        return checksum
+
+    def run(self, only=(), start=None):
+        """Run the selected stages (see `select`), each as soon as the
+        stages it depends on are done"""
+        forced, targets, needed = self.select(only, start)
+        self.stored = self.read()
+        with ThreadPoolExecutor(len(self.stages) or 1) as executor:
+            futures = {}
+            for name, stage in self.stages.items():
+                futures[name] = executor.submit(
+                    self.process, stage, [futures[x] for x in stage.deps],
+                    forced, targets, needed, only)
+            for future in futures.values():
+                future.result()
+        return self.values
@@ -7,74 +7,171 @@
 # ----------------------------------------------------------------------------
 
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-
-def plot_regressions(plots_pd, pdf):
-    for (f, r, p, s), cur_pd in plots_pd.groupby(
-            ['forward', 'reverse', 'perc_identity', 'mock_sample']
-    ):
-        empties = cur_pd['perc_empty_samples'].tolist()[0]
-        g = sns.lmplot(
-            data=cur_pd, x='mock (% reads)', y='sample (% reads)',
-            hue='variable', col='comparison', col_wrap=3, height=4, aspect=0.8,
-            facet_kws={'sharex': False, 'sharey': False})
-        g.set_titles('{col_name}')
-        plt.suptitle(
-            '[%s-%s] Relative abundances of mock "%s" vs samples features (open-ref clust=%s)\n'
-            '(%s %s of metadata samples do not shared any mock feature)' % (
-                f, r, s, p, round(empties, 2), "%"), fontsize=14)
-        plt.subplots_adjust(top=0.8)
-        pdf.savefig(bbox_inches='tight')
-        plt.close()
+from evaluate_dada2.mock import get_plot_pd
+from evaluate_dada2.regression import PAGE, get_line
+from evaluate_dada2.trace import traced
+
+
+@traced(cat='plot')
+def plot_regressions(plots_pd, regressions_pd, meta_combis, sams_labels,
+                     pdf):
+    """Add a page of samples vs mock features regressions for each mock
+    sample of each combination and perc_identity"""
+    regressions = dict(list(regressions_pd.groupby(PAGE)))
+    for page, page_pd in plots_pd.groupby(PAGE):
+        pdf.add(draw_regressions, page_pd, regressions[page], meta_combis,
+                sams_labels, page)
 
 
+def draw_regressions(page_pd, page_regs, meta_combis, sams_labels, page):
+    """Draw the samples vs mock features scatters with the precomputed
+    regression lines and confidence bands (see `regression.get_regressions`)"""
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    f, r, p, s = page
+    empties = page_pd['perc_empty_samples'].tolist()[0]
+    cur_pd = get_plot_pd(page_pd, s, meta_combis, sams_labels,
+                         'sample (% reads)')
+    cur_regs = page_regs.set_index(['comparison', 'variable'])
+    comparisons = cur_pd['comparison'].unique()
+    n_rows = int(np.ceil(len(comparisons) / 3))
+    fig, axes = plt.subplots(
+        n_rows, min(3, len(comparisons)), squeeze=False,
+        figsize=(min(3, len(comparisons)) * 3.2, n_rows * 4))
+    for ax, comparison in zip(axes.flatten(), comparisons):
+        comp_pd = cur_pd[cur_pd['comparison'] == comparison]
+        variables = sorted(comp_pd['variable'].unique())
+        palette = sns.color_palette(n_colors=len(variables))
+        for variable, color in zip(variables, palette):
+            var_pd = comp_pd[comp_pd['variable'] == variable]
+            ax.scatter(var_pd['mock (% reads)'],
+                       var_pd['sample (% reads)'], s=12, color=color,
+                       alpha=0.8, label=variable)
+            x, y, low, high = get_line(cur_regs.loc[(comparison, variable)])
+            ax.plot(x, y, color=color)
+            ax.fill_between(x, low, high, color=color, alpha=0.15)
+        ax.set_title(comparison)
+        ax.set_xlabel('mock (% reads)')
+        ax.set_ylabel('sample (% reads)')
+        ax.legend(fontsize=6, title='variable', title_fontsize=7)
+    for ax in axes.flatten()[len(comparisons):]:
+        ax.set_axis_off()
+    plt.suptitle(
+        '[%s-%s] Relative abundances of mock "%s" vs samples features (open-ref clust=%s)\n'
+        '(%s %s of metadata samples do not shared any mock feature)' % (
+            f, r, s, p, round(empties, 2), "%"), fontsize=14)
+    plt.subplots_adjust(top=0.8)
+
+
+@traced(cat='plot')
 def make_heatmap_outputs(meta, stats_pd, pdf):
     """Make heatmaps for the DADA2 stats"""
     for value in ['passed filter', 'merged', 'non-chimeric']:
         name = 'percentage of input %s' % value
         if name not in set(stats_pd.columns):
             continue
-        if 'is_control' not in meta or meta['is_control'].nunique() == 1:
-            controls = [0]
-            fig, axes = plt.subplots(figsize=(5, 3))
+        pdf.add(draw_heatmap_outputs, meta, stats_pd, name)
+
+
+def draw_heatmap_outputs(meta, stats_pd, name):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    if 'is_control' not in meta or meta['is_control'].nunique() == 1:
+        controls = [0]
+        fig, axes = plt.subplots(figsize=(5, 3))
+    else:
+        controls = [0, 1]
+        fig, axes = plt.subplots(1, 2, figsize=(11, 3))
+    for control in controls:
+        if len(controls) == 2:
+            sams = list(meta[meta['is_control'] == control].sample_name)
+        else:
+            sams = list(meta.sample_name)
+        cur_stats_pd = stats_pd[stats_pd['sample-id'].isin(sams)]
+        stats_mean = cur_stats_pd.pivot_table(
+            index=['forward'], columns=['reverse'],
+            values=[name], aggfunc=np.mean)
+        stats_sd = cur_stats_pd.pivot_table(
+            index=['forward'], columns=['reverse'],
+            values=[name], aggfunc=np.std)
+        stats_full = round(
+            stats_mean, 2).astype(str) + "\n(±" + round(
+            stats_sd, 2).astype(str) + ")"
+        stats_mean.columns = stats_mean.columns.droplevel()
+        if len(controls) == 2:
+            g = sns.heatmap(stats_mean, cmap='RdBu', ax=axes[control],
+                            annot=stats_full.values, fmt='',
+                            annot_kws={"fontsize": 8})
+            g.set_title('control samples==%s (n=%s)' % (control, len(sams)))
         else:
-            controls = [0, 1]
-            fig, axes = plt.subplots(1, 2, figsize=(11, 3))
-        for control in controls:
-            if len(controls) == 2:
-                sams = list(meta[meta['is_control'] == control].sample_name)
-            else:
-                sams = list(meta.sample_name)
-            cur_stats_pd = stats_pd[stats_pd['sample-id'].isin(sams)]
-            stats_mean = cur_stats_pd.pivot_table(
-                index=['forward'], columns=['reverse'],
-                values=[name], aggfunc=np.mean)
-            stats_sd = cur_stats_pd.pivot_table(
-                index=['forward'], columns=['reverse'],
-                values=[name], aggfunc=np.std)
-            stats_full = round(
-                stats_mean, 2).astype(str) + "\n(±" + round(
-                stats_sd, 2).astype(str) + ")"
-            stats_mean.columns = stats_mean.columns.droplevel()
-            if len(controls) == 2:
-                g = sns.heatmap(stats_mean, cmap='RdBu', ax=axes[control],
-                                annot=stats_full.values, fmt='',
-                                annot_kws={"fontsize": 8})
-                g.set_title('control samples==%s (n=%s)' % (control, len(sams)))
-            else:
-                g = sns.heatmap(
-                    stats_mean, cmap='RdBu', annot=stats_full.values, fmt='')
-                g.set_title('samples (n=%s)' % len(sams))
-        plt.suptitle(name, fontsize=14, fontweight="bold")
-        plt.subplots_adjust(top=0.82)
-        pdf.savefig(bbox_inches='tight')
-        plt.close()
+            g = sns.heatmap(
+                stats_mean, cmap='RdBu', annot=stats_full.values, fmt='')
+            g.set_title('samples (n=%s)' % len(sams))
+    plt.suptitle(name, fontsize=14, fontweight="bold")
+    plt.subplots_adjust(top=0.82)
+
+
+def get_stability_medians(stability_pd):
+    """Median (across samples) dissimilarities of each pair of combinations,
+    with the label of each combination of the pair (a, b)"""
+    gb = ['forward_a', 'reverse_a', 'forward_b', 'reverse_b']
+    medians = stability_pd.groupby(gb)[['Bray-Curtis', 'Jaccard']].median()
+    medians = medians.reset_index()
+    for fr in 'ab':
+        medians[fr] = medians['forward_%s' % fr].astype(str) + '-' + medians[
+            'reverse_%s' % fr].astype(str)
+    return medians
+
 
+@traced(cat='plot')
+def make_heatmap_stability(stability_pd, pairs, pdf):
+    """Make heatmaps of the median (across samples) dissimilarity between
+    the communities of neighboring (or all pairs of) combinations"""
+    if not stability_pd.shape[0]:
+        return
+    medians = get_stability_medians(stability_pd)
+    for metric in ['Bray-Curtis', 'Jaccard']:
+        pdf.add(draw_heatmap_stability, medians, pairs, metric)
 
+
+def draw_heatmap_stability(medians, pairs, metric):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    if pairs == 'all':
+        pvs = [('All pairs of combinations', medians.pivot_table(
+            index='a', columns='b', values=metric, sort=False))]
+    else:
+        pvs = []
+        for step in ['forward', 'reverse']:
+            other = {'forward': 'reverse', 'reverse': 'forward'}[step]
+            step_pd = medians[(medians['%s_a' % other] == medians[
+                '%s_b' % other]) & (medians['%s_a' % step] != medians[
+                '%s_b' % step])]
+            if step_pd.shape[0]:
+                pvs.append(('vs next %s length' % step,
+                            step_pd.pivot_table(index='forward_a',
+                                                columns='reverse_a',
+                                                values=metric)))
+    fig, axes = plt.subplots(1, len(pvs), squeeze=False,
+                             figsize=(len(pvs) * 6, 4.5))
+    for ax, (title, pv) in zip(axes[0], pvs):
+        g = sns.heatmap(pv, cmap='RdBu_r', ax=ax, annot=pv.shape[0] < 15,
+                        fmt='.2f', annot_kws={"fontsize": 6})
+        g.set_title(title, fontsize=10)
+    plt.suptitle('Stability of the samples communities (median %s)' % (
+        metric), fontsize=14, fontweight="bold")
+    plt.subplots_adjust(top=0.82)
+
+
+@traced(cat='plot')
 def make_heatmap_blast_asv(blast_in_pd, pdf):
+    pdf.add(draw_heatmap_blast_asv, blast_in_pd)
+
+
+def draw_heatmap_blast_asv(blast_in_pd):
     """Parse the BLAST results to get the numbers of proper hits"""
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     nqueries_pv = blast_in_pd.pivot_table(
         index=['forward'],
         columns=['reverse'],
@@ -85,8 +182,6 @@ def make_heatmap_blast_asv(blast_in_pd, pdf):
     plt.suptitle('Number of ASVs in the trimmed mock sample',
                  fontsize=14, fontweight="bold")
     plt.subplots_adjust(top=0.82)
-    pdf.savefig(bbox_inches='tight')
-    plt.close()
 
 
 def get_txts():
@@ -129,128 +224,177 @@ def get_txts():
     return txts
 
 
+def get_classifs_cells(classifs):
+    """Number of taxa (other than "None") and taxa names ("taxa"), and
+    summed mock abundance ("mock") of every cell of a classification table,
+    indexed by cell (type, sam, p, f, r)"""
+    cell = ['type', 'sam', 'p', 'f', 'r']
+    taxa = classifs[cell + ['Taxon']].drop_duplicates()
+    n_taxa = taxa[taxa['Taxon'] != 'None'].groupby(
+        cell, observed=True).size()
+    is_taxo = taxa['type'] == 'taxo'
+    taxa['name'] = taxa['Taxon'].where(~is_taxo, taxa['Taxon'].str.split(
+        ';').str[-1].str.strip())
+    names = taxa[cell + ['name']].drop_duplicates().sort_values('name')
+    names_gb = names.groupby(cell, observed=True)['name']
+    cells = names_gb.agg('\n'.join).to_frame('names')
+    is_ids = cells.index.get_level_values('type') != 'taxo'
+    cells.loc[is_ids & (names_gb.size() >= 5).values, 'names'] = '>5 IDs'
+    cells['taxa'] = n_taxa.reindex(cells.index, fill_value=0).astype(
+        str) + '\n' + cells['names']
+    cells['mock'] = classifs.groupby(cell, observed=True)['mock'].sum(
+        min_count=1)
+    return cells[['taxa', 'mock']]
+
+
+def get_classifs_grids(classifs):
+    """Cells of a classification table for all the pages at once: forward
+    lengths (rows) by field and reverse lengths (columns), indexed by page
+    (type, sam, p)"""
+    return get_classifs_cells(classifs).unstack('r')
+
+
+@traced(cat='plot')
 def make_heatmap_classifs(outs, txts, pdf):
-    gb = ['type', 'sam']
     for typ in ['misclass', 'underclass', 'false_neg']:
-        top, Y, suptitle, text = txts[typ]
-        for (level, sam), gb_pd in outs[typ].groupby(gb, group_keys=False):
-            n_p = gb_pd['p'].nunique()
-            fig, axes = plt.subplots(1, n_p, figsize=(n_p * 12, 6))
-            for pdx, (p, p_pd) in enumerate(gb_pd.groupby('p')):
-                taxa_len = p_pd[['f', 'r', 'Taxon']].pivot_table(
-                    index=['f'], columns=['r'], values=['Taxon'],
-                    aggfunc=lambda x: len(set([i for i in x if i != 'None'])))
-                if level == 'taxo':
-                    func = lambda x: '\n'.join(
-                        sorted(set([i.split(';')[-1].strip() for i in x])))
-                else:
-                    func = lambda x: '\n'.join(
-                        sorted(set([';'.join(i) if len(set(x)) < 5 else '>5 IDs'
-                         for i in np.array_split(sorted(set(x)), 4)])))
-                taxa_names = p_pd[['f', 'r', 'Taxon']].pivot_table(
-                    index=['f'], columns=['r'], values=['Taxon'],
-                    aggfunc=func)
-                taxa_relab = p_pd[['f', 'r', 'mock']].pivot_table(
-                    index=['f'], columns=['r'], values=['mock'],
-                    aggfunc=sum)
-                taxa_relab.columns = taxa_relab.columns.droplevel()
-                taxa_names = taxa_len.astype(str) + '\n' + taxa_names.astype(
-                    str)
-                g = sns.heatmap(
-                    taxa_relab, cmap='RdBu', fmt='', ax=axes[pdx],
-                    annot=taxa_names.astype(str).values,
-                    annot_kws={"fontsize": 6})
-                g.set_title('Mock BLASTdb perc_ident = %s' % p, fontsize=12)
-            plt.suptitle(suptitle % (sam, level), fontsize=20,
-                         fontweight="bold")
-            plt.text(.5, Y, text, transform=fig.transFigure,
-                     horizontalalignment='center', fontsize=16)
-            plt.subplots_adjust(top=top)
-            pdf.savefig(bbox_inches='tight')
-            plt.close()
+        grids = get_classifs_grids(outs[typ])
+        for (level, sam), grid in grids.groupby(
+                level=['type', 'sam'], observed=True):
+            pdf.add(draw_heatmap_classifs, grid.droplevel(['type', 'sam']),
+                    txts[typ], level, sam)
+
 
+def draw_heatmap_classifs(grid, txt, level, sam):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    top, Y, suptitle, text = txt
+    ps = grid.index.get_level_values('p').unique()
+    fig, axes = plt.subplots(1, len(ps), figsize=(len(ps) * 12, 6))
+    for pdx, p in enumerate(ps):
+        p_grid = grid.xs(p, level='p').dropna(axis=1, how='all')
+        g = sns.heatmap(
+            p_grid['mock'], cmap='RdBu', fmt='', ax=axes[pdx],
+            annot=p_grid['taxa'].values, annot_kws={"fontsize": 6})
+        g.set_title('Mock BLASTdb perc_ident = %s' % p, fontsize=12)
+    plt.suptitle(suptitle % (sam, level), fontsize=20,
+                 fontweight="bold")
+    plt.text(.5, Y, text, transform=fig.transFigure,
+             horizontalalignment='center', fontsize=16)
+    plt.subplots_adjust(top=top)
 
+
+def get_stats_grids(results):
+    """Pivot all the metrics (and their confidence intervals) of all the
+    pages at once: the forward lengths (rows) by metric and reverse lengths
+    (columns), indexed by page (type, level, sam, p)"""
+    values = [x for x in results.columns if x not in [
+        'sample', 'level', 'type', 'sam', 'p', 'f', 'r']]
+    grids = results.pivot_table(
+        index=['type', 'level', 'sam', 'p', 'f'], columns=['r'],
+        values=values, observed=True)
+    return grids
+
+
+def get_pv(grid, metric, n):
+    """Grid of one metric of a page, as its own pivot would be"""
+    return round(grid[metric].dropna(how='all'), n)
+
+
+def get_ci_pv(grid, metric, pv, n):
+    """Bootstrap confidence intervals of a metric, as "[low, high]" strings
+    on the grid of the metric's pivot (None if no bootstrap was done)"""
+    low, high = '%s low' % metric, '%s high' % metric
+    if low not in grid.columns.get_level_values(0):
+        return None
+    bounds = []
+    for bound in [low, high]:
+        bound_pv = get_pv(grid, bound, n)
+        bounds.append(bound_pv.reindex(index=pv.index, columns=pv.columns))
+    return '[' + bounds[0].astype(str) + ', ' + bounds[1].astype(str) + ']'
+
+
+def get_ci_annot(grid, metric, pv, n):
+    """Heatmap annotations of a metric, with its confidence interval"""
+    ci_pv = get_ci_pv(grid, metric, pv, n)
+    if ci_pv is None:
+        return True
+    return (pv.astype(str) + '\n' + ci_pv).values
+
+
+@traced(cat='plot')
 def make_heatmap_stats(outs, txts, pdf):
-    gb = ['type', 'level', 'sam', "p"]
-    for (typ, l, sam, p), gb_pd in outs['results'].groupby(gb,
-                                                           group_keys=False):
+    grids = get_stats_grids(outs['results'])
+    for (typ, l, sam, p), grid in grids.groupby(
+            level=['type', 'level', 'sam', 'p'], observed=True):
         if typ == 'taxo' and l == 1:
             continue
-        fig, axes = plt.subplots(2, 3, figsize=(14, 7))
-
-        obs, obsexp = 'Observed Taxa', 'Observed / Expected Taxa'
-        obs_pv = gb_pd.pivot_table(index=['f'], columns=['r'], values=[obs])
-        obs_pv.columns = obs_pv.columns.droplevel()
-        obsexp_pv = round(100 * (
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=[obsexp])), 2)
-        obsexp_pv.columns = obsexp_pv.columns.droplevel()
-        both_pv = obs_pv.astype(str) + '\n (' + obsexp_pv.astype(str) + '%)'
-        g = sns.heatmap(obs_pv, cmap='RdBu', fmt='', ax=axes[0, 0],
-                        annot=both_pv.values, annot_kws={"fontsize": 6})
-        g.set_title(txts[obsexp][0], fontsize=8)
-        plt.text(.215, 0.885, txts[obs][0], transform=fig.transFigure,
-                 horizontalalignment='center', fontsize=10, fontweight="bold")
-
-        tar_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['TAR']), 4)
-        tar_pv.columns = tar_pv.columns.droplevel()
-        g = sns.heatmap(tar_pv, cmap='RdBu', fmt='', ax=axes[0, 1],
-                        annot=True, annot_kws={"fontsize": 6})
-        g.set_title(txts['TAR'][1], fontsize=8)
-        plt.text(.5, 0.92, txts['TAR'][0], transform=fig.transFigure,
-                 horizontalalignment='center', fontsize=10, fontweight="bold")
-
-        tdr_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['TDR']), 4)
-        tdr_pv.columns = tdr_pv.columns.droplevel()
-        g = sns.heatmap(tdr_pv, cmap='RdBu', fmt='', ax=axes[0, 2],
-                        annot=True, annot_kws={"fontsize": 6})
-        g.set_title(txts['TDR'][1], fontsize=8)
-        plt.text(.765, 0.92, txts['TDR'][0], transform=fig.transFigure,
-                 horizontalalignment='center', fontsize=10, fontweight="bold")
-
-        bc_pv = round(gb_pd.pivot_table(index=['f'], columns=['r'],
-                                        values=['Bray-Curtis']), 4)
-        bc_pv.columns = bc_pv.columns.droplevel()
-        g = sns.heatmap(bc_pv, cmap='RdBu', fmt='', ax=axes[1, 0],
-                        annot=True, annot_kws={"fontsize": 6})
-        g.set_title(txts['Bray-Curtis'][0], fontsize=10, fontweight="bold")
-
-        jc_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['Jaccard']),
-            4)
-        jc_pv.columns = jc_pv.columns.droplevel()
-        g = sns.heatmap(jc_pv, cmap='RdBu', fmt='', ax=axes[1, 1],
-                        annot=True, annot_kws={"fontsize": 6})
-        g.set_title(txts['Jaccard'][0], fontsize=10, fontweight="bold")
-
-        r_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['r-squared']),
-            5)
-        s_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['Slope']), 2)
-        p_pv = round(
-            gb_pd.pivot_table(index=['f'], columns=['r'], values=['P value']),
-            5)
-        r_pv.columns = r_pv.columns.droplevel()
-        s_pv.columns = s_pv.columns.droplevel()
-        p_pv.columns = p_pv.columns.droplevel()
-        annot_pv = '[s=' + s_pv.astype(str) + '\np=' + p_pv.astype(str) + ']'
-        g = sns.heatmap(r_pv, cmap='RdBu', fmt='', ax=axes[1, 2],
-                        annot=annot_pv.values, annot_kws={"fontsize": 5})
-        plt.text(.765, 0.44, txts['r-squared'][0], transform=fig.transFigure,
-                 horizontalalignment='center', fontsize=10, fontweight="bold")
-        g.set_title('Linear regression stats [s=slope; p=p-value]', fontsize=8)
-
-        if typ == 'asv':
-            plt.suptitle(
-                'Feature evaluation: mock "%s" vs ref (p=%s) ["%s" level]' % (
-                    sam, p, typ), fontsize=15, fontweight="bold")
-        else:
-            plt.suptitle(
-                'Feature evaluation: mock "%s" vs ref (p=%s) [%s level %s]' % (
-                    sam, p, typ, l), fontsize=15, fontweight="bold")
-        plt.subplots_adjust(top=0.85, hspace=0.525)
-        pdf.savefig(bbox_inches='tight')
-        plt.close()
+        grid = grid.droplevel(['type', 'level', 'sam', 'p'])
+        pdf.add(draw_heatmap_stats, grid.dropna(axis=1, how='all'), txts,
+                typ, l, sam, p)
+
+
+def draw_heatmap_stats(grid, txts, typ, l, sam, p):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(2, 3, figsize=(14, 7))
 
+    obs, obsexp = 'Observed Taxa', 'Observed / Expected Taxa'
+    obs_pv = grid[obs].dropna(how='all')
+    obsexp_pv = round(100 * grid[obsexp].dropna(how='all'), 2)
+    both_pv = obs_pv.astype(str) + '\n (' + obsexp_pv.astype(str) + '%)'
+    g = sns.heatmap(obs_pv, cmap='RdBu', fmt='', ax=axes[0, 0],
+                    annot=both_pv.values, annot_kws={"fontsize": 6})
+    g.set_title(txts[obsexp][0], fontsize=8)
+    plt.text(.215, 0.885, txts[obs][0], transform=fig.transFigure,
+             horizontalalignment='center', fontsize=10, fontweight="bold")
+
+    tar_pv = get_pv(grid, 'TAR', 4)
+    g = sns.heatmap(tar_pv, cmap='RdBu', fmt='', ax=axes[0, 1],
+                    annot=get_ci_annot(grid, 'TAR', tar_pv, 4),
+                    annot_kws={"fontsize": 6})
+    g.set_title(txts['TAR'][1], fontsize=8)
+    plt.text(.5, 0.92, txts['TAR'][0], transform=fig.transFigure,
+             horizontalalignment='center', fontsize=10, fontweight="bold")
+
+    tdr_pv = get_pv(grid, 'TDR', 4)
+    g = sns.heatmap(tdr_pv, cmap='RdBu', fmt='', ax=axes[0, 2],
+                    annot=get_ci_annot(grid, 'TDR', tdr_pv, 4),
+                    annot_kws={"fontsize": 6})
+    g.set_title(txts['TDR'][1], fontsize=8)
+    plt.text(.765, 0.92, txts['TDR'][0], transform=fig.transFigure,
+             horizontalalignment='center', fontsize=10, fontweight="bold")
+
+    bc_pv = get_pv(grid, 'Bray-Curtis', 4)
+    g = sns.heatmap(bc_pv, cmap='RdBu', fmt='', ax=axes[1, 0],
+                    annot=get_ci_annot(grid, 'Bray-Curtis', bc_pv, 4),
+                    annot_kws={"fontsize": 6})
+    g.set_title(txts['Bray-Curtis'][0], fontsize=10, fontweight="bold")
+
+    jc_pv = get_pv(grid, 'Jaccard', 4)
+    g = sns.heatmap(jc_pv, cmap='RdBu', fmt='', ax=axes[1, 1],
+                    annot=get_ci_annot(grid, 'Jaccard', jc_pv, 4),
+                    annot_kws={"fontsize": 6})
+    g.set_title(txts['Jaccard'][0], fontsize=10, fontweight="bold")
+
+    r_pv = get_pv(grid, 'r-squared', 5)
+    s_pv = get_pv(grid, 'Slope', 2)
+    p_pv = get_pv(grid, 'P value', 5)
+    annot_pv = '[s=' + s_pv.astype(str) + '\np=' + p_pv.astype(str) + ']'
+    r_ci = get_ci_pv(grid, 'r-squared', r_pv, 2)
+    if r_ci is not None:
+        annot_pv = annot_pv + '\nr2=' + r_ci
+    g = sns.heatmap(r_pv, cmap='RdBu', fmt='', ax=axes[1, 2],
+                    annot=annot_pv.values, annot_kws={"fontsize": 5})
+    plt.text(.765, 0.44, txts['r-squared'][0], transform=fig.transFigure,
+             horizontalalignment='center', fontsize=10, fontweight="bold")
+    g.set_title('Linear regression stats [s=slope; p=p-value]', fontsize=8)
+
+    if typ == 'asv':
+        plt.suptitle(
+            'Feature evaluation: mock "%s" vs ref (p=%s) ["%s" level]' % (
+                sam, p, typ), fontsize=15, fontweight="bold")
+    else:
+        plt.suptitle(
+            'Feature evaluation: mock "%s" vs ref (p=%s) [%s level %s]' % (
+                sam, p, typ, l), fontsize=15, fontweight="bold")
+    plt.subplots_adjust(top=0.85, hspace=0.525)
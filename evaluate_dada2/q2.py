@@ -11,13 +11,12 @@ import subprocess
 import numpy as np
 import pandas as pd
 from os.path import isfile
-from qiime2 import Artifact, Metadata
-from qiime2.plugins.dada2.methods import denoise_single, denoise_paired
-from qiime2.plugins.feature_table.methods import filter_samples
-from qiime2.plugins.quality_control.visualizers import evaluate_composition
+from evaluate_dada2.trace import span, traced
 
 
+@traced('import')
 def load_trimmed_seqs(manifest, reverses):
+    from qiime2 import Artifact
     single, paired = 'Single', ''
     if reverses:
         single, paired = 'Paired', 'PairedEnd'
@@ -28,6 +27,8 @@ def load_trimmed_seqs(manifest, reverses):
 
 
 def run_evaluation(ref_q2, sam_q2, depth=1):
+    from qiime2.plugins.quality_control.visualizers import (
+        evaluate_composition)
     evaluation = evaluate_composition(
         expected_features=ref_q2, observed_features=sam_q2,
         depth=depth, palette='Set1', plot_tar=True, plot_r_value=True,
@@ -37,9 +38,13 @@ def run_evaluation(ref_q2, sam_q2, depth=1):
 
 
 def run_denoise(combis, trimmed_seqs, out_files, params):
+    from qiime2.plugins.dada2.methods import denoise_single, denoise_paired
+    from qiime2.plugins.feature_table.methods import filter_samples
     for for_rev in combis:
         tab_fp, seq_fp, sta_fp = out_files[tuple(for_rev)]
-        if not (isfile(tab_fp) and isfile(seq_fp) and isfile(sta_fp)):
+        if isfile(tab_fp) and isfile(seq_fp) and isfile(sta_fp):
+            continue
+        with span('denoise', 'task', combo='-'.join(map(str, for_rev))):
             if len(for_rev) == 2:
                 tab, seq, sta = denoise_paired(
                     demultiplexed_seqs=trimmed_seqs,
@@ -75,7 +80,16 @@ def run_denoise(combis, trimmed_seqs, out_files, params):
             sta.save(sta_fp)
 
 
+def denoise_combi(job):
+    """Denoise one combination (in a worker) and return it"""
+    combis, trimmed_seqs, out_files, params = job
+    run_denoise(combis, trimmed_seqs, out_files, params)
+    return tuple(combis[0])
+
+
+@traced()
 def get_results(out_files):
+    from qiime2 import Artifact
     dada2 = {}
     for fr, (tab_fp, seq_fp, sta_fp) in out_files.items():
         dada2[fr] = (
@@ -103,8 +117,10 @@ def spawn_subprocess(cmd):
     return out
 
 
+@traced()
 def get_stats_pd(dada2):
     """Concatenate the stats from the runs"""
+    from qiime2 import Metadata
     stats_pds = []
     for fr, (tab, seq, sta) in dada2.items():
         stats_pd = sta.view(Metadata).to_dataframe()
@@ -0,0 +1,122 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t as t_dist
+from evaluate_dada2.trace import traced
+
+# a regression plot page: one mock sample of a combination
+PAGE = ['forward', 'reverse', 'perc_identity', 'mock_sample']
+SUMS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+
+
+def linregress_sums(n, sx, sy, sxx, syy, sxy):
+    """Least-squares regression of y on x from the sums of x, y, x², y² and
+    xy of every group (same outputs as scipy.stats.linregress)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mx, my = sx / n, sy / n
+        sxx = sxx - n * mx ** 2
+        syy = syy - n * my ** 2
+        sxy = sxy - n * mx * my
+        slope = sxy / sxx
+        intercept = my - slope * mx
+        r = np.where(sxx * syy > 0, sxy / np.sqrt(sxx * syy), 0.)
+        r = np.clip(r, -1., 1.)
+        df = n - 2
+        t = r * np.sqrt(df / ((1. - r) * (1. + r)))
+        p = np.where(np.abs(r) == 1., 0., 2 * t_dist.sf(np.abs(t), df))
+        p = np.where(n == 2, np.where(syy == 0, 1., 0.), p)
+        std_err = np.sqrt((1 - r ** 2) * syy / sxx / df)
+        std_err = np.where(n == 2, 0., std_err)
+    return slope, intercept, r, p, std_err
+
+
+def get_sample_sums(plots_pd):
+    """Sums of the regression of every sample on the mock sample of each
+    page (features absent from a sample are zeros: they add to n only)"""
+    is_mock = plots_pd['sample_name'] == plots_pd['mock_sample']
+    x_pd = plots_pd.loc[is_mock, PAGE + ['feature', 'value']].rename(
+        columns={'value': 'x'})
+    x_pd['x2'] = x_pd['x'] ** 2
+    pages = x_pd.groupby(PAGE).agg(
+        n=('x', 'size'), sx=('x', 'sum'), sxx=('x2', 'sum'),
+        x_min=('x', 'min'), x_max=('x', 'max'))
+    xy_pd = plots_pd.loc[~is_mock].merge(x_pd, on=PAGE + ['feature'])
+    xy_pd['y2'] = xy_pd['value'] ** 2
+    xy_pd['xy'] = xy_pd['value'] * xy_pd['x']
+    sums = xy_pd.groupby(PAGE + ['sample_name']).agg(
+        sy=('value', 'sum'), syy=('y2', 'sum'), sxy=('xy', 'sum'))
+    sums = sums.reset_index().merge(pages.reset_index(), on=PAGE)
+    return sums
+
+
+@traced()
+def get_regressions(plots_pd, meta_combis, sams_labels, ci=95):
+    """Regressions of the samples' on the mock's relative abundances for
+    every page, comparison (metadata combination) and variable (samples
+    label), in one grouped pass over the samples' sums.
+
+    Parameters
+    ----------
+    plots_pd : pd.DataFrame
+        Non-zero relative abundances of the mock features in the samples
+        (see `mock.get_lmplots`)
+    meta_combis : list
+        Combinations of metadata variables
+    sams_labels : dict
+        Label of each sample for every combination of metadata variables
+    ci : int
+        Size of the confidence intervals (%)
+
+    Returns
+    -------
+    regressions : pd.DataFrame
+        Slope, intercept, r², p-value and their confidence intervals, and
+        what is needed to draw the lines and confidence bands
+    """
+    sums = get_sample_sums(plots_pd)
+    groups = []
+    for meta_combi in meta_combis:
+        labels = sums['sample_name'].map(sams_labels[meta_combi])
+        combi_sums = sums.assign(
+            variable=labels.fillna(sums['sample_name']),
+            comparison=' & '.join(meta_combi))
+        groups.append(combi_sums.groupby(
+            PAGE + ['comparison', 'variable']).agg(
+            n_samples=('sample_name', 'size'), x_min=('x_min', 'first'),
+            x_max=('x_max', 'first'), **{x: (x, 'sum') for x in SUMS}))
+    regressions = pd.concat(groups).reset_index()
+    n, sx, sy, sxx, syy, sxy = [regressions[x].values for x in SUMS]
+    slope, intercept, r, p, std_err = linregress_sums(n, sx, sy, sxx, syy, sxy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_crit = t_dist.ppf(0.5 + ci / 200., n - 2)
+        x_mean, ssx = sx / n, sxx - sx ** 2 / n
+        sse = np.maximum((syy - sy ** 2 / n) - slope * (sxy - sx * sy / n), 0)
+        resid_std = np.sqrt(sse / (n - 2))
+        intercept_err = resid_std * np.sqrt(1. / n + x_mean ** 2 / ssx)
+    regressions = regressions.assign(
+        slope=slope, intercept=intercept, r_value=r, r_squared=r ** 2,
+        p_value=p, std_err=std_err,
+        slope_low=slope - t_crit * std_err,
+        slope_high=slope + t_crit * std_err,
+        intercept_low=intercept - t_crit * intercept_err,
+        intercept_high=intercept + t_crit * intercept_err,
+        x_mean=x_mean, ssx=ssx, resid_std=resid_std, t_crit=t_crit)
+    return regressions.drop(columns=SUMS[1:])
+
+
+def get_line(regression, n_points=50):
+    """Fitted line and confidence band of a regression, over its x range"""
+    x = np.linspace(regression['x_min'], regression['x_max'], n_points)
+    y = regression['intercept'] + regression['slope'] * x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        err = regression['t_crit'] * regression['resid_std'] * np.sqrt(
+            1. / regression['n'] + (x - regression['x_mean']) ** 2 /
+            regression['ssx'])
+    return x, y, y - err, y + err
@@ -0,0 +1,130 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import glob
+import time
+import pickle
+import hashlib
+import inspect
+from evaluate_dada2.io import mk_dirs, print_progress, get_pool
+from evaluate_dada2.trace import span, traced
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+
+def get_code_version(draw):
+    """Checksum of the code of a drawing function: the source of its module
+    and of the package functions that this module imports"""
+    module = inspect.getmodule(draw)
+    md5 = hashlib.md5(inspect.getsource(module).encode())
+    for name, obj in sorted(vars(module).items()):
+        if inspect.isfunction(obj) and obj.__module__ != module.__name__ \
+                and obj.__module__.startswith('evaluate_dada2.'):
+            md5.update(inspect.getsource(obj).encode())
+    return md5.hexdigest()
+
+
+def get_page_key(draw, args, version):
+    """Key of a page: checksum of the drawing function, of its code version
+    and of the data slice (arguments) it draws"""
+    md5 = hashlib.md5(('%s.%s|%s' % (
+        draw.__module__, draw.__qualname__, version)).encode())
+    md5.update(pickle.dumps(args, protocol=4))
+    return md5.hexdigest()
+
+
+def render_page(job):
+    """Draw one page and save it as a single-page PDF (in a worker)"""
+    import matplotlib.pyplot as plt
+    draw, args, page_fp = job
+    with span(draw.__name__, 'page'):
+        draw(*args)
+        plt.savefig('%s.tmp' % page_fp, format='pdf', bbox_inches='tight')
+        plt.close('all')
+    os.replace('%s.tmp' % page_fp, page_fp)
+    return page_fp
+
+
+class Report(object):
+    """PDF report made of page jobs, i.e., a drawing function (that draws
+    one figure) and its arguments. The pages are rendered when the report
+    is closed: as single-page PDFs cached on the key of each page (only
+    the new or changed pages are rendered, in a pool of workers) and then
+    merged in the order of the jobs, or serially in the PDF if `pypdf` is
+    not installed. Nothing is done if there is no PDF file"""
+
+    def __init__(self, pdf_fp, n_cores=1):
+        self.pdf_fp = pdf_fp
+        self.pages_dir = '%s/pages' % os.path.dirname(pdf_fp or '.')
+        self.n_cores = n_cores
+        self.jobs = []
+
+    def add(self, draw, *args):
+        if self.pdf_fp is not None:
+            self.jobs.append((draw, args))
+
+    @traced('pdf_report')
+    def close(self):
+        if self.pdf_fp is None:
+            return
+        if PdfWriter is None:
+            self.render_serial()
+        else:
+            self.render_cached()
+        self.jobs = []
+
+    def render_serial(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(self.pdf_fp) as pdf:
+            for draw, args in self.jobs:
+                with span(draw.__name__, 'page'):
+                    draw(*args)
+                    pdf.savefig(bbox_inches='tight')
+                    plt.close('all')
+
+    def get_pages(self):
+        """Cached page file of each job, and the jobs of the missing pages"""
+        versions, page_fps, todo = {}, [], {}
+        for draw, args in self.jobs:
+            if draw not in versions:
+                versions[draw] = get_code_version(draw)
+            page_fp = '%s/%s.pdf' % (self.pages_dir, get_page_key(
+                draw, args, versions[draw]))
+            page_fps.append(page_fp)
+            if not os.path.isfile(page_fp):
+                todo[page_fp] = (draw, args, page_fp)
+        return page_fps, list(todo.values())
+
+    def render_cached(self):
+        mk_dirs([self.pages_dir])
+        page_fps, todo = self.get_pages()
+        print('%s pages to render (%s cached)' % (
+            len(todo), len(page_fps) - len(todo)))
+        start = time.time()
+        if self.n_cores > 1 and len(todo) > 1:
+            with get_pool(self.n_cores) as pool:
+                pages = pool.imap_unordered(render_page, todo)
+                for jdx, _ in enumerate(pages):
+                    if not (jdx + 1) % 100 or jdx + 1 == len(todo):
+                        print_progress(jdx + 1, len(todo), start, 'pages')
+        else:
+            for job in todo:
+                render_page(job)
+        writer = PdfWriter()
+        for page_fp in page_fps:
+            writer.append(page_fp)
+        with open(self.pdf_fp, 'wb') as o:
+            writer.write(o)
+        cached = set(glob.glob('%s/*' % self.pages_dir))
+        for page_fp in cached - set(page_fps):
+            os.remove(page_fp)
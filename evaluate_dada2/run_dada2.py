@@ -7,21 +7,233 @@
 # ----------------------------------------------------------------------------
 
 import os
+import shutil
 import pandas as pd
-import multiprocessing
-from matplotlib.backends.backend_pdf import PdfPages
+from os.path import isfile
+from concurrent.futures import ThreadPoolExecutor
 
 from evaluate_dada2.q2 import (
-    load_trimmed_seqs, get_combis_split, run_denoise, get_results, get_stats_pd)
+    load_trimmed_seqs, get_combis_split, denoise_combi, get_results,
+    get_stats_pd)
 from evaluate_dada2.io import (
-    get_fors_revs, define_dirs, get_metadata, get_fastqs,
-    get_trimmed_seqs, get_out_files, to_do)
+    get_fors_revs, define_dirs, get_metadata, get_fastqs, get_trimmed_seqs,
+    get_out_files, to_do, mk_dirs, get_fwd_rev, get_keys, read_store,
+    write_store, get_pool)
 from evaluate_dada2.plots import (
     plot_regressions, get_txts, make_heatmap_classifs, make_heatmap_stats,
-    make_heatmap_outputs, make_heatmap_blast_asv)
-from evaluate_dada2.mock import get_ref_seqs, get_refs, open_ref, get_mock_refs
-from evaluate_dada2.blast import run_blasts, get_hits_pd
-from evaluate_dada2.eval import get_outs
+    make_heatmap_outputs, make_heatmap_blast_asv, make_heatmap_stability,
+    get_stability_medians)
+from evaluate_dada2.mock import (
+    get_ref_seqs, get_refs, open_ref, get_mock_refs, get_meta_combis,
+    get_sams_labels)
+from evaluate_dada2.blast import (
+    run_blasts, read_blasts, get_hits_pd, merge_streams as merge_searches)
+from evaluate_dada2.eval import (
+    OUTS, get_outs, load_outs, merge_streams as merge_evaluations)
+from evaluate_dada2.taxonomy import get_tax_index
+from evaluate_dada2.regression import get_regressions
+from evaluate_dada2.stability import get_stability
+from evaluate_dada2.report import Report
+from evaluate_dada2.pipeline import Stage, Pipeline
+from evaluate_dada2.shard import (
+    get_shard_dir, get_shard_combis, reset_shard, write_shard, merge_shards)
+from evaluate_dada2.trace import span, start_trace, stop_trace
+from evaluate_dada2.html_report import (
+    HtmlReport, get_outputs_data, get_blast_data, get_classifs_data,
+    get_results_data, get_regressions_data, get_points_data, get_pages_data,
+    get_labels_data)
+
+
+def get_stream_dirs(values):
+    """Folder of the search and evaluation outputs of each combination"""
+    return ['%s/streamed/%s' % (values['eval_dir'], '-'.join(map(str, fr)))
+            for fr in values['out_files']]
+
+
+def stream_combi(values, fr):
+    """Search and evaluate the mock ASVs of a combination as soon as it is
+    denoised: stored in a folder per combination, they are then merged once
+    in the stores by the search and evaluation stages"""
+    combo = '-'.join(map(str, fr))
+    stream_dir = '%s/streamed/%s' % (values['eval_dir'], combo)
+    mk_dirs([stream_dir])
+    blast_out = '%s/blast_out.tsv' % stream_dir
+    with span('stream', 'task', combo=combo):
+        dada2 = get_results({fr: values['out_files'][fr]})
+        run_blasts(dada2, values['eval_dir'], values['mocks'],
+                   values['ref_seqs'], values['blast_dbs'],
+                   '%s/blast_in.tsv' % stream_dir, blast_out,
+                   values['search'])
+        if not isfile(blast_out):
+            return
+        hits_pd = get_hits_pd(read_blasts(blast_out, dada2))
+        get_outs(dada2, values['eval_dir'], values['mocks'], hits_pd,
+                 values['mock_tabs'], values['tax_index'],
+                 values['evaluator'], 1, values['n_boot'],
+                 '%s/outs' % stream_dir)
+
+
+def denoise(values):
+    """Denoise the combinations whose outputs are missing, or were denoised
+    with other inputs (reads or parameters) than the current ones, each in
+    a worker. Each denoised combination is streamed to its search and
+    evaluation (one at a time, while the others are denoised)"""
+    out_files, fingerprint = values['out_files'], values['fingerprint']
+    fingerprints_fp = '%s/fingerprints.tsv' % values['denoized_dir']
+    done = {}
+    if isfile(fingerprints_fp):
+        stored = read_store(fingerprints_fp)
+        done = dict(zip(get_keys(stored, ['forward', 'reverse']),
+                        stored['fingerprint']))
+    for fr, fps in out_files.items():
+        key = '%s|%s' % get_fwd_rev(fr)
+        # the outputs of previous versions (without fingerprint) are kept
+        if done.get(key, fingerprint) != fingerprint:
+            for fp in fps:
+                if isfile(fp):
+                    os.remove(fp)
+        done[key] = fingerprint
+    if to_do(out_files):
+        print("Running DADA2")
+        manifest = get_trimmed_seqs(values['fastqs'], values['denoized_dir'],
+                                    values['reverses'])
+        trimmed = load_trimmed_seqs(manifest, values['reverses'])
+        jobs = [([list(fr)], trimmed, out_files, values['params'])
+                for fr, fps in out_files.items()
+                if not all(isfile(fp) for fp in fps)]
+        streams = []
+        shutil.rmtree('%s/streamed' % values['eval_dir'], ignore_errors=True)
+        # the streamer takes one of the cores
+        n_workers = values['n_cores'] - (values['stream'] and
+                                         values['n_cores'] > 1)
+        with ThreadPoolExecutor(1) as streamer, get_pool(n_workers) as pool:
+            for fr in pool.imap_unordered(denoise_combi, jobs):
+                if values['stream']:
+                    streams.append(streamer.submit(stream_combi, values, fr))
+            for stream in streams:
+                stream.result()
+    write_store(pd.DataFrame([k.split('|') + [v] for k, v in done.items()],
+                             columns=['forward', 'reverse', 'fingerprint']),
+                fingerprints_fp)
+    return {}
+
+
+def load_dada2(values):
+    print("Reading DADA2 results")
+    dada2 = get_results(values['out_files'])
+    return {'dada2': dada2, 'stats_pd': get_stats_pd(dada2)}
+
+
+def compare_combis(values):
+    print("Comparing the samples communities across combinations")
+    stability_pd = get_stability(values['dada2'], values['stability'])
+    mk_dirs([os.path.dirname(values['stability_fp'])])
+    write_store(stability_pd, values['stability_fp'])
+    return {'stability_pd': stability_pd}
+
+
+def load_stability(values):
+    return {'stability_pd': read_store(values['stability_fp'])}
+
+
+def cluster(values):
+    print("Open-reference clustering on the mock references")
+    plots_pd = open_ref(values['dada2'], values['ref_seqs'], values['mocks'],
+                        values['n_cores'])
+    write_store(plots_pd, values['lmplot_fp'])
+    return {'plots_pd': plots_pd}
+
+
+def load_clusters(values):
+    return {'plots_pd': read_store(values['lmplot_fp'])}
+
+
+def regress(values):
+    print("Making regressions for relative abundances of samples/mock ASVs")
+    sams_labels = get_sams_labels(values['meta'], values['meta_combis'])
+    regressions_pd = get_regressions(values['plots_pd'],
+                                     values['meta_combis'], sams_labels)
+    write_store(regressions_pd, values['regressions_fp'])
+    return {'regressions_pd': regressions_pd, 'sams_labels': sams_labels}
+
+
+def load_regressions(values):
+    sams_labels = get_sams_labels(values['meta'], values['meta_combis'])
+    return {'regressions_pd': read_store(values['regressions_fp']),
+            'sams_labels': sams_labels}
+
+
+def search_mocks(values):
+    merge_searches(get_stream_dirs(values), values['blast_in'],
+                   values['blast_out'])
+    run_blasts(values['dada2'], values['eval_dir'], values['mocks'],
+               values['ref_seqs'], values['blast_dbs'], values['blast_in'],
+               values['blast_out'], values['search'], values['n_cores'])
+    return load_searches(values)
+
+
+def load_searches(values):
+    return {'blast_in_pd': read_blasts(values['blast_in'], values['dada2']),
+            'blast_out_pd': read_blasts(values['blast_out'], values['dada2'])}
+
+
+def parse_hits(values):
+    print("Parsing the BLASTn hits")
+    return {'hits_pd': get_hits_pd(values['blast_out_pd'])}
+
+
+def evaluate(values):
+    print("Evaluating the composition of the samples' mocks features")
+    merge_evaluations(get_stream_dirs(values), '%s/outs' % values['eval_dir'])
+    outs = get_outs(values['dada2'], values['eval_dir'], values['mocks'],
+                    values['hits_pd'], values['mock_tabs'],
+                    values['tax_index'], values['evaluator'],
+                    values['n_cores'], values['n_boot'])
+    return {'outs': outs}
+
+
+def load_evaluation(values):
+    return {'outs': load_outs(values['eval_dir'], values['dada2'])}
+
+
+def make_reports(values):
+    """Add the pages (and HTML views) of the stages in the pipeline, and
+    write the reports"""
+    pdf, html = values['pdf'], values['html']
+    print("Making heatmaps from DADA2 stat results")
+    make_heatmap_outputs(values['meta'], values['stats_pd'], pdf)
+    html.add('dada2', get_outputs_data, values['meta'], values['stats_pd'])
+    if 'stability_pd' in values:
+        stability_pd = values['stability_pd']
+        make_heatmap_stability(stability_pd, values['stability'], pdf)
+        if stability_pd.shape[0]:
+            html.add('stability', get_stability_medians, stability_pd)
+            html.add('pairs', str, values['stability'])
+    if 'regressions_pd' in values:
+        plots_pd, regressions_pd = values['plots_pd'], values['regressions_pd']
+        plot_regressions(plots_pd, regressions_pd, values['meta_combis'],
+                         values['sams_labels'], pdf)
+        html.add('regressions', get_regressions_data, regressions_pd)
+        html.add('points', get_points_data, plots_pd)
+        html.add('pages', get_pages_data, plots_pd)
+        html.add('labels', get_labels_data, values['sams_labels'])
+    if 'blast_in_pd' in values:
+        print("Making heatmap of the BLASTed ASVs numbers")
+        make_heatmap_blast_asv(values['blast_in_pd'], pdf)
+        html.add('blast', get_blast_data, values['blast_in_pd'])
+    if 'outs' in values:
+        print("Making heatmap from the evaluate-composition results")
+        txts = get_txts()
+        make_heatmap_classifs(values['outs'], txts, pdf)
+        make_heatmap_stats(values['outs'], txts, pdf)
+        html.add('classifs', get_classifs_data, values['outs'])
+        html.add('results', get_results_data, values['outs'])
+    html.close()
+    if values['report'] != 'html':
+        print("Rendering the %s pages of the report" % len(pdf.jobs))
+        pdf.close()
+        print('--> Written:', values['pdf_fp'])
+    return {}
 
 
 def run_dada2(
@@ -40,13 +252,33 @@ def run_dada2(
         trunc_q,
         max_er,
         max_er_rev,
-        n_reads_learn
+        n_reads_learn,
+        search,
+        evaluator,
+        max_meta_depth,
+        stability,
+        n_boot,
+        report,
+        trace,
+        only=(),
+        start=None,
+        shard=None,
+        merge=False
 ):
+    out_dir = base_dir
+    if shard:
+        out_dir = get_shard_dir(base_dir, shard)
+        reset_shard(out_dir)
+    if trace:
+        start_trace('%s/trace_events' % out_dir)
     mini, maxi, step = trim_range
     params = [trunc_q, max_er, max_er_rev, n_reads_learn]
     forwards, reverses = get_fors_revs(mini, maxi, step, trim_lengths,
                                        f_trim_lengths, r_trim_lengths)
     combis_split = get_combis_split(forwards, reverses, n_cores)
+    if shard:
+        print("Shard %s of %s of the combinations" % shard)
+        combis_split = get_shard_combis(combis_split, shard, n_cores)
     print("Will trim forward reads to", ' nt, '.join(
         map(str, list(forwards))), 'nt')
     if reverses:
@@ -61,73 +293,93 @@ def run_dada2(
         print("Metadata variables to check:", '; '.join(sorted(meta_cols)))
 
     print("Getting output folders")
-    trimmed_dir, denoized_dir, eval_dir, pdf_fp = define_dirs(base_dir)
-    pdf = PdfPages(pdf_fp)
+    trimmed_dir, denoized_dir, eval_dir, pdf_fp = define_dirs(base_dir,
+                                                             out_dir)
+    html_dir = '%s/report' % os.path.dirname(pdf_fp)
     out_files = get_out_files(combis_split, denoized_dir)
-    lmplot_fp = '%s/lmplot_data.tsv' % eval_dir
+    if merge:
+        merge_shards(base_dir, out_files, denoized_dir, eval_dir)
 
     # metadata things
     print("Loading metadata")
     meta, mocks = get_metadata(metadata, mock_ref_dir)
     if 'control_type' not in meta_cols:
         meta_cols = ['control_type'] + sorted(meta_cols)
-
-    # mock things
-    if mock_ref_dir:
-        print("Loading mock community reference(s)")
-        ref_seqs = get_ref_seqs(mock_ref_dir)
-        refs = get_refs(mock_ref_dir, ref_tax_file)
+    meta_combis = get_meta_combis(meta_cols, max_meta_depth)
 
     fastqs = get_fastqs(meta, trimmed_dir)
     print("Fastq files in", base_dir, "[%s samples detected]" % len(fastqs))
 
-    # DADA2 things
-    if to_do(out_files):
-        print("Running DADA2")
-        manifest = get_trimmed_seqs(fastqs, denoized_dir, reverses)
-        trimmed = load_trimmed_seqs(manifest, reverses)
-        pool = multiprocessing.Pool(n_cores)
-        pool_params = [(x, trimmed, out_files, params) for x in combis_split]
-        pool.starmap(run_denoise, pool_params)
-        pool.close()
-        pool.join()
-
-    print("Reading DADA2 results")
-    dada2 = get_results(out_files)
-    stats_pd = get_stats_pd(dada2)
-
-    print("Making heatmaps from DADA2 stat results")
-    make_heatmap_outputs(meta, stats_pd, pdf)
+    config = {
+        'meta': meta, 'mocks': mocks, 'meta_combis': meta_combis,
+        'fastqs': fastqs, 'reverses': reverses, 'params': params,
+        'out_files': out_files, 'denoized_dir': denoized_dir,
+        'eval_dir': eval_dir,
+        'n_cores': n_cores, 'search': search, 'evaluator': evaluator,
+        'stability': stability, 'n_boot': n_boot, 'report': report,
+        'pdf_fp': pdf_fp, 'pdf': Report(pdf_fp if report != 'html' else None,
+                                        n_cores),
+        'html': HtmlReport(html_dir if report != 'pdf' else None),
+        'stability_fp': '%s/outs/stability.tsv' % eval_dir,
+        'lmplot_fp': '%s/lmplot_compact.tsv' % eval_dir,
+        'regressions_fp': '%s/regressions.tsv' % eval_dir,
+        'blast_in': '%s/blast_in.tsv' % eval_dir,
+        'blast_out': '%s/blast_out.tsv' % eval_dir,
+        'stream': bool(mock_ref_dir) and not only}
+    # the stages with a pool of workers (or threads) take all the cores
+    pipeline = Pipeline(config, '%s/pipeline.tsv' % out_dir, n_cores)
+    pipeline.add(Stage(
+        'denoise', denoise, outputs=[y for x in out_files.values() for y in x],
+        files=sorted(y for x in fastqs.values() for y in x),
+        params=[params, bool(reverses)], cores=n_cores))
+    pipeline.add(Stage('dada2', load_dada2, ['denoise'],
+                       code=[get_results, get_stats_pd]))
+    # the stages that need all the combinations wait for the merge
+    reports = ['dada2']
+    if stability != 'none' and not shard:
+        pipeline.add(Stage(
+            'stability', compare_combis, ['dada2'], [config['stability_fp']],
+            load_stability, params=[stability], code=[get_stability]))
+        reports.append('stability')
 
+    # mock things
     if mock_ref_dir:
-        if sample_regressions:
-            if not os.path.isfile(lmplot_fp):
-                print("Open-reference clustering on the mock references")
-                plots_pd = open_ref(dada2, ref_seqs, mocks, meta, meta_cols)
-                plots_pd.to_csv(lmplot_fp, index=False, sep='\t')
-            else:
-                plots_pd = pd.read_table(lmplot_fp)
-            print("Making regressions for relative abundances of samples/mock ASVs")
-            plot_regressions(plots_pd, pdf)
-
-        blast_in = '%s/blast_in.tsv' % eval_dir
-        blast_out = '%s/blast_out.tsv' % eval_dir
+        print("Loading mock community reference(s)")
+        ref_seqs = get_ref_seqs(mock_ref_dir)
+        refs = get_refs(mock_ref_dir, ref_tax_file)
+        tax_index = get_tax_index(refs, list(ranks))
         print("Loading reference mock into qiime2 and for BLASTn")
-        blast_dbs, mock_q2s = get_mock_refs(ref_seqs, refs, ranks)
-        if not (os.path.isfile(blast_in) and os.path.isfile(blast_out)):
-            print("Running BLASTn for ASVs vs mock references")
-            run_blasts(dada2, eval_dir, mocks, blast_dbs, blast_in, blast_out)
-        blast_out_pd = pd.read_table(blast_out)
-        blast_in_pd = pd.read_table(blast_in)
-        print("Making heatmap of the BLASTed ASVs numbers")
-        make_heatmap_blast_asv(blast_in_pd, pdf)
-        print("Parsing the BLASTn hits")
-        hits_pd = get_hits_pd(blast_out_pd)
-        print("Running Qiime2's evaluate-composition for samples' mocks features")
-        outs = get_outs(dada2, eval_dir, mocks, hits_pd, mock_q2s, refs, ranks)
-        print("Making heatmap from the Qiime2's evaluate-composition results")
-        txts = get_txts()
-        make_heatmap_classifs(outs, txts, pdf)
-        make_heatmap_stats(outs, txts, pdf)
-    pdf.close()
-    print('--> Written:', pdf_fp)
+        blast_dbs, mock_tabs = get_mock_refs(ref_seqs, tax_index)
+        config.update({'ref_seqs': ref_seqs, 'tax_index': tax_index,
+                       'blast_dbs': blast_dbs, 'mock_tabs': mock_tabs})
+        ref_fps = sorted(y for x in ref_seqs.values() for y in x[:2])
+        if sample_regressions and not shard:
+            pipeline.add(Stage(
+                'clustering', cluster, ['dada2'], [config['lmplot_fp']],
+                load_clusters, ref_fps, code=[open_ref], cores=n_cores))
+            pipeline.add(Stage(
+                'regressions', regress, ['clustering'],
+                [config['regressions_fp']], load_regressions, [metadata],
+                params=meta_combis, code=[get_regressions, get_sams_labels]))
+            reports.extend(['clustering', 'regressions'])
+        pipeline.add(Stage(
+            'search', search_mocks, ['dada2'],
+            [config['blast_in'], config['blast_out']], load_searches, ref_fps,
+            params=[search], code=[run_blasts], cores=n_cores))
+        pipeline.add(Stage('hits', parse_hits, ['search'], code=[get_hits_pd]))
+        outs_fps = ['%s/outs/%s.tsv' % (eval_dir, x)
+                    for x in OUTS + ['fingerprints']]
+        ref_tax_fp = '%s/%s' % (mock_ref_dir, ref_tax_file)
+        pipeline.add(Stage(
+            'evaluation', evaluate, ['dada2', 'hits'], outs_fps,
+            load_evaluation, ref_fps + [ref_tax_fp],
+            params=[evaluator, n_boot, list(ranks)], code=[get_outs],
+            cores=n_cores))
+        reports.extend(['search', 'evaluation'])
+    if not shard:
+        pipeline.add(Stage('report', make_reports, reports,
+                           cores=1 if report == 'html' else n_cores))
+    pipeline.run(only, start)
+    if shard:
+        write_shard(out_dir, out_files)
+    stop_trace('%s/trace.json' % out_dir)
@@ -9,7 +9,23 @@
 import click
 
 from evaluate_dada2 import __version__
-from evaluate_dada2.run_dada2 import run_dada2
+
+STAGES = ['denoise', 'dada2', 'stability', 'clustering', 'regressions',
+          'search', 'hits', 'evaluation', 'report']
+
+
+def get_shard(ctx, param, value):
+    """Shard `i/N` as (i, N)"""
+    if value is None:
+        return None
+    try:
+        i, n = map(int, value.split('/'))
+    except ValueError:
+        raise click.BadParameter('expected i/N (e.g. 1/4), got "%s"' % value)
+    if not 1 <= i <= n:
+        raise click.BadParameter('expected 1 <= i <= N, got "%s"' % value)
+    return i, n
+
 
 @click.command()
 @click.option(
@@ -61,6 +77,52 @@ from evaluate_dada2.run_dada2 import run_dada2
 @click.option(
     "-nr", "--p-n-reads-learn", type=int, nargs=1, show_default=False,
     default=1000000, help="Number of reads to use for error model training.")
+@click.option(
+    "-s", "--p-search", type=click.Choice(['blastn', 'kmer']),
+    default='blastn', show_default=True,
+    help="Search backend for the mock ASVs vs the mock references: BLAST+ "
+         "`blastn`, or an in-process k-mer seeded aligner (no BLAST+ needed)")
+@click.option(
+    "-v", "--p-evaluator", type=click.Choice(['native', 'qiime2']),
+    default='native', show_default=True,
+    help="Evaluate the mock compositions all at once (native), or one by "
+         "one with qiime2's quality-control evaluate-composition")
+@click.option(
+    "-md", "--p-max-meta-depth", type=int, nargs=1, default=0,
+    show_default=True,
+    help="Max number of metadata variables combined for the sample "
+         "regressions (0: all combinations)")
+@click.option(
+    "-st", "--p-stability", type=click.Choice(['neighbors', 'all', 'none']),
+    default='neighbors', show_default=True,
+    help="Compare the samples communities between neighboring combinations "
+         "of truncation lengths, or between all pairs of combinations")
+@click.option(
+    "-b", "--p-bootstraps", type=int, nargs=1, default=0, show_default=True,
+    help="Number of multinomial resamples of the mock samples reads for the "
+         "confidence intervals of the evaluation metrics (0: no bootstrap)")
+@click.option(
+    "-rp", "--p-report", type=click.Choice(['pdf', 'html', 'both']),
+    default='pdf', show_default=True,
+    help="Report as a PDF (one page per figure), as an interactive HTML "
+         "page (drawn in the browser from compact data files), or both")
+@click.option(
+    "--trace/--no-trace", default=False, show_default=True,
+    help="Record the time, memory and I/O of every stage and task in a "
+         "Chrome trace file (trace.json) and print a summary at the end")
+@click.option(
+    "--only", multiple=True, type=click.Choice(STAGES), default=[],
+    help="Only run these stages (the stages they depend on are loaded from "
+         "their outputs, even if outdated)")
+@click.option(
+    "--from", "from_stage", type=click.Choice(STAGES), default=None,
+    help="Run this stage and all the stages that depend on it (the others "
+         "are only run if their inputs changed)")
+@click.option(
+    "-sh", "--p-shard", default=None, callback=get_shard,
+    help="Only denoise, search and evaluate the i-th of N shards of the "
+         "combinations (e.g. 1/4, in `shards/1-of-4`), to run the grid on N "
+         "machines sharing the filesystem, then combine with `merge_dada2`")
 @click.version_option(__version__, prog_name="evaluate_dada2")
 
 
@@ -80,8 +142,21 @@ def standalone_dada2(
         p_trunc_quality,
         p_max_error,
         p_max_error_reverse,
-        p_n_reads_learn
+        p_n_reads_learn,
+        p_search,
+        p_evaluator,
+        p_max_meta_depth,
+        p_stability,
+        p_bootstraps,
+        p_report,
+        trace,
+        only,
+        from_stage,
+        p_shard,
+        merge=False
 ):
+    # imported here so that --help and --version do not load qiime2
+    from evaluate_dada2.run_dada2 import run_dada2
 
     run_dada2(
         base_dir=i_fastq_dir,
@@ -100,8 +175,28 @@ def standalone_dada2(
         max_er=p_max_error,
         max_er_rev=p_max_error_reverse,
         n_reads_learn=p_n_reads_learn,
+        search=p_search,
+        evaluator=p_evaluator,
+        max_meta_depth=p_max_meta_depth,
+        stability=p_stability,
+        n_boot=p_bootstraps,
+        report=p_report,
+        trace=trace,
+        only=only,
+        start=from_stage,
+        shard=p_shard,
+        merge=merge
     )
 
 
+@click.command(params=[x for x in standalone_dada2.params
+                       if x.name not in ('only', 'from_stage', 'p_shard')])
+def standalone_merge(**kwargs):
+    """Merge the shards of the combinations (run with the same options and
+    `--p-shard i/N`) and run the stages across all the combinations"""
+    standalone_dada2.callback(only=(), from_stage=None, p_shard=None,
+                              merge=True, **kwargs)
+
+
 if __name__ == "__main__":
     standalone_dada2()
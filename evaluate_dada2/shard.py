@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import glob
+import shutil
+import numpy as np
+import pandas as pd
+from os.path import basename, isfile
+from evaluate_dada2.io import get_fwd_rev, get_keys, read_store, write_store
+from evaluate_dada2.blast import merge_blasts
+from evaluate_dada2.eval import KEY, Outputs, read_outs, merge_outs
+
+
+def get_shard_dir(base_dir, shard):
+    return '%s/shards/%s-of-%s' % (base_dir, shard[0], shard[1])
+
+
+def get_shard_combis(combis_split, shard, n_cores):
+    """Combinations of the shard `(i, N)`: every N-th combination of the
+    grid from the i-th (whatever the number of cores), split as per the
+    number of CPUs"""
+    i, n = shard
+    combis = [list(y) for x in combis_split for y in x][i - 1::n]
+    return [x for x in np.array_split(combis, n_cores) if len(x)]
+
+
+def reset_shard(shard_dir):
+    """Mark a shard as incomplete (running, or failed if it stops) until it
+    is written again, so that a rerun is never merged from the previous"""
+    fp = '%s/combinations.tsv' % shard_dir
+    if isfile(fp):
+        os.remove(fp)
+
+
+def write_shard(shard_dir, out_files):
+    """Mark a shard as complete, with the combinations it denoised"""
+    write_store(pd.DataFrame([get_fwd_rev(fr) for fr in out_files],
+                             columns=['forward', 'reverse']),
+                '%s/combinations.tsv' % shard_dir)
+
+
+def get_shards(base_dir, out_files):
+    """Shard of each combination of the grid, checking that the shards all
+    split the grid in the same number and are complete"""
+    shard_dirs = sorted(glob.glob('%s/shards/*-of-*' % base_dir))
+    if not shard_dirs:
+        raise IOError('No shard in "%s/shards"' % base_dir)
+    ns = set(basename(x).split('-of-')[1] for x in shard_dirs)
+    if len(ns) > 1:
+        raise ValueError('Shards of different splits of the grid (%s) in '
+                         '"%s/shards"' % (', '.join(sorted(ns)), base_dir))
+    incomplete = [basename(x) for x in shard_dirs
+                  if not isfile('%s/combinations.tsv' % x)]
+    if incomplete:
+        raise IOError('Incomplete shard(s) (running, or failed): %s' % (
+            ', '.join(incomplete)))
+    shards = {}
+    for shard_dir in shard_dirs:
+        combis = read_store('%s/combinations.tsv' % shard_dir)
+        for key in get_keys(combis, ['forward', 'reverse']):
+            shards[key] = shard_dir
+    missing = ['%s-%s' % get_fwd_rev(fr) for fr in out_files
+               if '%s|%s' % get_fwd_rev(fr) not in shards]
+    if missing:
+        raise ValueError('Combination(s) in no shard: %s' % ', '.join(missing))
+    return shards
+
+
+def merge_shards(base_dir, out_files, denoized_dir, eval_dir):
+    """Import the outputs of the shards of the grid in the main folders:
+    the denoised combinations and their fingerprints, the search results
+    and the evaluation outputs, which are then up to date for the stages
+    of the pipeline"""
+    shards = get_shards(base_dir, out_files)
+    print("Merging the outputs of %s shards" % len(set(shards.values())))
+    for fr, fps in out_files.items():
+        shard_dir = shards['%s|%s' % get_fwd_rev(fr)]
+        for fp in fps:
+            shard_fp = '%s/02_denoized/%s' % (
+                shard_dir, os.path.relpath(fp, denoized_dir))
+            shutil.copyfile(shard_fp, '%s.tmp' % fp)
+            os.replace('%s.tmp' % fp, fp)
+    outs_dir = '%s/outs' % eval_dir
+    for shard_dir in sorted(set(shards.values())):
+        combos = [k for k, v in shards.items() if v == shard_dir]
+        # tables keyed on the combinations: the rows of the shard replace
+        for fp, shard_fp in [
+                ('%s/fingerprints.tsv' % denoized_dir,
+                 '%s/02_denoized/fingerprints.tsv' % shard_dir),
+                ('%s/blast_in.tsv' % eval_dir,
+                 '%s/03_evaluated/blast_in.tsv' % shard_dir),
+                ('%s/blast_out.tsv' % eval_dir,
+                 '%s/03_evaluated/blast_out.tsv' % shard_dir)]:
+            if isfile(shard_fp):
+                merge_blasts(fp, read_store(shard_fp), combos)
+        shard_outs, shard_fps = read_outs('%s/03_evaluated/outs' % shard_dir)
+        if shard_outs:
+            stored, stored_fps = read_outs(outs_dir)
+            out = Outputs()
+            out.extend(shard_outs)
+            merge_outs(outs_dir, out, stored, stored_fps, shard_fps,
+                       set(get_keys(shard_fps, KEY)))
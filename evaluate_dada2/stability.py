@@ -0,0 +1,116 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import itertools
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from evaluate_dada2.io import get_fwd_rev
+from evaluate_dada2.trace import traced
+
+METRICS = ['Bray-Curtis', 'Jaccard']
+
+
+def get_features(dada2):
+    """Key of the features of each combination: their sequence, truncated
+    to the shortest forward length for the single-end combinations (so
+    that an ASV has the same key whatever the truncation length)"""
+    from qiime2 import Metadata
+    singles = [fr[0] for fr in dada2 if len(fr) == 1]
+    features = {}
+    for fr, (_, seq, __) in dada2.items():
+        seqs = seq.view(Metadata).to_dataframe()['Sequence']
+        seqs = seqs.astype(str).str.upper()
+        if len(fr) == 1:
+            seqs = seqs.str[:min(singles)]
+        features[fr] = seqs.to_dict()
+    return features
+
+
+def get_matrices(dada2, features):
+    """Relative abundances of the features of each combination in every
+    sample, as sparse matrices over shared sample and feature indices"""
+    tabs = {fr: tab.view(pd.DataFrame) for fr, (tab, _, __) in dada2.items()}
+    samples = pd.Index(sorted(set().union(*[x.index for x in tabs.values()])))
+    codes, coos = {}, {}
+    for fr, tab in tabs.items():
+        cols = np.array([codes.setdefault(features[fr][x], len(codes))
+                         for x in tab.columns], dtype=int)
+        coo = sp.coo_matrix(tab.values)
+        coos[fr] = (coo.data, samples.get_indexer(tab.index)[coo.row],
+                    cols[coo.col])
+    mats = {}
+    for fr, (data, rows, cols) in coos.items():
+        mat = sp.csr_matrix((data, (rows, cols)),
+                            shape=(len(samples), len(codes)))
+        depths = np.asarray(mat.sum(1)).ravel()
+        scale = np.divide(1., depths, out=np.zeros(len(depths)),
+                          where=depths > 0)
+        mats[fr] = sp.diags(scale) @ mat
+    return samples, mats
+
+
+def get_pairs(combos, pairs='neighbors'):
+    """Pairs of combinations to compare: all of them, or the neighbors in
+    the grid of truncation lengths (next forward, or next reverse length)"""
+    combos = sorted(combos)
+    if pairs == 'all':
+        return list(itertools.combinations(combos, 2))
+    combos_set = set(combos)
+    neighbors = []
+    for dim in range(max(len(x) for x in combos)):
+        lengths = sorted(set(x[dim] for x in combos))
+        nexts = dict(zip(lengths, lengths[1:]))
+        for fr in combos:
+            if fr[dim] not in nexts:
+                continue
+            nxt = fr[:dim] + (nexts[fr[dim]],) + fr[dim + 1:]
+            if nxt in combos_set:
+                neighbors.append((fr, nxt))
+    return neighbors
+
+
+def get_dissimilarities(a, b):
+    """Bray-Curtis and Jaccard dissimilarities between the rows (samples)
+    of two relative abundance matrices"""
+    diff = np.asarray(abs(a - b).sum(1)).ravel()
+    total = np.asarray((a + b).sum(1)).ravel()
+    a_pos, b_pos = a > 0, b > 0
+    n_a = np.asarray(a_pos.sum(1)).ravel()
+    n_b = np.asarray(b_pos.sum(1)).ravel()
+    shared = np.asarray(a_pos.multiply(b_pos).sum(1)).ravel()
+    union = n_a + n_b - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bray_curtis = np.where(total > 0, diff / total, np.nan)
+        jaccard = np.where(union > 0, 1. - shared / union, np.nan)
+    return bray_curtis, jaccard, n_a, n_b
+
+
+@traced()
+def get_stability(dada2, pairs='neighbors'):
+    """Per-sample Bray-Curtis and Jaccard dissimilarities between the
+    communities of pairs of combinations (samples empty in both are
+    skipped)"""
+    features = get_features(dada2)
+    samples, mats = get_matrices(dada2, features)
+    stability = []
+    for fr_a, fr_b in get_pairs(mats, pairs):
+        bray_curtis, jaccard, n_a, n_b = get_dissimilarities(
+            mats[fr_a], mats[fr_b])
+        keep = ~np.isnan(bray_curtis)
+        (f_a, r_a), (f_b, r_b) = get_fwd_rev(fr_a), get_fwd_rev(fr_b)
+        stability.append(pd.DataFrame({
+            'sample_name': samples[keep], 'forward_a': f_a, 'reverse_a': r_a,
+            'forward_b': f_b, 'reverse_b': r_b,
+            'Bray-Curtis': bray_curtis[keep], 'Jaccard': jaccard[keep],
+            'features_a': n_a[keep], 'features_b': n_b[keep]}))
+    if not stability:
+        return pd.DataFrame(columns=['sample_name', 'forward_a', 'reverse_a',
+                                     'forward_b', 'reverse_b'] + METRICS)
+    stability_pd = pd.concat(stability, ignore_index=True)
+    return stability_pd
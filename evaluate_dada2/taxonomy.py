@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def pad_taxon(taxon, ranks):
+    """Add the empty ranks after the deepest rank of a taxonomy"""
+    return '%s; %s' % (taxon, '; '.join([
+        '%s__' % r for r in ranks[ranks.index(taxon.split('; ')[-1][0]) + 1:]
+    ]))
+
+
+def get_tax_index(refs, ranks, defaults=('d__', 'd__Eukaryota')):
+    """Index the taxonomy of the mock references once: padded lineage of
+    every reference (and of the defaults used for features without
+    taxonomy), and integer node ID of every lineage at every rank"""
+    lineages = {feature: pad_taxon(taxon, ranks)
+                for feature, taxon in refs.items()}
+    defaults = {default: pad_taxon(default, ranks) for default in defaults}
+    taxa = sorted(set(lineages.values()) | set(defaults.values()))
+    nodes = {}
+    for level in range(1, len(ranks) + 1):
+        codes, uniques = factorize(
+            [';'.join(x.split(';')[:level]) for x in taxa])
+        nodes[level] = (dict(zip(taxa, codes)), uniques)
+    tax_index = {'ranks': list(ranks), 'lineages': lineages,
+                 'defaults': defaults, 'nodes': nodes}
+    return tax_index
+
+
+def factorize(values):
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object), sort=True)
+    return codes, np.asarray(uniques)
+
+
+def get_aggregation(codes, n_groups):
+    """Sparse (members x groups) matrix summing members into groups"""
+    codes = np.asarray(codes)
+    return sp.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), codes)),
+        shape=(len(codes), n_groups))
+
+
+def aggregate(tab, codes, groups):
+    """Sum the columns of a table into groups, keeping non-empty groups"""
+    agg = get_aggregation(codes, len(groups))
+    members = np.asarray(agg.sum(0)).ravel() > 0
+    values = (agg.T @ tab.values.T).T[:, members]
+    return pd.DataFrame(values, index=tab.index, columns=groups[members])
+
+
+def collapse_features(tab, tax_index, default='d__'):
+    """Sum the feature columns of a table per padded lineage"""
+    fallback = tax_index['defaults'][default]
+    lineages = [tax_index['lineages'].get(x, fallback) for x in tab.columns]
+    codes, taxa = factorize(lineages)
+    return aggregate(tab, codes, taxa)
+
+
+def collapse(tab, level, tax_index=None):
+    """Sum the columns of a table that share a taxonomy up to `level`:
+    indexed lineages use the precomputed nodes of that rank, others (e.g.
+    ASV IDs) are grouped on their truncated name"""
+    if tax_index and level in tax_index['nodes']:
+        nodes, taxa = tax_index['nodes'][level]
+        if all(x in nodes for x in tab.columns):
+            return aggregate(tab, [nodes[x] for x in tab.columns], taxa)
+    codes, taxa = factorize(
+        [';'.join(x.split(';')[:level]) for x in tab.columns])
+    return aggregate(tab, codes, taxa)
@@ -0,0 +1,174 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import resource
+import functools
+import threading
+import pandas as pd
+from contextlib import contextmanager, nullcontext
+
+# folder of the spans recorded by each process (tracing is disabled if unset,
+# and enabled for the workers started once it is set)
+TRACE_ENV = 'EVALUATE_DADA2_TRACE'
+NULL = nullcontext()
+METRICS = ['wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_mb', 'read_mb',
+           'written_mb']
+# usage of the whole process (not of the thread of a span), which is only
+# attributed to the spans that overlap no span of another thread, and is
+# recorded as a process total (prefixed "process_", and not summed) for the
+# others, e.g. of concurrent stages
+PROCESS = ['children_cpu_s', 'read_mb', 'written_mb']
+# spans open in this process: their thread and whether another thread had
+# an open span meanwhile
+OPEN = {}
+OPEN_LOCK = threading.Lock()
+
+
+def get_io():
+    """Bytes read and written by the process (including from the page cache
+    and pipes, and by its terminated children) on Linux, or from its block
+    I/O operations elsewhere"""
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(x.split(': ') for x in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except OSError:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def get_usage():
+    """Timestamp (µs), CPU time of the thread (stages run concurrently in
+    threads) and of the terminated children of the process (e.g. blastn,
+    or the R of DADA2) and bytes read and written"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.time_ns() // 1000, time.thread_time(),
+            children.ru_utime + children.ru_stime) + get_io()
+
+
+def get_peak_rss():
+    """Peak resident memory of the process so far (MB)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def open_span(token):
+    """Register a span of the current thread, and flag the open spans of
+    the other threads as overlapped (and this one, if there are any)"""
+    tid = threading.get_ident()
+    with OPEN_LOCK:
+        others = [x for x in OPEN.values() if x[0] != tid]
+        for other in others:
+            other[1] = True
+        OPEN[token] = [tid, bool(others)]
+
+
+def close_span(token):
+    """Whether a span overlapped a span of another thread"""
+    with OPEN_LOCK:
+        return OPEN.pop(token)[1]
+
+
+@contextmanager
+def record(trace_dir, name, cat, args):
+    token = object()
+    open_span(token)
+    start = get_usage()
+    try:
+        yield
+    finally:
+        end = get_usage()
+        overlapped = close_span(token)
+        usage = [x - y for x, y in zip(end, start)]
+        args = {k: str(v) for k, v in args.items()}
+        args.update({
+            'cpu_s': usage[1], 'children_cpu_s': usage[2],
+            'peak_rss_mb': get_peak_rss(), 'read_mb': usage[3] / 1e6,
+            'written_mb': usage[4] / 1e6})
+        if overlapped:
+            args.update({'process_%s' % x: args.pop(x) for x in PROCESS})
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start[0],
+                 'dur': usage[0], 'pid': os.getpid(),
+                 'tid': threading.get_ident(),
+                 'args': args}
+        with open('%s/%s.jsonl' % (trace_dir, os.getpid()), 'a') as o:
+            o.write('%s\n' % json.dumps(event))
+
+
+def span(name, cat='stage', **args):
+    """Record the wall and CPU time, peak memory, I/O and subprocesses time
+    of a block, if tracing is enabled (otherwise, a no-op)"""
+    trace_dir = os.environ.get(TRACE_ENV)
+    if not trace_dir:
+        return NULL
+    return record(trace_dir, name, cat, args)
+
+
+def traced(name=None, cat='stage'):
+    """Decorator recording each call of a function as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace(trace_dir):
+    """Enable tracing in this process and in the workers it will start"""
+    if os.path.isdir(trace_dir):
+        shutil.rmtree(trace_dir)
+    os.makedirs(trace_dir)
+    os.environ[TRACE_ENV] = trace_dir
+
+
+def get_summary(events):
+    """Number of calls, total times and I/O, and max peak memory per span
+    (the process totals of the overlapping spans are not summed)"""
+    spans = pd.DataFrame([dict(dict.fromkeys(METRICS), name=e['name'],
+                               cat=e['cat'], wall_s=e['dur'] / 1e6,
+                               **e['args'])
+                          for e in events])
+    spans[METRICS] = spans[METRICS].astype(float)
+    summary = spans.groupby(['cat', 'name']).agg(
+        calls=('wall_s', 'size'), **{x: (x, 'max' if x == 'peak_rss_mb'
+                                         else 'sum') for x in METRICS})
+    return summary.sort_values('wall_s', ascending=False).round(2)
+
+
+def stop_trace(trace_fp):
+    """Gather the spans of all the processes in a Chrome trace JSON file
+    (to open in Perfetto or chrome://tracing), write and print a summary
+    per span name, and disable tracing"""
+    trace_dir = os.environ.pop(TRACE_ENV, None)
+    if not trace_dir:
+        return
+    events = []
+    for events_fp in sorted(glob.glob('%s/*.jsonl' % trace_dir)):
+        with open(events_fp) as f:
+            events.extend(json.loads(x) for x in f)
+    shutil.rmtree(trace_dir)
+    names = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid,
+              'args': {'name': 'main' if pid == os.getpid() else 'worker'}}
+             for pid in sorted(set(e['pid'] for e in events))]
+    with open(trace_fp, 'w') as o:
+        json.dump({'traceEvents': names + events,
+                   'displayTimeUnit': 'ms'}, o)
+    if not events:
+        return
+    summary = get_summary(events)
+    summary.to_csv(trace_fp.replace('.json', '_summary.tsv'), sep='\t')
+    print('Time spent per stage and task (trace in %s):' % trace_fp)
+    print(summary.to_string())
@@ -37,7 +37,9 @@ with open("evaluate_dada2/__init__.py", "rb") as f:
     hit = _version_re.search(f.read().decode("utf-8")).group(1)
     version = str(ast.literal_eval(hit))
 
-standalone = ['run_dada2=evaluate_dada2.scripts._standalone_dada2:standalone_dada2']
+standalone = [
+    'run_dada2=evaluate_dada2.scripts._standalone_dada2:standalone_dada2',
+    'merge_dada2=evaluate_dada2.scripts._standalone_dada2:standalone_merge']
 
 setup(
     name="evaluate_dada2",
@@ -53,8 +55,10 @@ setup(
     url="https://github.com/FranckLejzerowicz/evaluate_dada2",
     packages=find_packages(),
     install_requires=["click", "seaborn"],
+    extras_require={"report": ["pypdf"]},
     classifiers=classifiers,
     entry_points={'console_scripts': standalone},
     include_package_data=True,
+    package_data={"evaluate_dada2": ["resources/*.html"]},
     python_requires='>=3.6',
 )
@@ -0,0 +1,144 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+"""Reference outputs of the evaluation of each observed composition of
+`observed.tsv` against `expected.tsv`, in `outputs/<composition>/`:
+
+    python tests/data/evaluation/make_outputs.py [--scipy]
+
+By default, with qiime2's `quality-control evaluate-composition` (needs
+qiime2 and q2-quality-control). With `--scipy`, one composition at a time
+with scipy, as q2-quality-control computes them: tables collapsed at each
+level on the truncated lineages (zeros for the features of the other),
+`linregress(expected, observed)`, `braycurtis`, `jaccard` of the presences,
+and at the evaluation depth, the expected features not observed (false
+negatives) and the observed features not expected, which are either a
+less deep lineage of an expected feature (underclassifications, ignoring
+empty ranks) or misclassifications.
+
+How the outputs were made (the evaluator and the versions of qiime2,
+q2-quality-control and scipy) is recorded in `outputs/provenance.tsv`, which
+the tests check: they warn while the outputs are not those of qiime2. The
+outputs in the repository were written with `--scipy`, as qiime2 could not be
+installed where they were made: rerun without it where qiime2 is installed to
+replace them with the plugin's own outputs.
+"""
+
+import os
+import re
+import sys
+import tempfile
+import pandas as pd
+from importlib.metadata import version, PackageNotFoundError
+
+DEPTH = 7
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUTS = {'false_neg': 'false_negative_features', 'misclass':
+           'misclassifications', 'underclass': 'underclassifications',
+           'results': 'results'}
+
+
+def read_tables():
+    exp = pd.read_table('%s/expected.tsv' % DATA_DIR, index_col='Taxon')
+    obs = pd.read_table('%s/observed.tsv' % DATA_DIR, index_col='Taxon')
+    return exp['mock'], obs
+
+
+def collapse(vector, level):
+    return vector.groupby([';'.join(x.split(';')[:level])
+                           for x in vector.index]).sum()
+
+
+def get_ranks(taxon):
+    ranks = [x.strip() for x in taxon.split(';')]
+    return [x for x in ranks if x and not re.match(r'^\w__$', x)]
+
+
+def evaluate_scipy(exp, obs, depth):
+    from scipy.stats import linregress
+    from scipy.spatial.distance import braycurtis, jaccard
+    results = []
+    for level in range(1, depth + 1):
+        vectors = pd.concat([collapse(exp, level), collapse(obs, level)],
+                            axis=1).fillna(0.)
+        x, y = vectors.iloc[:, 0].values, vectors.iloc[:, 1].values
+        tp = ((x > 0) & (y > 0)).sum()
+        fit = linregress(x, y)
+        results.append({
+            'sample': 'mock', 'level': level,
+            'Observed Taxa': (y > 0).sum(),
+            'Observed / Expected Taxa': (y > 0).sum() / (x > 0).sum(),
+            'TAR': tp / (y > 0).sum(), 'TDR': tp / (x > 0).sum(),
+            'Slope': fit.slope, 'Intercept': fit.intercept,
+            'r-value': fit.rvalue, 'P value': fit.pvalue,
+            'Std Err': fit.stderr, 'r-squared': fit.rvalue ** 2,
+            'Bray-Curtis': braycurtis(x, y), 'Jaccard': jaccard(x > 0, y > 0)})
+    exp_taxa = [get_ranks(t) for t in vectors.index[x > 0]]
+    under = [any(len(get_ranks(t)) < len(e) and
+                 e[:len(get_ranks(t))] == get_ranks(t) for e in exp_taxa)
+             for t in vectors.index]
+    under = pd.Series(under, index=vectors.index)
+    exp_v, obs_v = vectors.iloc[:, 0], vectors.iloc[:, 1]
+    false_pos = (obs_v > 0) & (exp_v == 0)
+    return {
+        'false_neg': exp_v[(exp_v > 0) & (obs_v == 0)],
+        'misclass': obs_v[false_pos & ~under],
+        'underclass': obs_v[false_pos & under],
+        'results': pd.DataFrame(results)}
+
+
+def evaluate_q2(exp, obs, depth):
+    from evaluate_dada2.eval import eval_q2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        res = eval_q2(tmp_dir, exp.to_frame('mock').T, obs.to_frame('mock').T,
+                      depth, '%s/evaluation' % tmp_dir)
+    return res
+
+
+def write(res, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    for d, name in OUTPUTS.items():
+        dat = res[d]
+        if isinstance(dat, pd.Series):
+            dat = dat.rename_axis('Taxon').to_frame('mock').reset_index()
+        dat.to_csv('%s/%s.tsv' % (out_dir, name), sep='\t', index=False)
+
+
+def get_version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def write_provenance(scipy):
+    provenance = pd.Series({
+        'evaluator': 'scipy' if scipy else 'qiime2',
+        'qiime2': None if scipy else get_version('qiime2'),
+        'q2-quality-control': None if scipy else get_version(
+            'q2-quality-control'),
+        'scipy': get_version('scipy') if scipy else None})
+    provenance.rename_axis('item').to_frame('value').to_csv(
+        '%s/outputs/provenance.tsv' % DATA_DIR, sep='\t')
+
+
+def main(scipy=False):
+    exp, obs = read_tables()
+    for composition in obs.columns:
+        obs_vector = obs[composition].dropna()
+        if scipy:
+            res = evaluate_scipy(exp, obs_vector, DEPTH)
+        else:
+            res = evaluate_q2(exp, obs_vector, DEPTH)
+        write(res, '%s/outputs/%s' % (DATA_DIR, composition))
+        print('Written: outputs/%s' % composition)
+    write_provenance(scipy)
+
+
+if __name__ == "__main__":
+    main('--scipy' in sys.argv[1:])
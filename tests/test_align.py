@@ -0,0 +1,82 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import random
+import numpy as np
+import pandas as pd
+import pytest
+
+from evaluate_dada2.align import (
+    get_kmer_index, get_seeds, banded_align, encode, rev_comp, align_query,
+    kmer_search)
+from evaluate_dada2.blast import search_seqs
+
+
+@pytest.fixture(scope='module')
+def refs(tmp_path_factory):
+    """Two random 300 nt references, and a 250 nt query within the first"""
+    rng = random.Random(1)
+    seqs = [''.join(rng.choice('ACGT') for _ in range(300)) for _ in '12']
+    ref_fasta = '%s/refs.fasta' % tmp_path_factory.mktemp('refs')
+    with open(ref_fasta, 'w') as o:
+        for rdx, seq in enumerate(seqs):
+            o.write('>r%s\n%s\n' % (rdx + 1, seq))
+    return ref_fasta, get_kmer_index(ref_fasta), seqs[0][20:270]
+
+
+def mutate(query, edit):
+    base = 'A' if query[125] != 'A' else 'C'
+    return {'exact': query,
+            'mismatch': query[:125] + base + query[126:],
+            'deletion': query[:125] + query[126:],
+            'insertion': query[:125] + base + query[125:]}[edit]
+
+
+@pytest.mark.parametrize('edit, pident, bitscore', [
+    ('exact', 100., 462.), ('mismatch', 99.6, 457.),
+    ('deletion', 99.6, 456.), ('insertion', 99.602, 458.)])
+@pytest.mark.parametrize('strand', ['forward', 'reverse'])
+def test_align_query(refs, edit, pident, bitscore, strand):
+    _, index, query = refs
+    query = mutate(query, edit)
+    if strand == 'reverse':
+        query = rev_comp(query)
+    assert align_query(query, index) == [['r1', pident, bitscore, 100.]]
+
+
+def test_banded_align(refs):
+    """Score (doubled), identities, alignment length and query start and
+    end of the best local alignment on the seeded diagonal"""
+    _, index, query = refs
+    codes = encode(mutate(query, 'deletion'))
+    ref_idx, diags = get_seeds(codes, index)
+    scores, attrs = banded_align(codes, index, ref_idx, diags)
+    best = index['ids'].index('r1')
+    r1 = list(ref_idx).index(best)
+    assert scores[r1] == 249 * 2 - 5
+    assert list(attrs[r1]) == [249, 250, 0, 248]
+
+
+def test_unrelated(refs):
+    _, index, _ = refs
+    assert align_query('ACGT' * 60, index) == []
+
+
+def test_search_seqs(refs, tmp_path):
+    ref_fasta, index, query = refs
+    queries = pd.Series({x: mutate(query, x) for x in ['exact', 'mismatch',
+                                                       'deletion']})
+    search_out = search_seqs('%s/toblast.fa' % tmp_path, queries, ref_fasta,
+                             index, 'kmer', 1)
+    assert search_out.values.tolist() == [
+        ['exact', 'r1', 100., 462., 100.],
+        ['mismatch', 'r1', 99.6, 457., 100.],
+        ['deletion', 'r1', 99.6, 456., 100.]]
+    pd.testing.assert_frame_equal(
+        search_out, kmer_search(queries, index, n_cores=2))
+    assert np.issubdtype(search_out['bitscore'].dtype, np.floating)
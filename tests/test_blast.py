@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import random
+import shutil
+import pandas as pd
+import pytest
+
+from evaluate_dada2.align import OUT_COLS, get_kmer_index, rev_comp
+from evaluate_dada2.blast import get_exact_index, get_exact_hits, search_seqs
+
+
+@pytest.fixture(scope='module')
+def refs(tmp_path_factory):
+    """Two random 300 nt references, and a 250 nt query within the first"""
+    rng = random.Random(0)
+    seqs = [''.join(rng.choice('ACGT') for _ in range(300)) for _ in '12']
+    ref_fasta = '%s/refs.fasta' % tmp_path_factory.mktemp('refs')
+    with open(ref_fasta, 'w') as o:
+        for rdx, seq in enumerate(seqs):
+            o.write('>r%s\n%s\n' % (rdx + 1, seq))
+    return ref_fasta, seqs[0][20:270]
+
+
+@pytest.mark.parametrize('strand', ['forward', 'reverse'])
+def test_exact_hits(refs, strand):
+    ref_fasta, query = refs
+    if strand == 'reverse':
+        query = rev_comp(query)
+    queries = pd.Series({'asv': query, 'other': 'ACGT' * 10})
+    exact_pd, to_blast = get_exact_hits(queries, get_exact_index(ref_fasta))
+    assert list(to_blast.index) == ['other']
+    assert list(exact_pd.columns) == OUT_COLS
+    assert exact_pd.values.tolist() == [['asv', 'r1', 100., 462., 100.]]
+
+
+@pytest.mark.parametrize('backend', [
+    'kmer', pytest.param('blastn', marks=pytest.mark.skipif(
+        not shutil.which('blastn'), reason='blastn is not installed'))])
+def test_exact_hits_as_searched(refs, backend, tmp_path, monkeypatch):
+    """The exact hits have the same schema and values as the rows of the
+    search backends for an exact match"""
+    monkeypatch.setenv('EVALUATE_DADA2_CACHE', str(tmp_path))
+    ref_fasta, query = refs
+    queries = pd.Series({'asv': query})
+    exact_pd, _ = get_exact_hits(queries, get_exact_index(ref_fasta))
+    search_out = search_seqs('%s/toblast.fa' % tmp_path, queries, ref_fasta,
+                             get_kmer_index(ref_fasta), backend, 1)
+    search_out = search_out[search_out['sseqid'] == 'r1']
+    pd.testing.assert_frame_equal(exact_pd, search_out.reset_index(drop=True))
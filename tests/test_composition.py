@@ -0,0 +1,78 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import pytest
+
+from evaluate_dada2.composition import evaluate_compositions
+
+DATA_DIR = '%s/data/evaluation' % os.path.dirname(os.path.abspath(__file__))
+DEPTH = 7
+METRICS = ['Observed Taxa', 'Observed / Expected Taxa', 'TAR', 'TDR', 'Slope',
+           'Intercept', 'r-value', 'P value', 'Std Err', 'r-squared',
+           'Bray-Curtis', 'Jaccard']
+FEATURES = {'false_neg': 'false_negative_features',
+            'misclass': 'misclassifications',
+            'underclass': 'underclassifications'}
+
+
+def read_tables():
+    exp = pd.read_table('%s/expected.tsv' % DATA_DIR, index_col='Taxon')
+    obs = pd.read_table('%s/observed.tsv' % DATA_DIR, index_col='Taxon')
+    return exp['mock'], obs.T
+
+
+def read_outputs(composition, name):
+    return pd.read_table('%s/outputs/%s/%s.tsv' % (
+        DATA_DIR, composition, name))
+
+
+@pytest.fixture(scope='module')
+def evaluation():
+    """Native evaluation of all the observed compositions at once (warning
+    if the reference outputs are not those of q2-quality-control, see
+    `make_outputs.py`)"""
+    provenance = pd.read_table('%s/outputs/provenance.tsv' % DATA_DIR,
+                               index_col='item')['value']
+    if provenance['evaluator'] != 'qiime2':
+        warnings.warn('The reference outputs were made with %s, not with '
+                      'qiime2: rerun tests/data/evaluation/make_outputs.py '
+                      'where qiime2 is installed' % provenance['evaluator'])
+    exp, obs = read_tables()
+    return obs.index, evaluate_compositions(exp, obs, DEPTH)
+
+
+@pytest.mark.parametrize('composition', read_tables()[1].index)
+def test_results(evaluation, composition):
+    compositions, native = evaluation
+    cell = list(compositions).index(composition)
+    results = native['results']
+    results = results[results['cell'] == cell].set_index('level')
+    expected = read_outputs(composition, 'results').set_index('level')
+    assert list(results.index) == list(expected.index)
+    np.testing.assert_allclose(
+        results[METRICS].values.astype(float),
+        expected.loc[results.index, METRICS].values.astype(float),
+        rtol=1e-7, atol=1e-9, equal_nan=True)
+
+
+@pytest.mark.parametrize('composition', read_tables()[1].index)
+@pytest.mark.parametrize('output', list(FEATURES))
+def test_features(evaluation, composition, output):
+    compositions, native = evaluation
+    cell = list(compositions).index(composition)
+    features = native[output]
+    features = features[features['cell'] == cell]
+    expected = read_outputs(composition, FEATURES[output])
+    assert set(features['Taxon']) == set(expected['Taxon'])
+    np.testing.assert_allclose(
+        features.set_index('Taxon')['mock'].sort_index().astype(float),
+        expected.set_index('Taxon')['mock'].sort_index().astype(float))
@@ -0,0 +1,100 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import pytest
+
+from evaluate_dada2.pipeline import Stage, Pipeline
+
+
+def make_stage(out_dir, calls, name, compute, deps=(), params=()):
+    """Stage writing the value it computes to its output file"""
+    fp = '%s/%s.txt' % (out_dir, name)
+
+    def run(values):
+        calls.append(name)
+        value = compute(values)
+        with open(fp, 'w') as o:
+            o.write(str(value))
+        return {name: value}
+
+    def load(values):
+        with open(fp) as f:
+            return {name: int(f.read())}
+    return Stage(name, run, deps, [fp], load, params=params)
+
+
+def run(out_dir, x=1, y=1, only=(), start=None):
+    """Run a -> b -> c and d (independent): a only keeps the parity of its
+    parameter `x`, so that some of its changes leave its output intact"""
+    calls = []
+    pipeline = Pipeline({}, '%s/pipeline.tsv' % out_dir, 2)
+    pipeline.add(make_stage(out_dir, calls, 'a', lambda v: x % 2,
+                            params=[x]))
+    pipeline.add(make_stage(out_dir, calls, 'b', lambda v: v['a'] + 1, ['a']))
+    pipeline.add(make_stage(out_dir, calls, 'c', lambda v: v['b'] * 10,
+                            ['b']))
+    pipeline.add(make_stage(out_dir, calls, 'd', lambda v: y, params=[y]))
+    values = pipeline.run(only, start)
+    return sorted(calls), values
+
+
+@pytest.fixture
+def out_dir(tmp_path):
+    assert run(tmp_path)[0] == ['a', 'b', 'c', 'd']
+    return tmp_path
+
+
+def test_up_to_date(out_dir):
+    assert run(out_dir) == ([], {})
+
+
+def test_fingerprint(out_dir):
+    calls, values = run(out_dir, x=2)
+    assert calls == ['a', 'b', 'c']
+    assert values['c'] == {'c': 10}
+    assert run(out_dir, x=2, y=2)[0] == ['d']
+
+
+def test_same_outputs(out_dir):
+    """A stage rerun with the same outputs leaves its dependents as is"""
+    assert run(out_dir, x=3)[0] == ['a']
+    assert run(out_dir, x=3)[0] == []
+
+
+def test_outputs(out_dir):
+    with open('%s/b.txt' % out_dir, 'w') as o:
+        o.write('0')
+    assert run(out_dir)[0] == ['b']
+    os.remove('%s/c.txt' % out_dir)
+    assert run(out_dir)[0] == ['c']
+
+
+def test_only(out_dir):
+    """Only the selected stage runs, on the (stale) outputs of the stage it
+    depends on, which stay stale"""
+    calls, values = run(out_dir, x=2, only=['b'])
+    assert calls == ['b']
+    assert values['a'] == {'a': 1} and values['b'] == {'b': 2}
+    assert run(out_dir, x=2)[0] == ['a', 'b', 'c']
+
+
+def test_start(out_dir):
+    """The start stage and its dependents run, even if up to date"""
+    calls, values = run(out_dir, start='b')
+    assert calls == ['b', 'c']
+    assert values['c'] == {'c': 20}
+    assert run(out_dir)[0] == []
+
+
+def test_unknown(out_dir):
+    with pytest.raises(ValueError):
+        run(out_dir, only=['e'])
+    with pytest.raises(ValueError):
+        Pipeline({}, '%s/pipeline.tsv' % out_dir).add(
+            Stage('e', lambda v: {}, ['f']))
@@ -0,0 +1,90 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2023, Franck Lejzerowicz.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import glob
+import pandas as pd
+import pytest
+
+from evaluate_dada2.q2 import get_combis_split
+from evaluate_dada2.io import (
+    define_dirs, get_out_files, get_fwd_rev, get_keys, read_store,
+    write_store)
+from evaluate_dada2.shard import (
+    get_shard_dir, get_shard_combis, reset_shard, write_shard, merge_shards)
+
+FORWARDS, REVERSES = [150, 200, 250], [150, 200]
+N = 3
+
+
+def get_grid(combis_split):
+    return sorted(tuple(int(x) for x in y) for z in combis_split for y in z)
+
+
+@pytest.mark.parametrize('n_cores', [1, 2, 4])
+def test_get_shard_combis(n_cores):
+    """The shards split the grid, the same whatever the number of cores"""
+    combis_split = get_combis_split(FORWARDS, REVERSES, n_cores)
+    shards = [get_grid(get_shard_combis(combis_split, (i, N), 2))
+              for i in range(1, N + 1)]
+    assert sorted(sum(shards, [])) == get_grid(combis_split)
+    assert shards == [get_grid(get_shard_combis(
+        get_combis_split(FORWARDS, REVERSES, 1), (i, N), 1))
+        for i in range(1, N + 1)]
+
+
+def run_shard(base_dir, shard):
+    """Denoised outputs, fingerprints and search results of a shard"""
+    shard_dir = get_shard_dir(base_dir, shard)
+    reset_shard(shard_dir)
+    _, denoized_dir, eval_dir, _ = define_dirs(base_dir, shard_dir)
+    combis_split = get_combis_split(FORWARDS, REVERSES, 2)
+    out_files = get_out_files(get_shard_combis(combis_split, shard, 2),
+                              denoized_dir)
+    for fr, fps in out_files.items():
+        for fp in fps:
+            with open(fp, 'w') as o:
+                o.write('%s-%s' % get_fwd_rev(fr))
+    combos = pd.DataFrame([get_fwd_rev(fr) for fr in out_files],
+                          columns=['forward', 'reverse'])
+    write_store(combos.assign(fingerprint='x'),
+                '%s/fingerprints.tsv' % denoized_dir)
+    write_store(combos.assign(n=1, fingerprint='y'),
+                '%s/blast_in.tsv' % eval_dir)
+    return shard_dir, out_files
+
+
+def test_merge_shards(tmp_path):
+    base_dir = str(tmp_path)
+    for i in range(1, N + 1):
+        shard_dir, out_files = run_shard(base_dir, (i, N))
+        write_shard(shard_dir, out_files)
+    _, denoized_dir, eval_dir, _ = define_dirs(base_dir)
+    out_files = get_out_files(get_combis_split(FORWARDS, REVERSES, 1),
+                              denoized_dir)
+    grid = sorted('%s|%s' % get_fwd_rev(fr) for fr in out_files)
+    # the combinations of the complete shards cover the grid exactly once
+    combis = pd.concat([read_store(x) for x in glob.glob(
+        '%s/shards/*/combinations.tsv' % base_dir)])
+    assert sorted(get_keys(combis, ['forward', 'reverse'])) == grid
+
+    # a rerun shard is incomplete until it is written again
+    run_shard(base_dir, (2, N))
+    with pytest.raises(IOError):
+        merge_shards(base_dir, out_files, denoized_dir, eval_dir)
+    write_shard(*run_shard(base_dir, (2, N)))
+
+    for _ in range(2):
+        merge_shards(base_dir, out_files, denoized_dir, eval_dir)
+        for fp in ['%s/fingerprints.tsv' % denoized_dir,
+                   '%s/blast_in.tsv' % eval_dir]:
+            merged = read_store(fp)
+            assert sorted(get_keys(merged, ['forward', 'reverse'])) == grid
+    for fr, fps in out_files.items():
+        for fp in fps:
+            with open(fp) as f:
+                assert f.read() == '%s-%s' % get_fwd_rev(fr)